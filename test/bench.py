@@ -0,0 +1,440 @@
+#!/usr/bin/python3
+# bench -- Thot benchmark
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of Thot on synthetic documents.
+
+For each selected syntax (default, dokuwiki, textile, markdown) and
+size (in lines), a synthetic document made of sections, paragraphs,
+lists, tables, code and included files is generated. The document is
+parsed once, then generated with each selected back-end. The times of
+the parsing, of the pre-generation (Document.pregen) and of the
+generation itself are measured separately and written in a JSON file.
+
+A back-end failing on a document is recorded with an error message.
+Given the JSON file of a previous run (option -c), the times are
+compared and the command fails if one of them is slower than
+the allowed ratio.
+
+Examples:
+	python3 bench.py -s 1k,10k -o bench.json
+	python3 bench.py -s 1M -x dokuwiki -t html
+	python3 bench.py -c old.json
+"""
+
+import contextlib
+import datetime
+import json
+import optparse
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thot.command as command
+import thot.common as common
+import thot.doc as doc
+import thot.tparser as tparser
+
+VERSION = "1"
+SYNTAXES = ["default", "dokuwiki", "textile", "markdown"]
+BACKS = ["html", "latex", "docbook", "md"]
+PHASES = ["parse", "pregen", "gen"]
+INCLUDE_PERIOD = 10
+MIN_TIME = .01
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+	"adipiscing", "elit", "sed", "do", "eiusmod", "tempor", "incididunt",
+	"ut", "labore", "et", "dolore", "magna", "aliqua"]
+
+
+def parse_size(text):
+	"""Parse a size with an optional k or M suffix."""
+	text = text.strip()
+	mult = 1
+	if text[-1:] in ("k", "K"):
+		mult = 1000
+		text = text[:-1]
+	elif text[-1:] == "M":
+		mult = 1000000
+		text = text[:-1]
+	return int(text) * mult
+
+
+def format_size(size):
+	"""Format a size with a k or M suffix."""
+	if size % 1000000 == 0:
+		return "%dM" % (size // 1000000)
+	elif size % 1000 == 0:
+		return "%dk" % (size // 1000)
+	else:
+		return str(size)
+
+
+class Syntax:
+	"""Producer of the text of a synthetic document in a given syntax.
+	Each method returns a list of lines."""
+	name = None
+	use = None
+
+	def __init__(self, name, use = None):
+		self.name = name
+		self.use = use
+
+	def text(self, i):
+		"""Build a sentence using the words and the given index."""
+		words = [WORDS[(i * 7 + j * 3) % len(WORDS)] for j in range(12)]
+		return " ".join(words)
+
+	def styled(self, i):
+		"""Build a sentence with some formatting."""
+		return self.text(i)
+
+	def prolog(self):
+		lines = []
+		if self.use != None:
+			lines.append("@use %s" % self.use)
+		lines.append("@TITLE=Benchmark %s" % self.name)
+		lines.append("@AUTHORS=Thot <thot@example.org>")
+		lines.append("@LANG=en")
+		lines.append("")
+		return lines
+
+	def header(self, level, title):
+		return []
+
+	def par(self, i):
+		return [self.styled(i), self.text(i + 1), ""]
+
+	def list(self, i):
+		return []
+
+	def table(self, i):
+		return []
+
+	def code(self, i):
+		return []
+
+	def include(self, path):
+		return ["@include %s" % path, ""]
+
+	def section(self, i, include):
+		"""Build a section of the document."""
+		lines = self.header(1 if i % 5 == 0 else 2, "Section %d" % i)
+		lines = lines + self.par(i) + self.list(i) + self.par(i + 2) \
+			+ self.table(i) + self.code(i)
+		if include != None:
+			lines = lines + self.include(include)
+		return lines
+
+	def included(self):
+		"""Build the content of the included file."""
+		return self.par(0) + self.list(0)
+
+
+class Default(Syntax):
+	"""Syntax without any module: only paragraphs and Thot commands."""
+
+	def __init__(self):
+		Syntax.__init__(self, "default")
+
+	def styled(self, i):
+		return "%s @(TITLE) #(term%d) ##" % (self.text(i), i)
+
+
+class Dokuwiki(Syntax):
+
+	def __init__(self):
+		Syntax.__init__(self, "dokuwiki", "dokuwiki")
+
+	def styled(self, i):
+		return "**%s** //%s// ''code'' [[http://example.org/%d|link]] %s" \
+			% (WORDS[i % len(WORDS)], WORDS[(i + 1) % len(WORDS)], i, self.text(i))
+
+	def header(self, level, title):
+		eqs = "=" * (7 - level)
+		return ["%s %s %s" % (eqs, title, eqs), ""]
+
+	def list(self, i):
+		return ["  * %s" % self.text(i), "  * %s" % self.text(i + 1),
+			"    * %s" % self.text(i + 2), "", "  - %s" % self.text(i + 3), ""]
+
+	def table(self, i):
+		return ["^ a ^ b ^ c ^"] \
+			+ ["| %d | %s | %s |" % (j, WORDS[j], WORDS[i % len(WORDS)]) for j in range(3)] \
+			+ [""]
+
+	def code(self, i):
+		return ["<code python>", "def f%d(x):" % i, "\treturn x + %d" % i, "</code>", ""]
+
+
+class Textile(Syntax):
+
+	def __init__(self):
+		Syntax.__init__(self, "textile", "textile")
+
+	def styled(self, i):
+		return "*%s* **%s** \"link\":http://example.org/%d %s" \
+			% (WORDS[i % len(WORDS)], WORDS[(i + 1) % len(WORDS)], i, self.text(i))
+
+	def header(self, level, title):
+		return ["h%d. %s" % (level, title), ""]
+
+	def list(self, i):
+		return ["* %s" % self.text(i), "* %s" % self.text(i + 1),
+			"** %s" % self.text(i + 2), "", "# %s" % self.text(i + 3), ""]
+
+	def table(self, i):
+		return ["|_ a |_ b |_ c |"] \
+			+ ["| %d | %s | %s |" % (j, WORDS[j], WORDS[i % len(WORDS)]) for j in range(3)] \
+			+ [""]
+
+	def code(self, i):
+		return ["bc. return x + %d;" % i, ""]
+
+
+class Markdown(Syntax):
+
+	def __init__(self):
+		Syntax.__init__(self, "markdown", "markdown")
+
+	def styled(self, i):
+		return "**%s** *%s* `code` [link](http://example.org/%d) %s" \
+			% (WORDS[i % len(WORDS)], WORDS[(i + 1) % len(WORDS)], i, self.text(i))
+
+	def header(self, level, title):
+		return ["%s %s" % ("#" * level, title), ""]
+
+	def list(self, i):
+		return ["* %s" % self.text(i), "* %s" % self.text(i + 1),
+			"* %s" % self.text(i + 2), ""]
+
+	def code(self, i):
+		return ["    def f%d(x):" % i, "        return x + %d" % i, ""]
+
+
+SYNTAX_MAP = {
+	"default": Default(),
+	"dokuwiki": Dokuwiki(),
+	"textile": Textile(),
+	"markdown": Markdown()
+}
+
+
+def make_document(dir, syntax, size):
+	"""Generate a synthetic document of the given size in lines (the
+	included files are counted) and return its path."""
+	name = "%s-%s" % (syntax.name, format_size(size))
+	inc_name = "%s-inc.thot" % syntax.name
+	included = syntax.included()
+	with open(os.path.join(dir, inc_name), "w", encoding = "utf-8") as out:
+		for line in included:
+			out.write(line + "\n")
+	path = os.path.join(dir, name + ".thot")
+	with open(path, "w", encoding = "utf-8") as out:
+		count = 0
+		for line in syntax.prolog():
+			out.write(line + "\n")
+			count += 1
+		i = 0
+		while count < size:
+			inc = inc_name if i % INCLUDE_PERIOD == INCLUDE_PERIOD - 1 else None
+			lines = syntax.section(i, inc)
+			for line in lines:
+				out.write(line + "\n")
+			count += len(lines)
+			if inc != None:
+				count += len(included)
+			i += 1
+	return path
+
+
+def load_back(env, name):
+	"""Load a back-end."""
+	back = common.loadModule(name, os.path.join(env["THOT_LIB"], "backs"))
+	if back == None:
+		raise Exception("cannot find %s back-end" % name)
+	return back
+
+
+def measure(env, path, backs):
+	"""Parse the document and generate it with each back-end.
+	Return the list of measures."""
+	env = dict(env)
+	env["THOT_FILE"] = path
+	env["THOT_DOC_DIR"] = os.path.dirname(path)
+	env["THOT_OUT_TYPE"] = ",".join(backs)
+	document = doc.Document(env)
+	man = tparser.Manager(document)
+
+	# parse
+	start = time.perf_counter()
+	with open(path, encoding = common.ENCODING) as input:
+		man.parse(input, path)
+	parse = time.perf_counter() - start
+
+	# record pre-generation times
+	pregens = []
+	pregen = document.pregen
+	def timed_pregen(gen):
+		start = time.perf_counter()
+		pregen(gen)
+		pregens.append(time.perf_counter() - start)
+	document.pregen = timed_pregen
+
+	# generate with each back-end
+	res = []
+	for name in backs:
+		back = load_back(env, name)
+		document.env = dict(env)
+		document.env["THOT_OUT_TYPE"] = name
+		del pregens[:]
+		error = None
+		start = time.perf_counter()
+		try:
+			with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+				back.output(document)
+		except SystemExit:
+			error = "generation failed"
+		except Exception as e:
+			error = "%s: %s" % (e.__class__.__name__, e)
+		total = time.perf_counter() - start
+		res.append({
+			"back": name,
+			"parse": parse,
+			"pregen": sum(pregens),
+			"gen": total - sum(pregens),
+			"error": error
+		})
+	return res
+
+
+def run(options):
+	"""Run the benchmark and return the results."""
+	env = command.make_env()
+	env["THOT_CACHE"] = ""
+	sizes = [parse_size(size) for size in options.sizes.split(",")]
+	syntaxes = options.syntaxes.split(",")
+	backs = options.backs.split(",")
+	for syntax in syntaxes:
+		if syntax not in SYNTAX_MAP:
+			common.onError("unknown syntax %s (one of %s)" % (syntax, ", ".join(SYNTAXES)))
+	dir = options.dir if options.dir else tempfile.mkdtemp(prefix = "thot-bench-")
+	os.makedirs(dir, exist_ok = True)
+	results = []
+	try:
+		for syntax in syntaxes:
+			for size in sizes:
+				path = make_document(dir, SYNTAX_MAP[syntax], size)
+				best = None
+				for i in range(options.repeat):
+					res = measure(env, path, backs)
+					if best == None:
+						best = res
+					else:
+						for (b, r) in zip(best, res):
+							for phase in PHASES:
+								b[phase] = min(b[phase], r[phase])
+				for r in best:
+					r["syntax"] = syntax
+					r["lines"] = size
+					results.append(r)
+					display(r)
+	finally:
+		if not options.dir and not options.keep:
+			shutil.rmtree(dir, ignore_errors = True)
+	return results
+
+
+def display(r):
+	"""Display a measure."""
+	sys.stderr.write("%-9s %5s %-8s parse %8.3fs  pregen %8.3fs  gen %8.3fs%s\n" % (
+		r["syntax"], format_size(r["lines"]), r["back"],
+		r["parse"], r["pregen"], r["gen"],
+		"" if r["error"] == None else "  [%s]" % r["error"]))
+
+
+def compare(old, results, ratio):
+	"""Compare the results with old ones. Return the list of
+	regressions as strings. Times below MIN_TIME are considered
+	as noise."""
+	index = dict([((r["syntax"], r["lines"], r["back"]), r) for r in old["results"]])
+	regs = []
+	for r in results:
+		try:
+			o = index[(r["syntax"], r["lines"], r["back"])]
+		except KeyError:
+			continue
+		for phase in PHASES:
+			if r[phase] >= MIN_TIME and r[phase] > o[phase] * ratio:
+				regs.append("%s %s %s %s: %.3fs -> %.3fs" % (
+					r["syntax"], format_size(r["lines"]), r["back"],
+					phase, o[phase], r[phase]))
+	return regs
+
+
+def main():
+	oparser = optparse.OptionParser(usage = "%prog [options]")
+	oparser.add_option("-s", "--sizes", dest = "sizes", default = "1k,10k",
+		help = "comma-separated sizes in lines (suffixes k and M supported)")
+	oparser.add_option("-x", "--syntax", dest = "syntaxes", default = ",".join(SYNTAXES),
+		help = "comma-separated syntaxes among %s" % ", ".join(SYNTAXES))
+	oparser.add_option("-t", "--type", dest = "backs", default = ",".join(BACKS),
+		help = "comma-separated back-ends")
+	oparser.add_option("-r", "--repeat", dest = "repeat", type = "int", default = 1,
+		help = "number of runs (the best time is kept)")
+	oparser.add_option("-o", "--out", dest = "out",
+		help = "JSON file to write the results to (default standard output)")
+	oparser.add_option("-c", "--compare", dest = "compare",
+		help = "JSON file of previous results to compare with")
+	oparser.add_option("--ratio", dest = "ratio", type = "float", default = 1.2,
+		help = "maximal allowed ratio between new and old times (default 1.2)")
+	oparser.add_option("-d", "--dir", dest = "dir",
+		help = "directory to generate the documents in (kept after the run)")
+	oparser.add_option("-k", "--keep", dest = "keep", action = "store_true", default = False,
+		help = "keep the generated documents")
+	(options, args) = oparser.parse_args()
+
+	results = run(options)
+	out = {
+		"version": VERSION,
+		"thot": command.make_env()["THOT_VERSION"],
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"date": str(datetime.datetime.today()),
+		"results": results
+	}
+	if options.out:
+		with open(options.out, "w", encoding = "utf-8") as file:
+			json.dump(out, file, indent = 1)
+	else:
+		json.dump(out, sys.stdout, indent = 1)
+		sys.stdout.write("\n")
+
+	if options.compare:
+		with open(options.compare, encoding = "utf-8") as file:
+			regs = compare(json.load(file), results, options.ratio)
+		for reg in regs:
+			sys.stderr.write("REGRESSION: %s\n" % reg)
+		if regs:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
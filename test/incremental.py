@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+"""Check that the incremental generation of a document loaded from its
+snapshot only generates again the page of an edited chapter."""
+
+import os
+import os.path
+import re
+import subprocess
+import sys
+import tempfile
+
+THOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "thot.py")
+
+DOC = """@use dokuwiki
+@TITLE=Incremental
+@HTML_ONE_FILE_PER=chapter
+
+====== One ======
+Text of **one**.
+
+====== Two ======
+Text of two.
+
+====== Three ======
+Text of three.
+"""
+
+GENERATED = re.compile(r"^generated (\S+-[0-9]+\.html)$", re.MULTILINE)
+
+
+def run(dir):
+	"""Generate the document and return the list of generated chapter
+	pages and if the snapshot has been loaded."""
+	ret = subprocess.run(
+		[sys.executable, THOT, "-v", "--incremental", "book.thot"],
+		cwd = dir,
+		env = dict(os.environ, THOT_CACHE = os.path.join(dir, "cache"), THOT_SNAPSHOT = "yes"),
+		stdout = subprocess.PIPE,
+		stderr = subprocess.STDOUT,
+		universal_newlines = True
+	)
+	if ret.returncode != 0:
+		sys.stderr.write(ret.stdout)
+		sys.exit(1)
+	return (sorted(GENERATED.findall(ret.stdout)), "loaded snapshot" in ret.stdout)
+
+
+def check(what, res, expected):
+	if res != expected:
+		sys.stderr.write("%s: got %s, expected %s\n" % (what, res, expected))
+		sys.exit(1)
+
+
+with tempfile.TemporaryDirectory() as dir:
+	path = os.path.join(dir, "book.thot")
+	with open(path, "w") as out:
+		out.write(DOC)
+	check("parse", run(dir), (["book-0.html", "book-1.html", "book-2.html"], False))
+	check("snapshot", run(dir), ([], True))
+	with open(path, "w") as out:
+		out.write(DOC.replace("Text of three.", "Text of three, edited."))
+	check("edit", run(dir), (["book-2.html"], False))
+	check("edited snapshot", run(dir), ([], True))
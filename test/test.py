@@ -14,12 +14,14 @@ class Test:
 			self.file = file
 		self.params = params
 
+	def command(self):
+		return "%s %s %s" % (THOT, self.file, self.params)
+
 	def process(self, dump = False):
 		sys.stderr.write("%s ....\n" % self.label)
 		sys.stderr.flush()
 		ret = subprocess.run(
-			"%s %s %s 2> %s.log" % \
-				(THOT, self.file, self.params, self.label),
+			"%s 2> %s.log" % (self.command(), self.label),
 			shell=True
 		)
 		if ret.returncode == 0:
@@ -36,6 +38,15 @@ class Test:
 					% (self.label, self.label))
 			return False
 
+class Script(Test):
+	"""Test performed by a Python script."""
+
+	def __init__(self, label, file):
+		Test.__init__(self, label, file)
+
+	def command(self):
+		return "%s %s" % (sys.executable, self.file)
+
 ALL = [
 	Test("simple-html", "simple.thot"),
 	Test("simple-latex", "simple.thot", "-t latex"),	
@@ -45,6 +56,12 @@ ALL = [
 	Test("unicode-html", "unicode.thot"),
 	Test("lexicon-html", "lexicon.thot"),
 	Test("doxygen-html", "doxygen.thot"),
+	Test("mimetex-html", "mimetex.thot"),
+	Test("latexmath-unknown-html", "latexmath-unknown.thot"),
+	Test("deep-dump", "deep.thot", "--dump"),
+	Test("deep-html", "deep.thot"),
+	Test("deep-latex", "deep.thot", "-t latex"),
+	Script("incremental-snapshot", "incremental.py"),
 #	Test("wiki", "wiki.thot", "-t wiki")
 ]
 
@@ -19,3 +19,11 @@
 In fact, Thot is able to use several wiki syntaxes (Dokuwiki, Textile,
 Markdown) and to enrich them with different extended syntaxes like
 Math Latex, GraphViz dot graphs, GnuPlot, code, etc."""
+
+
+def render(source, out_type = "html", env = None, out_path = None, uses = None):
+	"""Generate the document of the given .thot file in the current
+	process (see thot.command.render()). Errors raise
+	thot.common.ErrorException. Return the parsed document."""
+	import thot.command
+	return thot.command.render(source, out_type, env, out_path, uses)
@@ -20,15 +20,81 @@ of output files.
 The following variables are supported:
 * FRIEND_RELOC - option to handle friend files ("local" (default): relocate all except relative
   files, "all": relocate all files)
+* FRIEND_COPY - how friend files are copied ("reflink" (default): as a copy-on-write clone
+  if the file system supports it, a copy else, "hardlink": as a hard link if possible (a change
+  of the imported file changes the source), "copy": always copied)
+* THOT_JOBS - number of external commands run in parallel (default 1)
+* ENCODING - encoding of the generated files
 """
 
+import hashlib
+import os
 import os.path
 import shutil
+import stat
 import sys
 
 import thot.common as common
 import thot.doc as tdoc
 import thot.i18n as i18n
+import thot.jobs as jobs
+import thot.profile as profile
+import thot.stream as stream
+
+
+def hash_file(path):
+	"""Compute the hash of the content of a file."""
+	h = hashlib.sha256()
+	with open(path, "rb") as file:
+		for block in iter(lambda: file.read(1 << 16), b""):
+			h.update(block)
+	return h.hexdigest()
+
+
+def dedup_files(dirs, hard = False):
+	"""Replace the files of the given directories having the same content
+	by reflinks to a single file or, if hard is True, by links (see
+	common.link_file()). Files that cannot be linked are left unchanged.
+	Return the number of bytes saved."""
+	sizes = { }
+	for dir in dirs:
+		for (dpath, _, files) in os.walk(dir):
+			for file in files:
+				path = os.path.join(dpath, file)
+				try:
+					st = os.lstat(path)
+				except OSError:
+					continue
+				if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+					sizes.setdefault(st.st_size, []).append((path, st))
+	saved = 0
+	for (size, files) in sizes.items():
+		if len(files) < 2:
+			continue
+		firsts = { }
+		for (path, st) in files:
+			try:
+				h = hash_file(path)
+			except OSError:
+				continue
+			if h not in firsts:
+				firsts[h] = (path, st)
+				continue
+			(fpath, fst) = firsts[h]
+			if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+				continue
+			tmp = "%s.%d.tmp" % (path, os.getpid())
+			try:
+				if hard:
+					common.link_file(fpath, tmp)
+				else:
+					common.reflink_file(fpath, tmp)
+				os.replace(tmp, path)
+				saved += size
+			except OSError:
+				if os.path.lexists(tmp):
+					os.remove(tmp)
+	return saved
 
 
 class Generator:
@@ -40,7 +106,18 @@ class Generator:
 	out = None
 	from_files = None
 	to_files = None
+	friend_counts = None
+	friend_sizes = None
+	friend_copy = "reflink"
 	added_files = None
+	added_set = None
+	pool = None
+	jobs = None
+	friend_log = None
+	sizes = None
+	counts = None
+	states = None
+	memory = None
 
 	def __init__(self, doc):
 		"""Build the abstract generator.
@@ -49,13 +126,27 @@ class Generator:
 		self.trans = i18n.getTranslator(self.doc)
 		self.from_files = { }
 		self.to_files = { }
+		self.friend_counts = { }
+		self.friend_sizes = { }
 		self.added_files = []
+		self.added_set = set()
 		
 		# new friend system
 		self.friend_reloc = doc.getVar("FRIEND_RELOC", "local")
+		self.friend_copy = doc.getVar("FRIEND_COPY", "reflink")
 		self.friends = []
 		self.friend_map = { }
 
+		# external jobs
+		self.jobs = { }
+
+		# written files
+		self.sizes = { }
+
+		# state of the modules for this generation
+		self.counts = { }
+		self.states = { }
+
 	def getType(self):
 		"""Get type of the back-end: html, latex, xml."""
 		return None
@@ -66,7 +157,8 @@ class Generator:
 
 	def addFile(self, file):
 		"""Add a file to the list of files linked to the document."""
-		if file not in self.added_files:
+		if file not in self.added_set:
+			self.added_set.add(file)
 			self.added_files.append(file)
 
 	def friendFiles(self):
@@ -79,6 +171,11 @@ class Generator:
 		"""Get the directory containing the imports."""
 		return self.root + "-imports"
 
+	def is_imported(self, path):
+		"""Test if the path is in the import directory."""
+		dir = os.path.abspath(self.getImportDir())
+		return os.path.commonpath([os.path.abspath(path), dir]) == dir
+
 	def openMain(self, suff, out_name = None):
 		"""Create and open an out file for the given document.
 		suff -- suffix of the out file.
@@ -86,8 +183,12 @@ class Generator:
 		Set path, root and out fields."""
 
 		self.path = self.doc.getVar("THOT_OUT_PATH")
-		if self.path:
-			self.out = open(self.path, "w")
+		if self.path == stream.STDOUT:
+			self.out = self.openOutput(stream.STDOUT)
+			self.path = "stdout"
+			self.root = "stdout"
+		elif self.path:
+			self.out = self.openOutput(self.path)
 			if self.path.endswith(suff):
 				self.root = self.path[:-5]
 			else:
@@ -98,7 +199,7 @@ class Generator:
 			else:
 				in_name = self.doc.getVar("THOT_FILE")
 			if not in_name or in_name == "<stdout>":
-				self.out = sys.stdout
+				self.out = self.openOutput(stream.STDOUT)
 				self.path = "stdout"
 				self.root = "stdout"
 			else:
@@ -108,7 +209,43 @@ class Generator:
 				else:
 					self.path = in_name + suff
 					self.root = self.path
-				self.out = open(self.path, "w")
+				self.out = self.openOutput(self.path)
+
+	def closeMain(self):
+		"""Close the main out file (if not already closed)."""
+		if self.out != None and not self.out.closed:
+			self.closeOutput(self.out)
+
+	def printSuccess(self):
+		"""Display the success of the generation of the main file. If the
+		main file is the standard output, the message goes to the error
+		stream to not mix it with the generated text. Nothing is displayed
+		if the files are kept in memory."""
+		if self.memory != None:
+			return
+		elif self.path == "stdout":
+			sys.stderr.write("SUCCESS: result in %s\n" % self.path)
+		else:
+			print("SUCCESS: result in %s" % self.path)
+
+	def openOutput(self, path):
+		"""Open a buffered output stream (see stream.open_output()) to
+		write the file with the given path (stream.STDOUT for standard
+		output) with the encoding of the document. If memory is not None,
+		the text is kept in memory instead (see closeOutput())."""
+		if self.memory != None and path != stream.STDOUT:
+			return stream.open_memory(path, self.doc.getVar("ENCODING"))
+		return stream.open_output(path, self.doc.getVar("ENCODING"))
+
+	def closeOutput(self, out):
+		"""Close an output stream opened by openOutput() and record
+		the number of written bytes in sizes. For an output kept in
+		memory, its text is recorded in the memory map."""
+		if isinstance(out, stream.MemoryOutput):
+			self.memory[out.name] = out.getvalue()
+		size = stream.close_output(out)
+		self.sizes[out.name] = size
+		common.onVerbose(lambda _: "%s: %d bytes written" % (out.name, size))
 
 
 	def get_friend(self, path, base = ''):
@@ -130,41 +267,104 @@ class Generator:
 		else:
 			return None
 
-	def prepare_friend(self, path):
+	def prepare_friend(self, path, create = True):
 		"""Prepare friend file to be created (ensuring uniqueness)
-		and existence of directories (maintain the same path suffix).
-		Return the actual path."""
+		and existence of directories (maintain the same path suffix),
+		if create is True. Return the actual path."""
 		
 		# create directories
 		dpath = os.path.dirname(path)
-		if not os.path.exists(dpath):
+		if create and not os.path.exists(dpath):
 			try:
 				os.makedirs(dpath)
 			except os.error as e:
 				common.onError('cannot create directory "%s": %s' % (dpath, e))
 		
-		# ensure uniqueness
-		file, ext = os.path.splitext(path)
-		cnt = 0
-		while path in self.to_files:
-			path = "%s-%d%s" % (file, cnt, ext)
-			cnt = cnt + 1
+		# ensure uniqueness (counters are kept per path as the
+		# allocated names are never released)
+		if path in self.to_files:
+			file, ext = os.path.splitext(path)
+			cnt = self.friend_counts.get(path, 0)
+			while True:
+				npath = "%s-%d%s" % (file, cnt, ext)
+				cnt = cnt + 1
+				if npath not in self.to_files:
+					break
+			self.friend_counts[path] = cnt
+			path = npath
 		return path
 
-	def new_friend(self, path):
+	def new_friend(self, path, create = True):
 		"""Allocate a place in friend files for the given path
-		(that must be relative)."""
-		fpath = self.prepare_friend(os.path.join(self.getImportDir(), path))
+		(that must be relative). An existing file at this place, in the
+		import directory, that is hard linked to other files is removed to
+		let them unchanged. If create is False, the directories of the
+		place are not created (jobs create them when they are run)."""
+		fpath = self.prepare_friend(os.path.join(self.getImportDir(), path), create)
+		if self.is_imported(fpath):
+			try:
+				if os.lstat(fpath).st_nlink > 1:
+					os.remove(fpath)
+			except FileNotFoundError:
+				pass
+			except OSError as e:
+				common.onWarning("cannot remove %s: %s" % (fpath, e))
 		self.addFile(fpath)
 		self.to_files[fpath] = ""
+		if self.friend_log != None:
+			self.friend_log.append(("new", fpath))
 		return fpath
 
+	def find_copy(self, spath, tpath):
+		"""Look for a friend file already copied with the same content
+		and extension as spath. Return its path or None. spath is
+		recorded for the following lookups. The content is only hashed
+		when another copied file has the same size and extension."""
+		try:
+			key = (os.path.getsize(spath), os.path.splitext(tpath)[1])
+			copies = self.friend_sizes.setdefault(key, [])
+			if copies == []:
+				copies.append([spath, tpath, None])
+				return None
+			h = hash_file(spath)
+			for copy in copies:
+				if copy[2] == None:
+					copy[2] = hash_file(copy[0])
+				if copy[2] == h:
+					return copy[1]
+			copies.append([spath, tpath, h])
+		except OSError:
+			pass
+		return None
+
 	def copy_friend(self, spath, tpath):
 		"""Load a friend file in the generation location.
-		path -- relative path to write to.
-		base -- absolute file to the file to copy."""
+		If a file with the same content has already been copied,
+		its path is returned instead.
+		spath -- absolute path of the file to copy,
+		tpath -- path to write to."""
 		tpath = self.prepare_friend(tpath)
+		if self.memory != None:
+			return tpath
+		cpath = self.find_copy(spath, tpath)
+		if cpath != None:
+			common.onVerbose(lambda _: "%s: same content as %s" % (spath, cpath))
+			return cpath
 		try:
+			if os.path.exists(tpath):
+				if os.path.samefile(spath, tpath) and (self.friend_copy == "hardlink"
+				or os.path.abspath(spath) == os.path.abspath(tpath)):
+					return tpath
+				os.remove(tpath)
+			try:
+				if self.friend_copy == "hardlink":
+					common.link_file(spath, tpath)
+					return tpath
+				elif self.friend_copy != "copy":
+					common.reflink_file(spath, tpath)
+					return tpath
+			except OSError:
+				pass
 			shutil.copyfile(spath, tpath)
 			return tpath
 		except shutil.Error as e:
@@ -187,6 +387,8 @@ class Generator:
 		# already declared?
 		tpath = self.get_friend(path, base)
 		if tpath:
+			if self.friend_log != None:
+				self.friend_log.append(("use", path, base, tpath))
 			return tpath 
 
 		# make target path
@@ -214,16 +416,77 @@ class Generator:
 
 		# record all
 		self.from_files[apath] = tpath
-		self.to_files[tpath] = apath;
+		if tpath not in self.to_files:
+			self.to_files[tpath] = apath
 		self.addFile(tpath)		
+		if self.friend_log != None:
+			self.friend_log.append(("use", path, base, tpath))
 		return tpath
 
+	def new_count(self, name):
+		"""Get the next number (starting at 0) of the counter with the
+		given name. Counters are used by modules to name the files
+		they produce and are specific to the generation."""
+		n = self.counts.get(name, 0)
+		self.counts[name] = n + 1
+		return n
+
+	def get_state(self, name, make):
+		"""Get the state of a module for this generation, identified by
+		name. It is built by calling make() on the first call."""
+		try:
+			return self.states[name]
+		except KeyError:
+			state = make()
+			self.states[name] = state
+			return state
+
 	def relative_friend(self, fpath, bpath):
 		"""Get the relative path of fpath reative to bpath."""
 		r = os.path.relpath(fpath, bpath)
 		return r
 
+	def get_pool(self):
+		"""Get the pool running the jobs of external commands."""
+		if self.pool == None:
+			try:
+				size = int(self.doc.getVar("THOT_JOBS", "1"))
+			except ValueError:
+				common.onError("THOT_JOBS must be an integer")
+			self.pool = jobs.Pool(max(size, 1))
+		return self.pool
+
+	def prepare_job(self, node, submit = True):
+		"""Build the job of the given node (see doc.Node.make_job())
+		and submit it to the pool of workers. If submit is False,
+		the job is only recorded: it may be submitted later (possibly
+		as part of a batch) or it will be run when its result is required."""
+		if profile.current == None:
+			job = node.make_job(self)
+		else:
+			job = profile.current.call("pregen", "%s.make_job" % profile.class_name(node), node.make_job, self)
+		self.jobs[node] = job
+		if job != None and submit:
+			self.get_pool().submit(job)
+
+	def get_job(self, node):
+		"""Get the job of the given node, waiting for its end.
+		If the job has not been prepared, it is built and run.
+		Return None if the node has no job."""
+		try:
+			job = self.jobs[node]
+		except KeyError:
+			job = node.make_job(self)
+			self.jobs[node] = job
+		if job != None:
+			job.wait()
+		return job
+
 	def genFootNote(self, note):
+		"""Called to generate a foot note. As the other methods generating
+		nodes with sub-nodes (genTable(), genList(), genDefList()), it may
+		return an iterator on the sub-nodes to generate in turn,
+		like a Python generator yielding them (see doc.Node.iterGen())."""
 		pass
 
 	def genQuoteBegin(self, level):
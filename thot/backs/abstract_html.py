@@ -354,25 +354,27 @@ class Generator(back.Generator):
 			input = open(spath)
 		except FileNotFoundError as e:
 			raise common.BackException(str(e))
-		output = open(tpath, "w")
+		output = self.openOutput(tpath)
 		rbase = os.path.dirname(spath)
 
 		# perform the copy
-		for line in input:
-			m = CSS_URL_RE.search(line)
-			while m:
-				output.write(line[:m.start()])
-				url = m.group(1)
-				res = urlparse.urlparse(url)
-				if res[0]:
-					output.write(m.group())
-				else:
-					rpath = os.path.relpath(os.path.join(rbase, res[2]), base)
-					rpath = self.use_friend(rpath, base)
-					output.write("url(%s)" % self.relative_friend(rpath, os.path.dirname(tpath)))
-				line = line[m.end():]
+		with input:
+			for line in input:
 				m = CSS_URL_RE.search(line)
-			output.write(line)
+				while m:
+					output.write(line[:m.start()])
+					url = m.group(1)
+					res = urlparse.urlparse(url)
+					if res[0]:
+						output.write(m.group())
+					else:
+						rpath = os.path.relpath(os.path.join(rbase, res[2]), base)
+						rpath = self.use_friend(rpath, base)
+						output.write("url(%s)" % self.relative_friend(rpath, os.path.dirname(tpath)))
+					line = line[m.end():]
+					m = CSS_URL_RE.search(line)
+				output.write(line)
+		self.closeOutput(output)
 
 		# return path
 		return tpath
@@ -444,7 +446,7 @@ class Generator(back.Generator):
 				if vspan:
 					self.out.write(' rowspan="' + str(vspan) + '"')
 				self.out.write('>')
-				cell.gen(self)
+				yield cell
 				if cell.kind == doc.TAB_HEADER:
 					self.out.write('</th>\n')
 				else:
@@ -503,7 +505,7 @@ class Generator(back.Generator):
 
 		for item in list.getItems():
 			self.out.write(item_begin)
-			item.gen(self)
+			yield item
 			self.out.write(item_end + '\n')
 
 		self.out.write(list_end + '\n')
@@ -512,9 +514,9 @@ class Generator(back.Generator):
 		self.out.write("<dl>\n")
 		for item in deflist.getItems():
 			self.out.write("<dt>")
-			item.get_term().gen(self)
+			yield item.get_term()
 			self.out.write("</dt><dd>")
-			item.get_def().gen(self)
+			yield item.get_def()
 			self.out.write("</dd>")
 		self.out.write("</dl>\n")
 
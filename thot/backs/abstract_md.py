@@ -410,7 +410,7 @@ class Generator(back.Generator):
 				if vspan:
 					self.out.write(' rowspan="' + str(vspan) + '"')
 				self.out.write('>')
-				cell.gen(self)
+				yield cell
 				if cell.kind == doc.TAB_HEADER:
 					self.out.write('</th>\n')
 				else:
@@ -469,7 +469,7 @@ class Generator(back.Generator):
 
 		for item in list.getItems():
 			self.out.write(item_begin)
-			item.gen(self)
+			yield item
 			self.out.write(item_end + '')
 
 		self.out.write(list_end + '')
@@ -478,9 +478,9 @@ class Generator(back.Generator):
 		self.out.write("<dl>\n")
 		for item in deflist.getItems():
 			self.out.write("<dt>")
-			item.get_term().gen(self)
+			yield item.get_term()
 			self.out.write("</dt><dd>")
-			item.get_def().gen(self)
+			yield item.get_def()
 			self.out.write("</dd>")
 		self.out.write("</dl>\n")
 
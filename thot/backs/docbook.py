@@ -108,10 +108,10 @@ class Generator(back.Generator):
 		# generate body
 		self.doc.gen(self)
 		self.out.write('</book>\n')
+		self.closeMain()
 		
 		# run the backend
 		if self.output == 'pdf':
-			self.out.close()
 			name, ext = os.path.splitext(self.path)
 			if self.backend == 'dblatex':
 				cmd = 'dblatex %s -o %s' % (self.path, name + ".pdf")
@@ -133,12 +133,11 @@ class Generator(back.Generator):
 					shutil.move(self.path + ".pdf", name + ".pdf")
 				print("SUCCESS: result in %s" % (name + ".pdf"))
 		else:
-			print("SUCCESS: result in %s" % self.path)
+			self.printSuccess()
 
 	def genFootNote(self, note):
 		self.out.write('<footnote>')
-		for item in note.getContent():
-			item.gen(self)
+		yield from note.getContent()
 		self.out.write('</footnote>')
 
 	def genQuoteBegin(self, level):
@@ -169,7 +168,7 @@ class Generator(back.Generator):
 					self.out.write(' namest="%d" nameend="%d"' % (icol, icol + cell.get_hspan() - 1))
 				icol += cell.get_hspan()
 				self.out.write('>')
-				cell.gen(self)
+				yield cell
 				self.out.write('</entry>')
 				
 			self.out.write('</row>\n')		
@@ -203,7 +202,7 @@ class Generator(back.Generator):
 	
 		for item in list.getItems():
 			self.out.write('<listitem>')
-			item.gen(self)
+			yield item
 			self.out.write('</listitem>\n')
 
 		if list.kind == 'ul':
@@ -28,19 +28,18 @@ import thot.doc as doc
 import thot.doc as tdoc
 import thot.highlight as highlight
 import thot.i18n as i18n
+import thot.incremental as incremental
 
 from thot.backs.abstract_html import escape_cdata
 from thot.backs.abstract_html import escape_attr
 
-def makeRef(nums):
-	"""Generate a reference from an header number array."""
-	return ".".join([str(i) for i in nums])
-
 class PagePolicy:
 	"""A page policy allows to organize the generated document
 	according the preferences of the user."""
 	gen = None
 	page = None
+	state = None
+	context = None
 
 	def __init__(self, gen, page):
 		self.gen = gen
@@ -76,6 +75,30 @@ class PagePolicy:
 		"""Return the file name containing the given node."""
 		return ""
 
+	def prepare_incremental(self):
+		"""Prepare the incremental generation of pages, if enabled.
+		Must be called once references are built."""
+		self.state = incremental.get(self.gen)
+		if self.state != None:
+			fp = self.state.fingerprint()
+			fp.add(self.__class__.__name__)
+			fp.addTOC(self.gen.doc)
+			template = self.gen.doc.getVar('HTML_TEMPLATE')
+			if template:
+				fp.addFile(template)
+			self.context = fp.get()
+
+	def fingerprint(self, nodes, path = []):
+		"""Compute the fingerprint of a page containing the given nodes
+		and the titles of the given path of headers."""
+		fp = self.state.fingerprint()
+		fp.add(self.context)
+		for header in path:
+			fp.addRef(header)
+		for node in nodes:
+			fp.addNode(node)
+		return fp.get()
+
 	
 class AllInOne(PagePolicy):
 	"""Simple page policy doing nothing: only one page."""
@@ -86,39 +109,11 @@ class AllInOne(PagePolicy):
 	def genRefs(self):
 		"""Generate and return the references for the given generator."""
 		self.gen.refs = { }
-		self.makeRefs([1], { }, self.gen.doc)
-
-	def makeRefs(self, nums, others, node):
-		"""Traverse the document tree and generate references in the given map."""
-		
-		# number for header
-		num = node.numbering()
-		if num == 'header':
-			r = makeRef(nums)
-			self.gen.add_ref(node, "#%s" % r, r)
-			nums.append(1)
-			for item in node.getContent():
-				self.makeRefs(nums, others, item)
-			nums.pop()
-			nums[-1] = nums[-1] + 1
-		
-		# number for embedded
-		else:
-			
-			# set number
-			if self.gen.doc.getLabelFor(node):
-				if num:
-					if num not in others:
-						others[num] = 1
-						n = 1
-					else:
-						n = others[num] + 1
-					self.gen.add_ref(node, "#%s-%d" % (num, n), str(n))
-					others[num] = n
-		
-			# look in children
-			for item in node.getContent():
-				self.makeRefs(nums, others, item)
+		for (node, num) in self.gen.doc.getNumbers().items():
+			if num.kind == 'header':
+				self.gen.add_ref(node, "#%s" % num.number, num.number)
+			else:
+				self.gen.add_ref(node, "#%s-%s" % (num.kind, num.number), num.number)
 	
 	def gen_title(self, gen):
 		gen.genTitleText()
@@ -148,7 +143,12 @@ class PerSection(PagePolicy):
 	def genRefs(self):
 		"""Generate and return the references for the given generator."""
 		self.gen.refs = { }
-		self.makeRefs([1], { }, self.gen.doc, -1)
+		for (node, num) in self.gen.doc.getNumbers().items():
+			page = self.page_name(num.section)
+			if num.kind == 'header':
+				self.gen.add_ref(node, page, num.number)
+			else:
+				self.gen.add_ref(node, "%s#%s-%s" % (page, num.kind, num.number), num.number)
 
 	def page_name(self, page):
 		"""Compute the page name."""
@@ -157,47 +157,27 @@ class PerSection(PagePolicy):
 		else:
 			return "%s-%d.html" % (self.gen.root, page)
 
-	def makeRefs(self, nums, others, node, page):
-		"""Traverse the document tree and generate references in the given map."""
-		
-		# number for header
-		num = node.numbering()
-		if num == 'header':
-			page = page + 1
-			self.gen.add_ref(node, self.page_name(page), makeRef(nums))
-			nums.append(1)
-			for item in node.getContent():
-				page = self.makeRefs(nums, others, item, page)
-			nums.pop()
-			nums[-1] = nums[-1] + 1
-		
-		# number for embedded
-		else:
-			
-			# set number
-			if num and self.gen.doc.getLabelFor(node):
-				if num not in others.has_key:
-					others[num] = 1
-					n = 1
-				else:
-					n = others[num] + 1
-				r = str(n)
-				self.gen.add_ref(node, "%s#%s-%s" % (self.page_name(page), num, r), r)
-				others[num] = n
-		
-			# look in children
-			for item in node.getContent():
-				page = self.makeRefs(nums, others, item, page)
-
-		return page
-
 	def process(self, header):
 
 		# generate the page
-		self.gen.openPage(header)
+		page = self.gen.getPage(header)
 		self.path = self.path + [header]
-		self.page.apply(self, self.gen)
-		print("generated %s" % (self.gen.getPage(header)))
+		fp = None
+		if self.state != None:
+			fp = self.fingerprint(
+				[c for c in header.getContent() if c.getHeaderLevel() < 0],
+				self.path)
+		if fp != None and self.state.is_unchanged(page, fp):
+			print("unchanged %s" % page)
+		else:
+			if fp != None:
+				self.state.begin()
+			self.gen.openPage(header)
+			self.page.apply(self, self.gen)
+			self.gen.closePage()
+			if fp != None:
+				self.state.end(page, fp)
+			print("generated %s" % page)
 		
 		# generate the su-headers
 		for child in header.getContent():
@@ -243,9 +223,12 @@ class PerSection(PagePolicy):
 		print("generated %s" % self.gen.path)
 
 		# generate chapter pages
+		self.prepare_incremental()
 		for node in self.gen.doc.getContent():
 			if node.getHeaderLevel() == 0:
 				self.process(node)
+		if self.state != None:
+			self.state.save()
 
 
 class PerChapter(PagePolicy):
@@ -258,43 +241,17 @@ class PerChapter(PagePolicy):
 	def genRefs(self):
 		"""Generate and return the references for the given generator."""
 		self.gen.refs = { }
-		self.makeRefs([1], { }, self.gen.doc, self.gen.root + ".html")
-
-	def makeRefs(self, nums, others, node, page):
-		"""Traverse the document tree and generate references in the given map."""
-		
-		# number for header
-		num = node.numbering()
-		if num == 'header':
-			if node.header_level == 0:
-				page = "%s-%d.html" % (self.gen.root, nums[0] - 1)
-				self.gen.add_ref(node, page, str(nums[0]))
+		for (node, num) in self.gen.doc.getNumbers().items():
+			if num.chapter == None:
+				page = self.gen.root + ".html"
 			else:
-				r = makeRef(nums)
-				self.gen.add_ref(node, "%s#%s" % (page, r), r)
-			nums.append(1)
-			for item in node.getContent():
-				self.makeRefs(nums, others, item, page)
-			nums.pop()
-			nums[-1] = nums[-1] + 1
-		
-		# number for embedded
-		else:
-			
-			# set number
-			if num and self.gen.doc.getLabelFor(node):
-				if num not in others:
-					others[num] = 1
-					n = 1
-				else:
-					n = others[num] + 1
-				r = str(n)
-				self.gen.add_ref(node, "%s#%s-%s" % (page, num, r), r)
-				others[num] = n
-		
-			# look in children
-			for item in node.getContent():
-				self.makeRefs(nums, others, item, page)
+				page = "%s-%d.html" % (self.gen.root, num.chapter)
+			if num.kind != 'header':
+				self.gen.add_ref(node, "%s#%s-%s" % (page, num.kind, num.number), num.number)
+			elif node.getHeaderLevel() == 0:
+				self.gen.add_ref(node, page, num.number.split(".")[0])
+			else:
+				self.gen.add_ref(node, "%s#%s" % (page, num.number), num.number)
 	
 	def gen_title(self, gen):
 		gen.genTitleText()
@@ -330,12 +287,26 @@ class PerChapter(PagePolicy):
 		print("generated %s" % self.gen.path)
 
 		# generate chapter pages
+		self.prepare_incremental()
 		for node in chapters:
+			page = self.gen.getPage(node)
+			fp = None
+			if self.state != None:
+				fp = self.fingerprint([node])
+			if fp != None and self.state.is_unchanged(page, fp):
+				print("unchanged %s" % page)
+				continue
+			if fp != None:
+				self.state.begin()
 			self.gen.openPage(node)
 			self.node = node
 			self.page.apply(self, self.gen)
 			self.gen.closePage()
-			print("generated %s" % (self.gen.getPage(node)))
+			if fp != None:
+				self.state.end(page, fp)
+			print("generated %s" % page)
+		if self.state != None:
+			self.state.save()
 
 
 class Generator(abstract_html.Generator):
@@ -385,21 +356,37 @@ class Generator(abstract_html.Generator):
 		self.out.write('</a>\n')
 
 	def expandContent(self, node, level, indent):
-		"""Expand recursively the content and to the given level."""
-		if node.getHeaderLevel() >= level:
-			return
-		one = False
-		for child in node.getContent():
-			if child.getHeaderLevel() >= 0:
-				if not one:
-					one = True
-					self.out.write('%s<ul class="toc">\n' % indent)
-				self.out.write("%s<li>\n" % indent)
-				self.genContentEntry(child, indent)
-				self.expandContent(child, level, indent + "  ")
-				self.out.write("%s</li>\n" % indent)
-		if one:
-			self.out.write('%s</ul>\n' % indent)
+		"""Expand the content below node to the given level."""
+		lists = []		# pairs [indent, open] of the expanded nodes
+
+		def enter(child):
+			if child is node:
+				if node.getHeaderLevel() >= level:
+					return False
+				lists.append([indent, False])
+				return True
+			elif child.getHeaderLevel() < 0:
+				return False
+			cindent = lists[-1][0]
+			if not lists[-1][1]:
+				lists[-1][1] = True
+				self.out.write('%s<ul class="toc">\n' % cindent)
+			self.out.write("%s<li>\n" % cindent)
+			self.genContentEntry(child, cindent)
+			if child.getHeaderLevel() >= level:
+				self.out.write("%s</li>\n" % cindent)
+				return False
+			lists.append([cindent + "  ", False])
+			return True
+
+		def leave(child):
+			(cindent, open) = lists.pop()
+			if open:
+				self.out.write('%s</ul>\n' % cindent)
+			if child is not node:
+				self.out.write("%s</li>\n" % lists[-1][0])
+
+		doc.walk(node, enter, leave)
 
 	def expandContentTo(self, node, path, level, indent):
 		"""Expand, not recursively, the content until reaching the end of the path.
@@ -439,11 +426,11 @@ class Generator(abstract_html.Generator):
 	def openPage(self, header):
 		path = self.getPage(header)
 		self.stack.append((self.out, self.footnotes))
-		self.out = open(path, 'w')
+		self.out = self.openOutput(path)
 		self.footnotes = []
 
 	def closePage(self):
-		self.out.close()
+		self.closeOutput(self.out)
 		self.out, self.footnotes = self.stack.pop()
 
 	def run(self):
@@ -462,7 +449,8 @@ class Generator(abstract_html.Generator):
 
 		# generate the document
 		policy.run()
-		print("SUCCESS: result in %s" % self.path)
+		self.closeMain()
+		self.printSuccess()
 
 
 def output(doc):
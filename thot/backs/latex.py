@@ -287,12 +287,12 @@ class Generator(back.Generator):
 
 		# write footer
 		self.out.write('\\end{document}\n')
-		self.out.close()
+		self.closeMain()
 
 		# generate final format
 		output = self.doc.getVar('OUTPUT')
 		if not output or output == 'latex':
-			print("SUCCESS: result in %s" % self.path)
+			self.printSuccess()
 		elif output == 'pdf':
 
 			# perform compilation
@@ -327,8 +327,7 @@ class Generator(back.Generator):
 
 	def genFootNote(self, note):
 		self.out.write('\\footnote{')
-		for item in note.getContent():
-			item.gen(self)
+		yield from note.getContent()
 		self.out.write('}')
 
 	def genQuoteBegin(self, level):
@@ -392,7 +391,7 @@ class Generator(back.Generator):
 				if cell.kind == doc.TAB_HEADER:
 					self.out.write('\\bf{')
 
-				cell.gen(self)
+				yield cell
 
 				if cell.kind == doc.TAB_HEADER:
 					self.out.write('}')
@@ -439,7 +438,7 @@ class Generator(back.Generator):
 
 		for item in list.getItems():
 			self.out.write('\\item ')
-			item.gen(self)
+			yield item
 
 		if list.kind == 'ul':
 			self.out.write('\\end{itemize}\n')
@@ -450,10 +449,9 @@ class Generator(back.Generator):
 		self.out.write("\\begin{itemize}\n")
 		for item in deflist.getItems():
 			self.out.write("\item[")
-			for text in item.get_term().getContent():
-				text.gen(self)
+			yield from item.get_term().getContent()
 			self.out.write("] ")
-			item.get_def().gen(self)
+			yield item.get_def()
 		self.out.write("\\end{itemize}\n")
 
 
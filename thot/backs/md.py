@@ -31,10 +31,6 @@ import thot.i18n as i18n
 from thot.backs.abstract_md import escape_cdata
 from thot.backs.abstract_md import escape_attr
 
-def makeRef(nums):
-	"""Generate a reference from an header number array."""
-	return ".".join([str(i) for i in nums])
-
 class PagePolicy:
 	"""A page policy allows to organize the generated document
 	according the preferences of the user."""
@@ -74,37 +70,11 @@ class AllInOne(PagePolicy):
 	def genRefs(self):
 		"""Generate and return the references for the given generator."""
 		self.gen.refs = { }
-		self.makeRefs([1], { }, self.gen.doc)
-
-	def makeRefs(self, nums, others, node):
-		"""Traverse the document tree and generate references in the given map."""
-		
-		# number for header
-		num = node.numbering()
-		if num == 'header':
-			r = makeRef(nums)
-			self.gen.add_ref(node, "#%s" % r, r)
-			nums.append(1)
-			for item in node.getContent():
-				self.makeRefs(nums, others, item)
-			nums.pop()
-			nums[-1] = nums[-1] + 1
-		# number for embedded
-		else:
-			# set number
-			if self.gen.doc.getLabelFor(node):
-				if num:
-					if num not in others:
-						others[num] = 1
-						n = 1
-					else:
-						n = others[num] + 1
-					self.gen.add_ref(node, "#%s-%d" % (num, n), str(n))
-					others[num] = n
-		
-			# look in children
-			for item in node.getContent():
-				self.makeRefs(nums, others, item)
+		for (node, num) in self.gen.doc.getNumbers().items():
+			if num.kind == 'header':
+				self.gen.add_ref(node, "#%s" % num.number, num.number)
+			else:
+				self.gen.add_ref(node, "#%s-%s" % (num.kind, num.number), num.number)
 	
 	def gen_title(self, gen):
 		gen.genTitleText()
@@ -169,21 +139,37 @@ class Generator(abstract_md.Generator):
 		self.out.write('</a>\n')
 
 	def expandContent(self, node, level, indent):
-		"""Expand recursively the content and to the given level."""
-		if node.getHeaderLevel() >= level:
-			return
-		one = False
-		for child in node.getContent():
-			if child.getHeaderLevel() >= 0:
-				if not one:
-					one = True
-					self.out.write('%s<ul class="toc">\n' % indent)
-				self.out.write("%s<li>\n" % indent)
-				self.genContentEntry(child, indent)
-				self.expandContent(child, level, indent + "  ")
-				self.out.write("%s</li>\n" % indent)
-		if one:
-			self.out.write('%s</ul>\n' % indent)
+		"""Expand the content below node to the given level."""
+		lists = []		# pairs [indent, open] of the expanded nodes
+
+		def enter(child):
+			if child is node:
+				if node.getHeaderLevel() >= level:
+					return False
+				lists.append([indent, False])
+				return True
+			elif child.getHeaderLevel() < 0:
+				return False
+			cindent = lists[-1][0]
+			if not lists[-1][1]:
+				lists[-1][1] = True
+				self.out.write('%s<ul class="toc">\n' % cindent)
+			self.out.write("%s<li>\n" % cindent)
+			self.genContentEntry(child, cindent)
+			if child.getHeaderLevel() >= level:
+				self.out.write("%s</li>\n" % cindent)
+				return False
+			lists.append([cindent + "  ", False])
+			return True
+
+		def leave(child):
+			(cindent, open) = lists.pop()
+			if open:
+				self.out.write('%s</ul>\n' % cindent)
+			if child is not node:
+				self.out.write("%s</li>\n" % lists[-1][0])
+
+		doc.walk(node, enter, leave)
 
 	def expandContentTo(self, node, path, level, indent):
 		"""Expand, not recursively, the content until reaching the end of the path.
@@ -223,11 +209,11 @@ class Generator(abstract_md.Generator):
 	def openPage(self, header):
 		path = self.getPage(header)
 		self.stack.append((self.out, self.footnotes))
-		self.out = open(path, 'w')
+		self.out = self.openOutput(path)
 		self.footnotes = []
 
 	def closePage(self):
-		self.out.close()
+		self.closeOutput(self.out)
 		self.out, self.footnotes = self.stack.pop()
 
 	def run(self):
@@ -237,7 +223,8 @@ class Generator(abstract_md.Generator):
 		policy = AllInOne(self, template)
 		# generate the document
 		policy.run()
-		print("SUCCESS: result in %s" % self.path)
+		self.closeMain()
+		self.printSuccess()
 
 
 def output(doc):
@@ -173,6 +173,7 @@ class Generator(abstract_html.Generator):
 			env["IF_ORG_LOGO"] = self.gen_org_logo
 			templater = Templater(env)
 			templater.gen(tpath, self.out)
+			self.closeMain()
 
 		except IOError as e:
 			common.onError("error during generation: %s" % e)
@@ -348,7 +349,7 @@ class Generator(abstract_html.Generator):
 	def genList(self, list, attrs = ""):
 		if self.inc:
 			attrs = attrs + ' class="incremental"'
-		backs.abstract_html.Generator.genList(self, list, attrs)
+		return backs.abstract_html.Generator.genList(self, list, attrs)
 
 
 def handle_slide(man, match):
@@ -0,0 +1,243 @@
+# cache -- Thot cache of external tool results
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content-addressed cache for the files produced by external tools
+(dot, gnuplot, PlantUML, ditaa, aafig, mimetex, etc).
+
+A cache entry is identified by a key computed from the tool version,
+the options and the text passed to the tool, and the content of the
+files named in this text (data files of gnuplot, included files of
+PlantUML, images of dot, etc). When an entry exists,
+the stored file is linked (or copied) in place of the file that should
+have been produced by the tool. Small texts computed from the tools
+(like list of supported languages) may also be recorded.
+
+The following variables are supported:
+* THOT_CACHE -- directory containing the cache (empty to disable it).
+"""
+
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import tempfile
+
+import thot.common as common
+
+VERSION = "1"
+
+versions = { }
+caches = { }
+hashes = { }
+
+# quoted strings and words that may name a file
+FILE_RE = re.compile(r""""([^"\n]+)"|'([^'\n]+)'|([^\s"'<>()\[\]{},;=]+)""")
+
+
+def tool_version(cmd):
+	"""Compute a version identifier for the given command line. As
+	tools do not provide a common way to get their version, the
+	identifier is made of the path, the size and the modification date
+	of each file involved in the command (executable, .jar, etc).
+	Therefore, any update of the tool invalidates the cache entries."""
+	try:
+		return versions[cmd]
+	except KeyError:
+		ids = []
+		for word in cmd.split():
+			word = word.strip("'\"")
+			if os.path.sep in word:
+				path = word
+			else:
+				path = common.which(word)
+			if path and os.path.isfile(path):
+				st = os.stat(path)
+				ids.append("%s:%d:%d" % (os.path.abspath(path), st.st_size, st.st_mtime))
+			else:
+				ids.append(word)
+		versions[cmd] = " ".join(ids)
+		return versions[cmd]
+
+
+def hash_file(path):
+	"""Compute the hash of the content of a file. Return None if the
+	file cannot be read."""
+	try:
+		st = os.stat(path)
+		id = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+		return hashes[id]
+	except OSError:
+		return None
+	except KeyError:
+		h = hashlib.sha256()
+		try:
+			with open(path, "rb") as file:
+				for block in iter(lambda: file.read(1 << 16), b""):
+					h.update(block)
+		except OSError:
+			return None
+		hashes[id] = h.hexdigest()
+		return hashes[id]
+
+
+def input_files(text):
+	"""Find the files an external tool may read from its text: the
+	quoted strings and the words (containing a dot or a slash) naming
+	an existing file, relative to the current directory where the tools
+	run. Return the list of "path:hash" items."""
+	items = []
+	done = set()
+	for match in FILE_RE.finditer(text):
+		path = match.group(1) or match.group(2)
+		if path == None:
+			path = match.group(3)
+			if "." not in path and "/" not in path:
+				continue
+		if path in done:
+			continue
+		done.add(path)
+		if os.path.isfile(path):
+			items.append("%s:%s" % (path, hash_file(path)))
+	return items
+
+
+class NullCache:
+	"""Cache used when caching is disabled: it never contains anything."""
+
+	def make_key(self, cmds, *items, inputs = None):
+		return None
+
+	def fetch(self, key, ext, tpath):
+		return False
+
+	def store(self, key, ext, spath):
+		pass
+
+	def load(self, key, ext):
+		return None
+
+	def save(self, key, ext, text):
+		pass
+
+
+class Cache(NullCache):
+	"""Cache stored in a directory of the file system."""
+	path = None
+
+	def __init__(self, path):
+		self.path = path
+
+	def make_key(self, cmds, *items, inputs = None):
+		"""Build a key for the given command (or list of alternative
+		commands) and the given items (options, text, etc). If inputs
+		is given, the content of the files it names is also part of
+		the key (see input_files())."""
+		if isinstance(cmds, str):
+			cmds = [cmds]
+		h = hashlib.sha256()
+		h.update(VERSION.encode("utf-8"))
+		for cmd in cmds:
+			h.update(b"\0")
+			h.update(tool_version(cmd).encode("utf-8"))
+		if inputs != None:
+			items = items + tuple(input_files(inputs))
+		for item in items:
+			h.update(b"\0")
+			h.update(str(item).encode("utf-8"))
+		return h.hexdigest()
+
+	def get_path(self, key, ext):
+		"""Get the path of the entry in the cache."""
+		return os.path.join(self.path, key[:2], key + ext)
+
+	def fetch(self, key, ext, tpath):
+		"""Look for an entry and, if found, make it available in tpath.
+		Return True if the entry has been found, False else.
+		In both cases, any existing file tpath is removed to prevent
+		the tool to overwrite a file shared with the cache."""
+		if os.path.lexists(tpath):
+			os.remove(tpath)
+		path = self.get_path(key, ext)
+		if not os.path.exists(path):
+			return False
+		try:
+			if os.path.dirname(tpath):
+				os.makedirs(os.path.dirname(tpath), exist_ok = True)
+			common.copy_file(path, tpath)
+			return True
+		except OSError as e:
+			common.onWarning("cannot get %s from cache: %s" % (tpath, e))
+			return False
+
+	def store(self, key, ext, spath):
+		"""Record in the cache the file spath produced by a tool."""
+		if not os.path.exists(spath):
+			return
+		path = self.get_path(key, ext)
+		dpath = os.path.dirname(path)
+		try:
+			os.makedirs(dpath, exist_ok = True)
+			fd, tmp = tempfile.mkstemp(dir = dpath)
+			os.close(fd)
+			shutil.copyfile(spath, tmp)
+			os.replace(tmp, path)
+		except OSError as e:
+			common.onWarning("cannot store %s in cache: %s" % (spath, e))
+
+	def load(self, key, ext):
+		"""Get the text recorded for the given key.
+		Return None if there is no entry."""
+		try:
+			with open(self.get_path(key, ext), encoding = "utf-8") as file:
+				return file.read()
+		except OSError:
+			return None
+
+	def save(self, key, ext, text):
+		"""Record a text (list of languages, etc) in the cache."""
+		path = self.get_path(key, ext)
+		dpath = os.path.dirname(path)
+		try:
+			os.makedirs(dpath, exist_ok = True)
+			fd, tmp = tempfile.mkstemp(dir = dpath)
+			with os.fdopen(fd, "w", encoding = "utf-8") as file:
+				file.write(text)
+			os.replace(tmp, path)
+		except OSError as e:
+			common.onWarning("cannot store %s in cache: %s" % (path, e))
+
+
+NULL_CACHE = NullCache()
+
+def get(doc):
+	"""Get the cache for the given document."""
+	path = doc.getVar("THOT_CACHE")
+	if not path:
+		return NULL_CACHE
+	try:
+		return caches[path]
+	except KeyError:
+		caches[path] = Cache(path)
+		return caches[path]
+
+
+def default_path():
+	"""Compute the default path of the cache."""
+	base = os.getenv("XDG_CACHE_HOME")
+	if not base:
+		base = os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "thot")
@@ -17,18 +17,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
 import datetime
 import glob
 import locale
+import multiprocessing
 import optparse
 import os
 import os.path
+import queue
 import re
 import sys
+import time
+import traceback
 
 import thot
+import thot.back as back
+import thot.cache as cache
 import thot.common as common
 import thot.doc as doc
+import thot.modindex as modindex
+import thot.profile as profile
+import thot.snapshot as snapshot
 import thot.tparser as tparser
 
 
@@ -42,72 +52,62 @@ def make_env():
 	env["THOT_BASE"] = os.path.join(thot_dir, "data", "")
 	env["THOT_USE_PATH"] = os.path.join(thot_dir, "mods", "")
 	env["THOT_DATE"] = str(datetime.datetime.today())
+	if "THOT_CACHE" not in env:
+		env["THOT_CACHE"] = cache.default_path()
 	return env
 
 
 def list_avail_modules(document):
 	"""List available modules."""
 	print("Available modules:")
-	paths = document.getVar("THOT_USE_PATH")
-	names = set([os.path.splitext(file)[0]
-		for path in paths.split(":") for file in os.listdir(path)
-			if os.path.splitext(file)[1] in { ".py" } and not file.startswith("__")])
-	for name in names:
-		mod = common.loadModule(name, paths)
+	for entry in modindex.get_entries(document, document.getVar("THOT_USE_PATH")):
 		desc = ""
-		if "__short__" in mod.__dict__:
-			desc = " (%s)" % mod.__short__
-		print("- %s%s" % (name, desc))
+		if entry.get("short"):
+			desc = " (%s)" % entry["short"]
+		print("- %s%s" % (entry["name"], desc))
 
 	print("\nAvailable back-ends:")
 	path = os.path.join(document.env["THOT_LIB"], "backs")
-	names = set([os.path.splitext(file)[0]
-		for file in os.listdir(path)
-			if os.path.splitext(file)[1] in { ".py" }
-			and not file.startswith("__")])
-	for name in names:
-		mod = common.loadModule(name, path)
+	for entry in modindex.get_entries(document, path):
 		desc = ""
-		if "__short__" in mod.__dict__:
-			desc = " (%s)" % mod.__short__
-		print("- %s%s" % (name, desc))
+		if entry.get("short"):
+			desc = " (%s)" % entry["short"]
+		print("- %s%s" % (entry["name"], desc))
 
 
 def list_module(document, name):
 	""""List the content of a particular module."""
 	paths = document.getVar("THOT_USE_PATH") + ":" + os.path.join(document.env["THOT_LIB"], "backs")
-	mod = common.loadModule(name, paths)
-	if not mod:
-		common.onError("no module named %s" % options.list_mod)
-		sys.exit(1)
+	entry = modindex.find(document, name, paths)
+	if entry != None and not entry["complete"]:
+		mod = common.loadModule(name, paths)
+		if mod:
+			entry = modindex.describe(mod)
+	if entry == None:
+		common.onError("no module named %s" % name)
 	short = ""
-	if "__short__" in mod.__dict__:
-		short = " (%s)" % mod.__short__
+	if entry["short"]:
+		short = " (%s)" % entry["short"]
 	print("Module: %s%s" % (name, short))
-	if "__description__" in mod.__dict__:
-		print("\n%s" % mod.__description__)
+	if entry["description"]:
+		print("\n%s" % entry["description"])
 	syn = []
-	if "__words__" in mod.__dict__:
-		for (_, word, desc) in mod.__words__:
-			syn.append((common.prepare_syntax(word), desc))
-	if "__lines__" in mod.__dict__:
-		for (_, line, desc) in mod.__lines__:
-			syn.append((common.prepare_syntax(line), desc))
-	if "__syntaxes__" in mod.__dict__:
-		for m in mod.__syntaxes__:
-			syn = syn + m.get_doc()
+	for (word, desc) in entry["words"]:
+		syn.append((common.prepare_syntax(word), desc))
+	for (line, desc) in entry["lines"]:
+		syn.append((common.prepare_syntax(line), desc))
+	syn = syn + entry.get("syntaxes", [])
 	if syn != []:
 		print("Syntax:")
 		common.display_syntax(syn)
 	has_output = False
 	for out in ["html", "latex", "docbook"]:
-		name = "__%s__" % out
-		if name in mod.__dict__:
+		if out in entry["outputs"]:
 			if not has_output:
 				has_output = True
 				print("\nOutput:")
 			print("\t%s:" % out)
-			for (form, desc) in mod.__dict__[name]:
+			for (form, desc) in entry["outputs"][out]:
 				print("\t%s\n\t\t%s" % (form, desc))
 
 
@@ -131,7 +131,7 @@ def list_output(man, output):
 	"""List possible outputs."""
 	print("Available outputs:")
 	for mod in man.used_mods:
-		print("- %s" % mod.__name__)
+		print("- %s" % common.module_name(mod))
 		name = "__%s__" % output
 		if name in mod.__dict__:
 			for (form, desc) in mod.__dict__[name]:
@@ -145,17 +145,256 @@ def list_used_modules(man):
 		desc = ""
 		if "__short__" in mod.__dict__:
 			desc = " (%s)" % mod.__short__
-		print("- %s%s" % (mod.__name__, desc))
+		print("- %s%s" % (common.module_name(mod), desc))
 
 
-def main():
-	"""Command line entry point."""
-	env = make_env()
-	
-	# Prepare arguments
+def get_parser_state(man):
+	"""Get the state of the parser of a manager (used to detect
+	back-ends changing the parser)."""
+	return (man.parser, man.factory, list(man.lines), list(man.words),
+		list(man.added_lines), list(man.added_words), list(man.used_mods))
+
+
+def changes_parser(out_driver, env):
+	"""Test if the initialization of the given back-end changes
+	the parser."""
+	if "init" not in out_driver.__dict__:
+		return False
+	man = tparser.Manager(doc.Document(dict(env)))
+	state = get_parser_state(man)
+	out_driver.init(man)
+	return get_parser_state(man) != state
+
+
+def group_outputs(env, out_drivers):
+	"""Group the back-ends, as pairs (name, module), that can be
+	generated from the same parsing. A back-end whose initialization
+	changes the parser requires its own parsing."""
+	if len(out_drivers) == 1:
+		return [out_drivers]
+	shared = []
+	groups = []
+	for (name, out_driver) in out_drivers:
+		if changes_parser(out_driver, env):
+			common.onWarning("back-end %s changes the parser: the document is parsed again for it" % name)
+			groups.append([(name, out_driver)])
+		else:
+			shared.append((name, out_driver))
+	if shared:
+		groups.insert(0, shared)
+	return groups
+
+
+def make_manager(env, out_drivers):
+	"""Build the manager to parse the document for the given back-ends."""
+	env = dict(env)
+	env["THOT_OUT_TYPE"] = ",".join([name for (name, _) in out_drivers])
+	return tparser.Manager(doc.Document(env))
+
+
+def output(document, out_driver):
+	"""Generate the document with the given back-end."""
+	try:
+		if profile.current == None:
+			out_driver.output(document)
+		else:
+			for val in list(out_driver.__dict__.values()):
+				if isinstance(val, type) and issubclass(val, back.Generator):
+					profile.instrument(val)
+			profile.current.call("phase", "output %s" % common.module_name(out_driver),
+				out_driver.output, document)
+	except common.BackException as e:
+		common.onError(str(e))
+
+
+def output_child(document, out_driver, conn):
+	"""Generate the document in a child process. If profiling is
+	enabled, the measures are sent back with the connection conn."""
+	if conn != None:
+		profile.current.reset()
+	try:
+		output(document, out_driver)
+	except common.ErrorException as e:
+		common.report_error(e)
+		sys.exit(1)
+	finally:
+		if conn != None:
+			conn.send(profile.current.export())
+			conn.close()
+
+
+def join_child(proc, conn, failed):
+	"""Wait for the end of a child process generating the document
+	and, if profiling is enabled, merge its measures."""
+	if conn != None:
+		try:
+			profile.current.merge(conn.recv())
+		except EOFError:
+			pass
+		conn.close()
+	proc.join()
+	if proc.exitcode != 0:
+		failed.append(proc.name)
+
+
+def output_all(document, out_drivers):
+	"""Generate the document with each back-end of the list of pairs
+	(name, module). When possible, each generation is run in its own
+	process so that it starts from the state of the parsing: the
+	generations are run one after the other or, if THOT_JOBS > 1,
+	in parallel. Else they are run one after the other in the current
+	process, each one starting with the variables as they are after
+	the parsing."""
+	if len(out_drivers) == 1:
+		output(document, out_drivers[0][1])
+		return
+	env = document.env
+	try:
+		size = int(document.getVar("THOT_JOBS", "1"))
+	except ValueError:
+		size = 1
+
+	# generate one after the other in the current process
+	if "fork" not in multiprocessing.get_all_start_methods():
+		for (name, out_driver) in out_drivers:
+			document.env = dict(env)
+			document.setVar("THOT_OUT_TYPE", name)
+			output(document, out_driver)
+		document.env = env
+		return
+
+	# generate in child processes
+	size = max(size, 1)
+	context = multiprocessing.get_context("fork")
+	running = []
+	failed = []
+	for (name, out_driver) in out_drivers:
+		if len(running) >= size:
+			join_child(*running.pop(0), failed)
+		document.env = dict(env)
+		document.setVar("THOT_OUT_TYPE", name)
+		sys.stdout.flush()
+		conn = None
+		child_conn = None
+		if profile.current != None:
+			(conn, child_conn) = context.Pipe(False)
+		proc = context.Process(target = output_child,
+			args = (document, out_driver, child_conn), name = name)
+		proc.start()
+		if child_conn != None:
+			child_conn.close()
+		running.append((proc, conn))
+	document.env = env
+	for (proc, conn) in running:
+		join_child(proc, conn, failed)
+	if failed:
+		common.onError("generation failed for %s" % ", ".join(failed))
+
+
+def init(man, out_drivers, uses):
+	"""Initialize the manager with the back-ends and the used modules."""
+	for out_driver in out_drivers:
+		if "init" in out_driver.__dict__:
+			out_driver.init(man)
+	if uses:
+		for u in uses:
+			man.use(u)
+
+
+def parse(man, out_drivers, options, input):
+	"""Parse the input with the given manager for the back-ends of the
+	list of pairs (name, module), or load its snapshot if it is still
+	valid. Return the parsed document."""
+	document = man.get_doc()
+	modules = [out_driver for (_, out_driver) in out_drivers]
+	snap = snapshot.Snapshot(man, modules, options.uses)
+	if not profile.call("phase", "snapshot", snap.load,
+	lambda: tparser.Manager(doc.Document(dict(document.env))), modules):
+		snap.start()
+		profile.call("phase", "init", init, man, modules, options.uses)
+		profile.call("phase", "parse", man.parse, input, document.env['THOT_FILE'])
+		if len(out_drivers) > 1 and "THOT_OUT_TYPE" in document.used_vars:
+			common.onWarning("THOT_OUT_TYPE is used by the document but it is parsed once for %s" % document.env["THOT_OUT_TYPE"])
+		snap.save()
+	return document
+
+
+def process(man, out_drivers, options, input):
+	"""Parse the input with the given manager and perform the action
+	selected by the options (generation, dump, listing) for the back-ends
+	of the list of pairs (name, module)."""
+	document = parse(man, out_drivers, options, input)
+
+	# dump the parsed document
+	if options.dump:
+		document.dump("")
+
+	# list the syntax
+	elif options.list_syntax:
+		list_syntax(man)
+		print("Available syntax:")
+
+	# list outputs
+	elif options.list_output:
+		list_output(man, options.list_output)
+
+	# list the involved modules
+	elif options.list_mods:
+		list_used_modules(man)
+
+	# Output the result
+	else:
+		output_all(document, out_drivers)
+
+
+def get_stamps(files):
+	"""Get the modification times of the given files."""
+	stamps = { }
+	for file in files:
+		try:
+			stamps[file] = os.stat(file).st_mtime
+		except OSError:
+			stamps[file] = None
+	return stamps
+
+
+WATCH_PERIOD = .5
+
+def watch(env, groups, options):
+	"""Generate the document, then generate it again each time
+	the main file or one of its included files changes. Modules
+	and variables defined on the command line stay loaded."""
+	files = [env["THOT_FILE"]]
+	try:
+		while True:
+			parsed = []
+			for group in groups:
+				man = make_manager(env, group)
+				try:
+					with open(env["THOT_FILE"], encoding = common.ENCODING) as input:
+						process(man, group, options, input)
+				except common.ErrorException as e:
+					common.report_error(e)
+				except SystemExit:
+					pass
+				except Exception:
+					traceback.print_exc()
+				parsed = parsed + [file for file in man.files if file not in parsed]
+			if parsed:
+				files = parsed
+			stamps = get_stamps(files)
+			common.onInfo("watching %d file(s) for changes (Ctrl-C to stop)" % len(files))
+			while get_stamps(files) == stamps:
+				time.sleep(WATCH_PERIOD)
+	except KeyboardInterrupt:
+		pass
+
+
+def make_option_parser():
+	"""Build the parser of the command line options."""
 	oparser = optparse.OptionParser()
 	oparser.add_option("-t", "--type", action="store", dest="out_type",
-		default="html", help="output type (xml, html, latex, ...)")
+		default="html", help="output type (xml, html, latex, ...) or comma-separated list of output types")
 	oparser.add_option("-o", "--out", action="store", dest="out_path",
 		help="output path")
 	oparser.add_option("-D", "--define", action="append", dest="defines",
@@ -178,27 +417,261 @@ def main():
 		help="list the content of a module")
 	oparser.add_option("--list-avail", dest = "list_avail", action="store_true", default=False,
 		help="list available modules")
+	oparser.add_option("-j", "--jobs", action="store", dest="jobs", type="int",
+		help="number of external commands (dot, gnuplot, ...) run in parallel or, with --batch, number of documents generated in parallel")
+	oparser.add_option("--incremental", dest="incremental", action="store_true", default=False,
+		help="only generate again the pages that changed (multi-page outputs)")
+	oparser.add_option("--watch", dest="watch", action="store_true", default=False,
+		help="generate again the document each time its files change")
+	oparser.add_option("--batch", action="store", dest="batch",
+		help="generate the documents listed in the given file (one path per line) in the same process")
+	oparser.add_option("--profile", dest="profile", action="store_true", default=False,
+		help="display the time spent in the different parts of the processing")
+	oparser.add_option("--profile-out", dest="profile_out", action="store",
+		help="save the profiling measures in the given JSON file, also in Chrome trace format (implies --profile)")
+	return oparser
+
+
+def set_input(env, path):
+	"""Set the variables of the environment describing the input file."""
+	env["THOT_FILE"] = path
+	env["THOT_DOC_DIR"] = os.path.dirname(path)
+	if not env["THOT_DOC_DIR"]:
+		env["THOT_DOC_DIR"] = "."
+
+
+def load_outputs(env):
+	"""Load the back-ends of THOT_OUT_TYPE (comma-separated list).
+	Return the list of pairs (name, module)."""
+	out_path = os.path.join(env["THOT_LIB"], "backs")
+	out_drivers = []
+	for out_name in env["THOT_OUT_TYPE"].split(","):
+		out_name = out_name.strip()
+		out_driver = common.loadModule(out_name,  out_path)
+		if not out_driver:
+			common.onError('cannot find %s back-end' % out_name)
+		out_drivers.append((out_name, out_driver))
+	if len(out_drivers) > 1 and env["THOT_OUT_PATH"]:
+		common.onError("-o cannot be used with several output types")
+	return out_drivers
+
+
+def generate(env, out_drivers, options, input = None):
+	"""Parse the document of THOT_FILE, or the given input, and process
+	it (once per group of back-ends). Return the document parsed for the
+	first group."""
+	groups = group_outputs(env, out_drivers)
+	if options.dump or options.list_syntax or options.list_output or options.list_mods:
+		groups = groups[:1]
+	elif len(groups) > 1 and input != None:
+		common.onError("cannot parse the standard input several times for %s" % env["THOT_OUT_TYPE"])
+	document = None
+	for group in groups:
+		man = make_manager(env, group)
+		if input != None:
+			process(man, group, options, input)
+		else:
+			try:
+				file = open(env["THOT_FILE"], encoding = common.ENCODING)
+			except OSError as e:
+				common.onError("cannot open %s: %s" % (env["THOT_FILE"], e))
+			with file:
+				process(man, group, options, file)
+		if document == None:
+			document = man.get_doc()
+	return document
+
+
+def render(source, out_type = "html", env = None, out_path = None, uses = None):
+	"""Generate the document of the given .thot file.
+	source -- path of the .thot file,
+	out_type -- back-end (or comma-separated list of back-ends),
+	env -- dictionary of variables added to the environment,
+	out_path -- output path (default to the source path with the
+		extension of the back-end),
+	uses -- list of modules to use.
+	Each call works on its own document and environment, so several
+	documents can be generated in the same process. Errors raise
+	common.ErrorException. Return the parsed document."""
+	denv = make_env()
+	if env:
+		denv.update(env)
+	denv["THOT_OUT_TYPE"] = out_type
+	denv["THOT_OUT_PATH"] = out_path if out_path else ""
+	set_input(denv, source)
+	options = make_option_parser().get_default_values()
+	options.uses = uses
+	return generate(denv, load_outputs(denv), options)
+
+
+def read_manifest(manifest):
+	"""Read the paths of the documents listed in a manifest file (one path
+	per line, relative to the directory of the manifest; empty lines and
+	lines starting with # are ignored)."""
+	try:
+		with open(manifest) as file:
+			lines = file.read().splitlines()
+	except OSError as e:
+		common.onError("cannot read %s: %s" % (manifest, e))
+	base = os.path.dirname(manifest)
+	paths = []
+	for line in lines:
+		path = line.strip()
+		if path and not path.startswith("#"):
+			paths.append(os.path.join(base, path))
+	return paths
+
+
+batch_state = None
+
+def batch_document(path):
+	"""Generate a document of a batch with the environment, back-ends and
+	options of batch_state. Return (path, time, error) where error is
+	the error message or None."""
+	(env, out_drivers, options) = batch_state
+	denv = dict(env)
+	set_input(denv, path)
+	start = time.time()
+	error = None
+	try:
+		generate(denv, out_drivers, options)
+	except common.ErrorException as e:
+		common.onVerbose(lambda _: common.show_stack())
+		error = str(e)
+	except Exception as e:
+		traceback.print_exc()
+		error = "internal error: %s" % e
+	sys.stdout.flush()
+	sys.stderr.flush()
+	return (path, time.time() - start, error)
+
+
+def batch_worker(tasks, results):
+	"""Worker process of a batch: generate the documents taken from
+	the tasks queue until None is found."""
+	while True:
+		path = tasks.get()
+		if path == None:
+			break
+		results.put(batch_document(path))
+
+
+def run_batch(paths, jobs):
+	"""Generate the documents of the given paths. If jobs > 1, the
+	documents are distributed over jobs worker processes (forked, so they
+	start with the modules loaded by the command): each idle worker takes
+	the next document of a shared queue, the biggest documents first.
+	Return the list of (path, time, error) in the order of completion."""
+	if jobs <= 1 or len(paths) <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+		return [batch_document(path) for path in paths]
+
+	# start the workers
+	def size(path):
+		try:
+			return os.path.getsize(path)
+		except OSError:
+			return 0
+	context = multiprocessing.get_context("fork")
+	tasks = context.Queue()
+	results = context.Queue()
+	for path in sorted(paths, key = size, reverse = True):
+		tasks.put(path)
+	jobs = min(jobs, len(paths))
+	for i in range(jobs):
+		tasks.put(None)
+	sys.stdout.flush()
+	sys.stderr.flush()
+	workers = [context.Process(target = batch_worker, args = (tasks, results))
+		for i in range(jobs)]
+	for worker in workers:
+		worker.start()
+
+	# collect the results
+	done = []
+	while len(done) < len(paths):
+		try:
+			done.append(results.get(timeout = 1))
+		except queue.Empty:
+			if not any([worker.is_alive() for worker in workers]):
+				break
+	for worker in workers:
+		worker.join()
+	paths = set(paths) - set([path for (path, _, _) in done])
+	for path in paths:
+		done.append((path, 0., "worker process failed"))
+	return done
+
+
+def batch(manifest, env, out_drivers, options, jobs = 1):
+	"""Generate the documents listed in the manifest file (see
+	read_manifest()), in the current process or, if jobs > 1, in jobs
+	worker processes. An error in a document is displayed and does not
+	stop the generation of the other ones. Once all documents are
+	generated, the identical files of their import directories are
+	shared as reflinks, or as hard links if FRIEND_COPY is "hardlink"
+	(nothing is shared if FRIEND_COPY is "copy").
+	Return the number of failed documents."""
+	global batch_state
+	paths = read_manifest(manifest)
+	start = time.time()
+	batch_state = (env, out_drivers, options)
+	try:
+		done = run_batch(paths, jobs)
+	finally:
+		batch_state = None
+	failed = 0
+	for (path, duration, error) in done:
+		if error == None:
+			common.onInfo("%s: generated in %.2fs" % (path, duration))
+		else:
+			sys.stderr.write("ERROR: %s: %s\n" % (path, error))
+			failed += 1
+
+	# share the identical imported files
+	if env.get("FRIEND_COPY") != "copy":
+		dirs = [path[:-5] + "-imports" for path in paths if path.endswith(".thot")]
+		saved = back.dedup_files([dir for dir in dirs if os.path.isdir(dir)],
+			env.get("FRIEND_COPY") == "hardlink")
+		if saved:
+			common.onInfo("%d bytes of imported files shared" % saved)
+
+	common.onInfo("%d document(s) processed, %d failed, in %.2fs"
+		% (len(paths), failed, time.time() - start))
+	return failed
+
+
+def run(argv):
+	"""Run the command with the given arguments."""
+	if argv[:1] == ["serve"]:
+		import thot.serve as serve
+		serve.run(argv[1:])
+		return
+	env = make_env()
 
 	# Parse arguments
-	(options, args) = oparser.parse_args()
+	(options, args) = make_option_parser().parse_args(argv)
 	common.IS_VERBOSE = options.verbose
+	if options.profile or options.profile_out:
+		profile.start(options.profile_out != None)
+		atexit.register(profile.stop, options.profile_out)
 	if options.encoding:
 		common.ENCODING = options.encoding
 	env["THOT_OUT_TYPE"] = options.out_type
+	if options.jobs and not options.batch:
+		env["THOT_JOBS"] = str(options.jobs)
+	if options.incremental:
+		env["THOT_INCREMENTAL"] = "yes"
 	if not options.out_path:
 		env["THOT_OUT_PATH"] = ""
 	else:
 		env["THOT_OUT_PATH"] = options.out_path
+	input = None
 	if args == []:
 		input = sys.__stdin__
-		env["THOT_FILE"] = "<stdin>"
-		env["THOT_DOC_DIR"] = "."
+		input.reconfigure(encoding = common.ENCODING)
+		set_input(env, "<stdin>")
 	else:
-		input = open(args[0])
-		env["THOT_FILE"] = args[0]
-		env["THOT_DOC_DIR"] = os.path.dirname(args[0])
-		if not env["THOT_DOC_DIR"]:
-			env["THOT_DOC_DIR"] = "."
+		set_input(env, args[0])
 	if options.defines:
 		for d in options.defines:
 			p = d.find('=')
@@ -207,53 +680,42 @@ def main():
 			else:
 				env[d[:p]] = d[p+1:]
 
-	# open the output
+	# open the outputs
 	document = doc.Document(env)
-	out_name = env["THOT_OUT_TYPE"]
-	out_path = os.path.join(document.env["THOT_LIB"], "backs")
-	out_driver = common.loadModule(out_name,  out_path)
-	if not out_driver:
-		common.onError('cannot find %s back-end' % out_name)
+	out_drivers = load_outputs(env)
 
 	# list available modules
 	if options.list_avail:
 		list_avail_modules(document)
-		sys.exit(0)
 
 	# list a module
 	elif options.list_mod:
 		list_module(document, options.list_mod)
-		sys.exit(0)
-
-	# Parse the file
-	man = tparser.Manager(document)
-	if "init" in out_driver.__dict__:
-		out_driver.init(man)
-	if options.uses:
-		for u in options.uses:
-			man.use(u)
-	man.parse(input, env['THOT_FILE'])
 
-	# dump the parsed document
-	if options.dump:
-		document.dump("")
+	# watch the files
+	elif options.watch:
+		if args == []:
+			common.onError("--watch requires a file to process")
+		watch(env, group_outputs(env, out_drivers), options)
 
-	# list the syntax
-	elif options.list_syntax:
-		list_syntax(man)
-		print("Available syntax:")
+	# generate the documents of a manifest
+	elif options.batch:
+		if args != []:
+			common.onError("--batch cannot be used with an input file")
+		if env["THOT_OUT_PATH"]:
+			common.onError("-o cannot be used with --batch")
+		if batch(options.batch, env, out_drivers, options, options.jobs or 1):
+			sys.exit(1)
 
-	# list outputs
-	elif options.list_output:
-		list_output(man, options.list_output)
+	# Parse the file and process it (once per group of back-ends)
+	else:
+		generate(env, out_drivers, options, input)
 
-	# list the involved modules
-	elif options.list_mods:
-		list_used_modules(man)
 
-	# Output the result
-	else:
-		try:
-			out_driver.output(document)
-		except common.BackException as e:
-			common.onError(str(e))
+def main():
+	"""Command line entry point."""
+	try:
+		run(sys.argv[1:])
+	except common.ErrorException as e:
+		common.report_error(e)
+		sys.exit(1)
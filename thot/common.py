@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import html
+import importlib
 import importlib.machinery
 import importlib.util
 import os
@@ -25,8 +27,17 @@ import subprocess
 import sys
 import traceback
 
+import thot.profile as profile
+
 from html import escape
 
+try:
+	import fcntl
+	FICLONE = 0x40049409
+except ImportError:
+	fcntl = None
+
+
 class ThotException(Exception):
 	"""Exception of the Thot system.
 	Any back-passed to the Thot system must inherit this exception.
@@ -64,9 +75,22 @@ class CommandException(ThotException):
 		ThotException.__init__(self, msg)
 
 
+class ErrorException(ThotException):
+	"""Raised by onError() to stop the processing of the current
+	document. The command line displays the message and exits;
+	a program using Thot as a library gets the exception."""
+	
+	def __init__(self, msg):
+		ThotException.__init__(self, msg)
+
+
 IS_VERBOSE = False
 ENCODING = "UTF-8"
 
+# list of the displayed messages as pairs (kind, message) while they
+# are recorded (see record_messages())
+messages = None
+
 
 def onVerbose(f):
 	"""Invoke and display the result of the given function if verbose
@@ -86,20 +110,30 @@ def onParseError(msg):
 	raise ParseException(msg)
 
 def onError(text):
-	"""Display the given error and stop the application."""
+	"""Stop the processing of the current document with the given error
+	(raise ErrorException)."""
+	raise ErrorException(text)
+
+
+def report_error(e, prefix = ""):
+	"""Display an error raised by onError() (with the stack in verbose
+	mode)."""
 	onVerbose(lambda _: show_stack())
-	sys.stderr.write("ERROR: %s\n" % text)
-	sys.exit(1)
+	sys.stderr.write("ERROR: %s%s\n" % (prefix, e))
 
 
 def onWarning(message):
 	"""Display a warning message."""
 	sys.stderr.write("WARNING: %s\n" % message)
+	if messages != None:
+		messages.append(("warning", message))
 
 
 def onInfo(message):
 	"""Display an information message."""
 	sys.stderr.write("INFO: %s\n" % message)
+	if messages != None:
+		messages.append(("info", message))
 
 
 DEPRECATED = []
@@ -108,31 +142,100 @@ def onDeprecated(msg):
 	if msg not in DEPRECATED:
 		sys.stderr.write("DEPRECATED: %s\n" % msg)
 		DEPRECATED.append(msg)
+		if messages != None:
+			messages.append(("deprecated", msg))
+
+
+def record_messages():
+	"""Start recording the warning, information and deprecated messages.
+	Return the list the messages are recorded in."""
+	global messages
+	messages = []
+	return messages
+
+
+def stop_messages():
+	"""Stop recording the messages."""
+	global messages
+	messages = None
+
+
+def replay_message(kind, message):
+	"""Display again a message recorded by record_messages()."""
+	if kind == "warning":
+		onWarning(message)
+	elif kind == "info":
+		onInfo(message)
+	else:
+		onDeprecated(message)
 
 
 def load_source(modname, filename):
-    loader = importlib.machinery.SourceFileLoader(modname, filename)
-    spec = importlib.util.spec_from_file_location(modname, filename, loader=loader)
-    module = importlib.util.module_from_spec(spec)
-    # The module is always executed and not cached in sys.modules.
-    # Uncomment the following line to cache the module.
-    # sys.modules[module.__name__] = module
-    loader.exec_module(module)
-    return module
+	"""Load a module from a source (.py) or compiled (.pyc) file and
+	record it in sys.modules with the given name. Source files are
+	compiled through the bytecode cache of Python (__pycache__)."""
+	if filename.endswith(".pyc"):
+		loader = importlib.machinery.SourcelessFileLoader(modname, filename)
+	else:
+		loader = importlib.machinery.SourceFileLoader(modname, filename)
+	spec = importlib.util.spec_from_file_location(modname, filename, loader=loader)
+	module = importlib.util.module_from_spec(spec)
+	(parent, _, child) = modname.rpartition(".")
+	if parent:
+		try:
+			importlib.import_module(parent)
+		except ImportError:
+			pass
+	sys.modules[modname] = module
+	try:
+		loader.exec_module(module)
+	except BaseException:
+		del sys.modules[modname]
+		raise
+	if parent in sys.modules:
+		setattr(sys.modules[parent], child, module)
+	return module
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+modules = { }
+
+def module_key(name, path):
+	"""Build the name of a module in sys.modules from its name and
+	its path: thot.mods.NAME, thot.backs.NAME or thot.langs.NAME for
+	the modules of Thot and thot.ext.HASH.NAME for the modules found
+	in other directories."""
+	dir = os.path.dirname(os.path.abspath(path))
+	if os.path.dirname(dir) == PACKAGE_DIR:
+		return "thot.%s.%s" % (os.path.basename(dir), name)
+	else:
+		return "thot.ext.d%s.%s" % (hashlib.sha1(dir.encode("utf-8")).hexdigest()[:12], name)
+
+def module_name(mod):
+	"""Get the name of a module loaded by loadModule() (without
+	its namespace)."""
+	return mod.__name__.split(".")[-1]
 
 def loadModule(name, paths):
 	"""Load a module by its name and a collection of paths to look in
-	and return its object."""
+	and return its object. A module is only loaded once: next loads
+	return the same module object. The module is also recorded in
+	sys.modules (see module_key())."""
 	try:
 		for path in paths.split(":"):
 			path = os.path.join(path, name + ".py")
-			if os.path.exists(path):
-				return load_source(name, path)
-			else:
+			if not os.path.exists(path):
 				path = path + "c"
-				if os.path.exists(path):
-					raise Exception("No can do")
-					# return imp.load_compiled(name, path)
+				if not os.path.exists(path):
+					continue
+			try:
+				return modules[path]
+			except KeyError:
+				key = module_key(name, path)
+				mod = sys.modules.get(key)
+				if mod == None or getattr(mod, "__file__", None) != os.path.abspath(path):
+					mod = profile.call("module", name, load_source, key, os.path.abspath(path))
+				modules[path] = mod
+				return mod
 		return None
 	except Exception as e:
 		tb = sys.exc_info()[2]
@@ -182,6 +285,42 @@ def which(program):
 	return None
 
 
+def reflink_file(spath, tpath):
+	"""Create tpath as a copy-on-write clone of spath (only supported
+	on Linux by some file systems). Raise OSError if it fails."""
+	if fcntl == None:
+		raise OSError("reflink not supported")
+	with open(spath, "rb") as sfile:
+		with open(tpath, "wb") as tfile:
+			try:
+				fcntl.ioctl(tfile.fileno(), FICLONE, sfile.fileno())
+			except OSError:
+				tfile.close()
+				os.remove(tpath)
+				raise
+
+
+def link_file(spath, tpath):
+	"""Make tpath a file with the same content as spath without copying
+	the content: as a reflink or, else, as a hard link. Raise OSError
+	if none is supported (different file systems for example)."""
+	try:
+		reflink_file(spath, tpath)
+	except OSError:
+		os.link(spath, tpath)
+
+
+def copy_file(spath, tpath):
+	"""Make the file spath available as tpath. A reflink or a hard link
+	is used if possible, a copy is performed else. As a hard link shares
+	the changes of its file, spath must not be changed after (like the
+	entries of the cache)."""
+	try:
+		link_file(spath, tpath)
+	except OSError:
+		shutil.copyfile(spath, tpath)
+
+
 def getLinuxDistrib():
 	"""Look for the current linux distribution.
 	Return (distribution, release) or None if version cannot be found."""
@@ -200,7 +339,7 @@ def getLinuxDistrib():
 
 def onRaise(msg):
 	"""Raise a command error with the given message."""
-	raise CommandError(msg)
+	raise CommandException(msg)
 
 def onIgnore(msg):
 	"""Ignore the error."""
@@ -329,8 +468,12 @@ STANDARD_VARS = [
 	("LOGO",			"logos of the supporting organization"),
 	("ORGANIZATION",	"organization producing the document"),
 	("SUBTITLE",		"sub-title of the document"),
+	("THOT_CACHE",		"directory of the external tool cache (empty to disable)"),
+	("THOT_INCREMENTAL",	"yes to only generate again changed pages"),
+	("THOT_JOBS",		"number of external commands run in parallel"),
 	("THOT_FILE",		"used to derivate the THOT_OUT_PATH if not set"),
 	("THOT_OUT_PATH",	"output directory path"),
+	("THOT_SNAPSHOT",	"yes to enable snapshots of the parsed document"),
 	("TITLE",			"title of the document"),
 ]
 
@@ -17,6 +17,7 @@
 import re
 
 import thot.common as common
+import thot.profile as profile
 
 # levels
 L_DOC=0
@@ -239,8 +240,113 @@ class QuoteEvent(Event):
 		return Quote(self.depth)
 
 
+# Attributes of nodes stored in slots: they are None until they are set.
+SLOTS = frozenset(["info", "file", "line", "content", "text", "label", "code", "style",
+	"ref", "kind", "depth"])
+
+
+def get_attrs(obj):
+	"""Get the set attributes of an object (including the attributes
+	stored in slots) as a dictionary. An attribute set to None is
+	considered as not set: this way, an object loaded from a snapshot
+	(whose slots may be set to None) gives the same attributes as
+	the parsed object."""
+	attrs = { }
+	for (name, val) in getattr(obj, "__dict__", { }).items():
+		if val is not None:
+			attrs[name] = val
+	for cls in type(obj).__mro__:
+		for name in cls.__dict__.get("__slots__", ()):
+			try:
+				val = cls.__dict__[name].__get__(obj, cls)
+				if val is not None:
+					attrs[name] = val
+			except AttributeError:
+				pass
+	return attrs
+
+
+def walk(node, enter = None, leave = None):
+	"""Traverse in depth-first order the tree of nodes rooted at node
+	(following getContent()). The traversal uses an explicit stack
+	so that deeply nested documents do not reach the recursion limit
+	of Python.
+	enter -- called with each node before its sub-nodes (pre-order);
+		if it returns False, the sub-nodes are skipped.
+	leave -- called with each node after its sub-nodes (post-order),
+		only if the sub-nodes have been traversed."""
+	parents = []
+	stack = [iter((node, ))]
+	while stack:
+		for node in stack[-1]:
+			if enter == None or enter(node) != False:
+				parents.append(node)
+				stack.append(iter(node.getContent()))
+			break
+		else:
+			stack.pop()
+			if parents:
+				node = parents.pop()
+				if leave != None:
+					leave(node)
+
+
+# node classes mapped to True if they are generated by iterGen(), False by gen()
+gen_iters = { }
+
+def start_gen(node, gen):
+	"""Start the generation of a node with the generator gen. Return None
+	if the node is generated, or an iterator on the sub-nodes to generate
+	(see Node.iterGen()). The nodes whose class redefines gen() after
+	iterGen() are generated by gen()."""
+	cls = node.__class__
+	try:
+		iter_gen = gen_iters[cls]
+	except KeyError:
+		iter_gen = False
+		for c in cls.__mro__:
+			if "iterGen" in c.__dict__:
+				iter_gen = True
+				break
+			elif "gen" in c.__dict__:
+				break
+		gen_iters[cls] = iter_gen
+	if iter_gen:
+		return node.iterGen(gen)
+	node.gen(gen)
+	return None
+
+
+def generate(nodes, gen):
+	"""Generate with the generator gen the nodes given by the iterator nodes
+	(as returned by Node.iterGen()) and, in turn, their sub-nodes. The
+	generation uses an explicit stack of iterators so that deeply nested
+	documents do not reach the recursion limit of Python."""
+	if nodes == None:
+		return
+	stack = [iter(nodes)]
+	while stack:
+		for node in stack[-1]:
+			nodes = start_gen(node, gen)
+			if nodes != None:
+				stack.append(iter(nodes))
+			break
+		else:
+			stack.pop()
+
+
 class Info:
-	info = None
+	"""Base class of objects supporting information values. To save
+	memory, the most common nodes store their attributes in slots
+	and the information dictionary is only created on the first
+	information set. Sub-classes not declaring __slots__ support any
+	attribute as usual."""
+	__slots__ = ("info", )
+
+	def __getattr__(self, name):
+		if name in SLOTS:
+			return None
+		raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
 
 	def setInfo(self, id, val):
 		"""Deprecated."""
@@ -284,8 +390,7 @@ class Info:
 # nodes
 class Node(Info):
 	"""Base definition of document nodes."""
-	file = None
-	line = None
+	__slots__ = ("file", "line")
 	
 	def __init__(self):
 		pass
@@ -338,10 +443,31 @@ class Node(Info):
 		return []
 
 	def gen(self, gen):
-		"""Method to perform document generation.
+		"""Method to perform document generation. As a default,
+		the generation is performed by iterGen().
 		gen -- used generator."""
+		generate(self.iterGen(gen), gen)
+
+	def iterGen(self, gen):
+		"""Perform the document generation without recursion: return None
+		if the node is generated, or an iterator on the sub-nodes to generate
+		in turn. A Python generator may produce output around the sub-nodes
+		it yields. As a default, generate nothing.
+		gen -- used generator."""
+		return None
+
+	def pregen(self, gen):
+		"""Called before the generation to let the node prepare it.
+		Nodes calling external commands usually call gen.prepare_job()
+		to launch their command in advance. As a default, do nothing."""
 		pass
 
+	def make_job(self, gen):
+		"""Called to build the job (jobs.Job) of external command
+		of the node. The result of the job is obtained by gen.get_job().
+		As a default, return None (no job)."""
+		return None
+
 	def acceptLabel(self):
 		"""Method called called when a label is found. Nodes not supporting
 		just return False (default behaviour) else node return True."""
@@ -387,7 +513,7 @@ class Node(Info):
 
 class Container(Node):
 	"""A container is an item containing other items."""
-	content = None
+	__slots__ = ("content", )
 
 	def __init__(self):
 		Node.__init__(self)
@@ -413,45 +539,92 @@ class Container(Node):
 		return self.content == []
 
 	def clean(self):
-		toremove = []
-		for item in self.content:
-			item.clean()
-			if item.isEmpty():
-				toremove.append(item)
-		for item in toremove:
-			self.content.remove(item)
+		def enter(node):
+			if node is self or node.__class__.clean is Container.clean:
+				return True
+			elif node.__class__.clean is not Node.clean:
+				node.clean()
+			return False
+		def leave(node):
+			node.content[:] = [item for item in node.content if not item.isEmpty()]
+		walk(self, enter, leave)
 
 	def dumpHead(self, tab):
 		pass
 
 	def dump(self, tab):
-		self.dumpHead(tab)
-		for item in self.content:
-			item.dump(tab + "  ")
-		print(tab + ")")
+		tabs = [tab]
+		def enter(node):
+			if node is self or node.__class__.dump is Container.dump:
+				node.dumpHead(tabs[-1])
+				tabs.append(tabs[-1] + "  ")
+				return True
+			node.dump(tabs[-1])
+			return False
+		def leave(node):
+			tabs.pop()
+			print(tabs[-1] + ")")
+		walk(self, enter, leave)
 
 	def getContent(self):
 		return self.content
 
 	def gen(self, gen):
-		for item in self.content:
-			item.gen(gen)
+		"""Generate only the sub-nodes, as a default. As a call to
+		Container.gen() does not use iterGen(), the sub-classes redefining
+		iterGen() also redefine gen() as Node.gen()."""
+		generate(Container.iterGen(self, gen), gen)
+
+	def iterGen(self, gen):
+		return iter(self.content)
+
+	def pregen(self, gen):
+		def enter(node):
+			if node is self or node.__class__.pregen is Container.pregen:
+				return True
+			elif node.__class__.pregen is not Node.pregen:
+				node.pregen(gen)
+			return False
+		walk(self, enter)
 
 	def toText(self):
-		r = ""
-		for item in self.content:
-			r = r + item.toText()
-		return r
+		text = []
+		def enter(node):
+			if node is self or node.__class__.toText is Container.toText:
+				return True
+			text.append(node.toText())
+			return False
+		walk(self, enter)
+		return "".join(text)
 
 
 # Word family
+MAX_MERGED_WORD = 1 << 12
+
 class Word(Node):
-	text = None
+	__slots__ = ("text", )
 
 	def __init__(self, text):
 		Node.__init__(self)
 		self.text = text
 
+	def isPlain(self):
+		"""Test if the word is plain text, that is, a Word without
+		information that can be merged with adjacent plain words."""
+		return self.__class__ is Word and not self.info
+
+	def onEvent(self, man, event):
+		"""A plain word following directly a plain word is merged in it
+		to reduce the number of nodes (until the word reaches
+		MAX_MERGED_WORD characters to keep the merge cost linear)."""
+		if event.__class__ is ObjectEvent and event.level == L_WORD \
+		and event.id == ID_NEW and event.object.__class__ is Word \
+		and self.isPlain() and event.object.isPlain() \
+		and len(self.text) < MAX_MERGED_WORD:
+			self.text = self.text + event.object.text
+		else:
+			man.forward(event)
+
 	def dump(self, tab):
 		print("%s%s" % (tab, self))
 
@@ -468,7 +641,7 @@ class Word(Node):
 		return self.text
 
 class Ref(Node):
-	label = None
+	__slots__ = ("label", )
 	
 	def __init__(self, label):
 		Node.__init__(self)
@@ -538,7 +711,7 @@ class Image(Node):
 
 
 class Glyph(Node):
-	code = None
+	__slots__ = ("code", )
 
 	def __init__(self, code):
 		Node.__init__(self)
@@ -554,6 +727,7 @@ class Glyph(Node):
 		visitor.onGlyph(self)
 
 class LineBreak(Node):
+	__slots__ = ()
 
 	def __init__(self):
 		Node.__init__(self)
@@ -570,7 +744,7 @@ class LineBreak(Node):
 
 # Style family
 class Style(Container):
-	style = None
+	__slots__ = ("style", )
 
 	def __init__(self, style):
 		Container.__init__(self)
@@ -589,9 +763,11 @@ class Style(Container):
 	def dumpHead(self, tab):
 		print(tab + "style(" + self.style + ",")
 
-	def gen(self, gen):
+	gen = Node.gen
+
+	def iterGen(self, gen):
 		gen.genStyleBegin(self.style)
-		Container.gen(self, gen)
+		yield from self.content
 		gen.genStyleEnd(self.style)
 
 	def visit(self, visitor):
@@ -618,9 +794,11 @@ class OpenStyle(Container):
 	def dumpHead(self, tab):
 		print(tab + "style(" + self.style + ",")
 
-	def gen(self, gen):
+	gen = Node.gen
+
+	def iterGen(self, gen):
 		gen.genStyleBegin(self.style)
-		Container.gen(self, gen)
+		yield from self.content
 		gen.genStyleEnd(self.style)
 
 	def visit(self, visitor):
@@ -654,8 +832,8 @@ class FootNote(OpenStyle):
 	def isEmpty(self):
 		return False
 
-	def gen(self, gen):
-		gen.genFootNote(self)
+	def iterGen(self, gen):
+		return gen.genFootNote(self)
 
 	def visit(self, visitor):
 		visitor.onFootNote(self)
@@ -666,7 +844,7 @@ class FootNote(OpenStyle):
 
 class Link(Container):
 	"""A link in a text."""
-	ref = None
+	__slots__ = ("ref", )
 
 	def __init__(self, ref):
 		Container.__init__(self)
@@ -683,9 +861,11 @@ class Link(Container):
 	def dumpHead(self, tab):
 		print(tab + "link(" + self.ref + ",")
 
-	def gen(self, gen):
+	gen = Node.gen
+
+	def iterGen(self, gen):
 		gen.genLinkBegin(self.ref)
-		Container.gen(self, gen)
+		yield from self.content
 		gen.genLinkEnd(self.ref)
 
 	def visit(self, visitor):
@@ -694,6 +874,7 @@ class Link(Container):
 
 # Par family
 class Par(Container):
+	__slots__ = ()
 
 	def __init__(self):
 		Container.__init__(self)
@@ -709,9 +890,11 @@ class Par(Container):
 	def dumpHead(self, tab):
 		print(tab + "par(")
 
-	def gen(self, gen):
+	gen = Node.gen
+
+	def iterGen(self, gen):
 		gen.genParBegin()
-		Container.gen(self, gen)
+		yield from self.content
 		gen.genParEnd()
 
 	def visit(self, visitor):
@@ -740,9 +923,9 @@ class Quote(Par):
 	def dumpHead(self, tab):
 		print(tab + "quote(")
 
-	def gen(self, gen):
+	def iterGen(self, gen):
 		gen.genQuoteBegin(self.level)
-		Container.gen(self, gen)
+		yield from self.content
 		gen.genQuoteEnd(self.level)
 
 	def visit(self, visitor):
@@ -840,6 +1023,7 @@ class Figure(Block):
 # List family
 class ListItem(Container):
 	"""Description of a list item."""
+	__slots__ = ()
 
 	def __init__(self):
 		Container.__init__(self)
@@ -854,8 +1038,7 @@ class ListItem(Container):
 
 class List(Container):
 	"""Description of any kind of list (numbered, unnumbered)."""
-	kind = None
-	depth = None
+	__slots__ = ("kind", "depth")
 
 	def __init__(self, kind, depth):
 		Container.__init__(self)
@@ -889,8 +1072,10 @@ class List(Container):
 		"""Get the list of items in the list."""
 		return self.content
 
-	def gen(self, gen):
-		gen.genList(self)
+	gen = Node.gen
+
+	def iterGen(self, gen):
+		return gen.genList(self)
 
 	def visit(self, visitor):
 		visitor.onList(self)
@@ -953,9 +1138,10 @@ class DefList(Container):
 		"""Get the list of items in the list."""
 		return self.content
 
-	def gen(self, gen):
-		gen.genDefList(self)
-		pass
+	gen = Node.gen
+
+	def iterGen(self, gen):
+		return gen.genDefList(self)
 
 	def visit(self, visitor):
 		visitor.onDefList(self)
@@ -972,7 +1158,7 @@ TABLE_KINDS = [ 'normal', 'header' ]
 TABLE_ALIGNS = [ 'left', 'center', 'right' ]
 
 class Cell(Par):
-	kind = None
+	__slots__ = ("kind", )
 
 	def __init__(self, kind, align = None, span = None, vspan = None):
 		Par.__init__(self)
@@ -999,15 +1185,15 @@ class Cell(Par):
 	def dumpHead(self, tab):
 		print(tab + 'cell(' + TABLE_KINDS[self.kind] + ', ' + TABLE_ALIGNS[self.align + 1] + ', ' + str(self.span) + ',')
 
-	def gen(self, gen):
-		Container.gen(self, gen)
+	def iterGen(self, gen):
+		return Container.iterGen(self, gen)
 
 	def visit(self, visitor):
 		visitor.onCell(self)
 
 
 class Row(Container):
-	kind = None
+	__slots__ = ("kind", )
 
 	def __init__(self, kind):
 		Container.__init__(self)
@@ -1065,8 +1251,10 @@ class Table(Container):
 		else:
 			man.forward(event)
 
-	def gen(self, gen):
-		gen.genTable(self)
+	gen = Node.gen
+
+	def iterGen(self, gen):
+		return gen.genTable(self)
 
 	def isEmpty(self):
 		return False
@@ -1203,6 +1391,11 @@ class Feature:
 	def prepare(self, gen):
 		pass
 
+	def complete(self, gen):
+		"""Called once the nodes of the document have been prepared
+		for generation (see Node.pregen()). As a default, do nothing."""
+		pass
+
 
 class HashSource:
 	"""A hash source provides a way to resolve hash word, prefixed by '#'."""
@@ -1214,20 +1407,123 @@ class HashSource:
 		return None
 	
 
+class VarCache:
+	"""Cache of the expanded values of the variables of an environment.
+	The variables used by the expansion of a value are recorded to drop
+	the value when one of them is changed."""
+	env = None
+	values = None		# identifier -> (expanded value, used identifiers)
+	users = None		# identifier -> identifiers of the values using it
+	stack = None		# identifiers of the expansions in progress
+	uses = None			# used identifiers of the expansions in progress
+
+	def __init__(self, env):
+		self.env = env
+		self.values = { }
+		self.users = { }
+		self.stack = []
+		self.uses = []
+
+	def expand(self, id):
+		"""Begin the expansion of a variable and return the set
+		of identifiers it uses."""
+		uses = set([id])
+		self.stack.append(id)
+		self.uses.append(uses)
+		return uses
+
+	def complete(self):
+		"""End the expansion in progress."""
+		self.stack.pop()
+		self.uses.pop()
+
+	def record(self, id, val, uses):
+		"""Record the expanded value of a variable."""
+		self.values[id] = (val, uses)
+		for use in uses:
+			try:
+				self.users[use].add(id)
+			except KeyError:
+				self.users[use] = set([id])
+
+	def invalidate(self, id):
+		"""Drop the values using the given variable."""
+		for user in self.users.pop(id, ()):
+			self.values.pop(user, None)
+
+
+class Number:
+	"""Number of a node in the reference index of a document.
+	* kind -- numbering kind ("header", "figure", etc),
+	* number -- number as a string ("1.2" for headers),
+	* section -- position of the last header found before the node
+	  (or the node itself if it is a header) in the document order,
+	  -1 if there is none,
+	* chapter -- position of the chapter (header of level 0)
+	  containing the node (or the node itself), None if there is none."""
+	__slots__ = ("kind", "number", "section", "chapter")
+
+	def __init__(self, kind, number, section, chapter):
+		self.kind = kind
+		self.number = number
+		self.section = section
+		self.chapter = chapter
+
+
+def make_numbers(doc):
+	"""Number the headers and the labelled nodes of the document.
+	Return the map of the numbered nodes, in the document order,
+	to their Number."""
+	numbers = { }
+	nums = [1]
+	others = { }
+	chapters = [None]
+	section = [-1]
+
+	def enter(node):
+		kind = node.numbering()
+		if kind == 'header':
+			section[0] = section[0] + 1
+			chapter = chapters[-1]
+			if node.getHeaderLevel() == 0:
+				chapter = nums[0] - 1
+			numbers[node] = Number(kind, ".".join([str(i) for i in nums]), section[0], chapter)
+			nums.append(1)
+			chapters.append(chapter)
+		elif kind and node in doc.inv_labels:
+			n = others.get(kind, 0) + 1
+			others[kind] = n
+			numbers[node] = Number(kind, str(n), section[0], chapters[-1])
+
+	def leave(node):
+		if node.numbering() == 'header':
+			chapters.pop()
+			nums.pop()
+			nums[-1] = nums[-1] + 1
+
+	walk(doc, enter, leave)
+	return numbers
+
+
 class Document(Container):
 	"""This is the top object of the document, containing the headings
 	and also the configuration environment."""
 	env = None
 	features = None
-	labels = { }
-	inv_labels = { }
+	labels = None
+	inv_labels = None
+	numbers = None
 	hashes = None
 	hash_srcs = None
+	used_vars = None
+	var_cache = None
 
 	def __init__(self, env):
 		Container.__init__(self)
 		self.env = env
 		self.features = []
+		self.labels = { }
+		self.inv_labels = { }
 		self.hashes = { }
 		self.hash_srcs = []
 	
@@ -1244,23 +1540,44 @@ class Document(Container):
 		"""Reduce variables in the given text.
 		- doc -- current document
 		- text -- text to replace in."""
-
-		m = VAR_REC.search(text)
-		while m:
-			val = str(self.getVar(m.group('varid')))
-			text = text[:m.start()] + val + text[m.end():]
-			m = VAR_REC.search(text)
-		return text
+		if "@(" not in text:
+			return text
+		return VAR_REC.sub(lambda m: str(self.getVar(m.group('varid'))), text)
 
 	def getVar(self, id, default = ""):
-		"""Get a variable and evaluates the variables in its content."""
-		if id in self.env:
-			return self.reduceVars(self.env[id])
-		else:
-			return default
+		"""Get a variable and evaluates the variables in its content.
+		If used_vars is not None, the variable identifier is recorded in
+		(with the identifiers of the variables used by its content)."""
+		cache = self.var_cache
+		if cache == None or cache.env is not self.env:
+			cache = VarCache(self.env)
+			self.var_cache = cache
+		try:
+			(val, uses) = cache.values[id]
+		except KeyError:
+			if id not in self.env:
+				(val, uses) = (default, (id, ))
+			elif id in cache.stack:
+				cycle = cache.stack[cache.stack.index(id):] + [id]
+				common.onWarning("cyclic definition of variables: %s" % " -> ".join(cycle))
+				(val, uses) = ("", (id, ))
+			else:
+				uses = cache.expand(id)
+				try:
+					val = self.reduceVars(self.env[id])
+				finally:
+					cache.complete()
+				cache.record(id, val, uses)
+		if cache.uses:
+			cache.uses[-1].update(uses)
+		if self.used_vars != None:
+			self.used_vars.update(uses)
+		return val
 
 	def setVar(self, name, val):
 		self.env[name] = val
+		if self.var_cache != None:
+			self.var_cache.invalidate(name)
 
 	def dumpHead(self, tab = ""):
 		for k in iter(self.env):
@@ -1273,14 +1590,28 @@ class Document(Container):
 			self.features.append(feature)
 
 	def pregen(self, gen):
-		"""Call the prepare method of features of the document."""
-		for feature in self.features:
-			feature.prepare(gen)
+		"""Call the prepare method of features of the document
+		and let the nodes prepare the generation."""
+		if profile.current == None:
+			for feature in self.features:
+				feature.prepare(gen)
+			Container.pregen(self, gen)
+			for feature in self.features:
+				feature.complete(gen)
+		else:
+			profile.current.begin("phase", "pregen")
+			for feature in self.features:
+				profile.current.call("pregen", "%s.prepare" % profile.class_name(feature), feature.prepare, gen)
+			Container.pregen(self, gen)
+			for feature in self.features:
+				profile.current.call("pregen", "%s.complete" % profile.class_name(feature), feature.complete, gen)
+			profile.current.end()
 
 	def addLabel(self, label, node):
 		"""Add a label for the given node."""
 		self.labels[label] = node
 		self.inv_labels[node] = label
+		self.numbers = None
 	
 	def getLabel(self, label):
 		"""Find the node matching the given label.
@@ -1297,6 +1628,20 @@ class Document(Container):
 		else:
 			return None
 
+	def getNumbers(self):
+		"""Get the map of the numbered nodes (headers and labelled
+		nodes) to their Number. The map is built once, when the
+		document is completely parsed, and is rebuilt only if labels
+		are added or if updateNumbers() is called."""
+		if self.numbers == None:
+			self.numbers = make_numbers(self)
+		return self.numbers
+
+	def updateNumbers(self):
+		"""Called to rebuild the numbers after a change of the
+		document tree."""
+		self.numbers = None
+
 	def visit(self, visitor):
 		"""Visit the content of a document using the visitor interface."""
 		visitor.onDocument(self)
@@ -1324,6 +1669,10 @@ class Document(Container):
 
 class Visitor:
 	"""Visitor default class."""
+
+	def walk(self, node):
+		"""Visit the node and all its sub-nodes in pre-order."""
+		walk(node, lambda node: node.visit(self))
 	
 	def onDocument(self, doc):
 		pass
@@ -1355,6 +1704,48 @@ class Visitor:
 	def onTag(self, tag):
 		pass
 
+	def onWord(self, word):
+		pass
+
+	def onRef(self, ref):
+		pass
+
+	def onImage(self, image):
+		pass
+
+	def onGlyph(self, glyph):
+		pass
+
+	def onLineBreak(self, lb):
+		pass
+
+	def onStyle(self, style):
+		pass
+
+	def onFootNote(self, note):
+		pass
+
+	def onLink(self, link):
+		pass
+
+	def onEmbeddedImage(self, image):
+		pass
+
+	def onListItem(self, item):
+		pass
+
+	def onDefItem(self, item):
+		pass
+
+	def onCell(self, cell):
+		pass
+
+	def onRow(self, row):
+		pass
+
+	def onHorizontalLine(self, hline):
+		pass
+
 
 class Factory:
 	"""Factory to customize the building of objects."""
@@ -15,12 +15,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
-import subprocess
 import sys
 import tempfile
 
+import thot.cache as cache
 import thot.common as common
 import thot.doc as doc
+import thot.jobs as jobs
 import thot.tparser as tparser
 
 ARG_RE = re.compile("[\s]*([\S]+)[\s]*=(.*)")
@@ -95,6 +96,28 @@ class SwitchOption(Option):
 			opts.append(self.opt)
 		
 
+class ExternalJob(jobs.Job):
+	"""Job trying, in turn, a list of alternative commands until one
+	is found (return code different of 127). The found command is then
+	recorded in found attribute."""
+	cmds = None
+	opts = None
+	found = None
+
+	def __init__(self, cmds, opts, input, path, key):
+		jobs.Job.__init__(self, "", input, path, key)
+		self.cmds = cmds
+		self.opts = opts
+
+	def run(self):
+		for cmd in self.cmds:
+			self.cmd = "%s %s" % (cmd, self.opts)
+			jobs.Job.run(self)
+			if self.error != None or self.returncode != 127:
+				self.found = cmd
+				return
+
+
 class ExternalBlock(doc.Block):
 	"""Abstract class for external block providing facilities to call
 	an external command and get back result."""
@@ -121,7 +144,7 @@ class ExternalBlock(doc.Block):
 	def get_path(self, gen):
 		"""Declare the given block file as friend and generate a valid path."""
 		if not self.path:
-			self.path = gen.new_friend('extern/%s-%s%s' % (self.meta.name, self.new_num(), self.meta.ext))
+			self.path = gen.new_friend('extern/%s-%s%s' % (self.meta.name, self.new_num(), self.meta.ext), False)
 		return self.path
 
 	def dumpHead(self, tab):
@@ -171,67 +194,68 @@ class ExternalBlock(doc.Block):
 		Enable the execution of post-pass commands. As a default, do nothgin."""
 		pass
 
-	def run(self, cmd, opts, input):
-		"""Run the command. Return True for success, False else."""
-		try:
-			cmd = "%s %s" % (cmd, " ".join(opts))
-			common.onVerbose(lambda _: "CMD: %s" % cmd)
-			process = subprocess.Popen(
-					cmd,
-					stdin = subprocess.PIPE,
-					stdout = subprocess.PIPE,
-					stderr = subprocess.PIPE,
-					close_fds = True,
-					shell = True
-				)
-			(out, err) = process.communicate("".join(input).encode('utf-8'))
-			if process.returncode == 127:
-				return False
-			if not self.meta.cmd:
-				self.meta.cmd = cmd
-			if process.returncode:
-				sys.stderr.write(err.decode('utf-8'))
-				self.onWarning("error during \"%s\' call (return code = %d)" % (cmd, process.returncode))
-				return False
-			else:
-				return True
-		except OSError as e:
-			self.onError('can not process %s: %s' % (self.meta.name, str(e)))
+	def check_job(self, job):
+		"""Check the result of the command job. Return True for success,
+		False else."""
+		if job.error != None:
+			self.onError('can not process %s: %s' % (self.meta.name, job.error))
+			return False
+		if job.found == None:
+			self.meta.cmd = ""
+			self.onWarning("cannot generate %s block: none of commands %s is available." % (self.meta.name, ", ".join(self.meta.cmds)))
+			return False
+		if not self.meta.cmd:
+			self.meta.cmd = job.found
+		if job.returncode:
+			sys.stderr.write(job.err.decode('utf-8'))
+			self.onWarning("error during \"%s\' call (return code = %d)" % (job.cmd, job.returncode))
 			return False
-
-	def run_command(self, opts, input):
-		"""Run the command to generate the block."""
-		if self.meta.cmd:
-			return self.run(self.meta.cmd, opts, input)
 		else:
-			i = 0
-			while i < len(self.meta.cmds):
-				res = self.run(self.meta.cmds[i], opts, input)
-				if res:
-					break
-				else:
-					i = i + 1
-			if self.meta.cmd:
-				return res
-			else:
-				self.meta.cmd = ""
-				self.onWarning("cannot generate %s block: none of commands %s is available." % (self.meta.name, ", ".join(self.meta.cmds)))
-				return False
+			return True
 	
 	def make_input(self, input):
 		"""Prepare input. As a default, do nothing."""
 		pass
 			
-	def gen(self, gen):
+	def make_key(self, gen, store):
+		"""Build the key identifying the result of the block in the cache.
+		As a default, it is made of the candidate commands, the output type,
+		the options, the text of the block and the files named in the text."""
+		text = self.toText()
+		return store.make_key(self.meta.cmds, self.meta.name, gen.getType(),
+			",".join(["%s=%s" % (opt.name, val) for (opt, val) in self.args]),
+			text, inputs = text)
+
+	def pregen(self, gen):
+		gen.prepare_job(self)
+
+	def make_job(self, gen):
 		if not self.is_ready():
-			return
+			return None
+		store = cache.get(gen.doc)
+		key = self.make_key(gen, store)
+		if store.fetch(key, self.meta.ext, self.get_path(gen)):
+			return jobs.Job(None, path = self.get_path(gen))
 		opts = []
 		input = []
 		self.prepare_input(gen, opts, input)
 		self.make_input(input)
 		self.make_options(opts, input)
-		if self.run_command(opts, input):
+		if self.meta.cmd:
+			cmds = [self.meta.cmd]
+		else:
+			cmds = self.meta.cmds
+		return ExternalJob(cmds, " ".join(opts), "".join(input), self.get_path(gen), key)
+
+	def gen(self, gen):
+		if not self.is_ready():
+			return
+		job = gen.get_job(self)
+		if job.cmd == None:
+			self.gen_output(gen)
+		elif self.check_job(job):
 			self.finalize_output(gen)
+			cache.get(gen.doc).store(job.key, self.meta.ext, self.get_path(gen))
 			self.gen_output(gen)
 
 	def numbering(self):
@@ -14,12 +14,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import glob
 import os.path
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
 
+import thot.cache as cache
 import thot.doc as doc
 import thot.common as common
+import thot.jobs as jobs
+
+try:
+	import pygments
+	import pygments.formatters
+	import pygments.lexers
+	import pygments.util
+except ImportError as e:
+	pygments = None
 
 LANGS=[
   '4gl',
@@ -160,10 +174,16 @@ DOCBOOK_LANGS = {
 
 CSS_BACKS = [ 'html', 'xhtml' ]
 
+BATCH_SIZE = 256
+
+HIGHLIGHT = "highlight"
+PYGMENTS = "pygments"
+
 unsupported = []
 unsupported_backs = []
 checked = False
 command = None
+engines = { }
 
 def getCommand():
 	global command
@@ -181,15 +201,174 @@ def getCommand():
 	return command
 	
 
-def genCode(gen, lang, text, type, line):
+def getEngine(doc):
+	"""Get the engine used to colorize the code: HIGHLIGHT (highlight
+	command) or PYGMENTS (in-process Pygments library). The engine is
+	selected by the HIGHLIGHT_ENGINE variable. As a default, highlight
+	command is used: Pygments is only used if HIGHLIGHT_ENGINE is
+	"pygments" as it changes the generated files."""
+	name = doc.getVar("HIGHLIGHT_ENGINE")
+	try:
+		return engines[name]
+	except KeyError:
+		engine = name
+		if engine == PYGMENTS and pygments == None:
+			common.onWarning("Pygments is not available: using highlight command.")
+			engine = HIGHLIGHT
+		elif engine not in [HIGHLIGHT, PYGMENTS]:
+			if engine:
+				common.onWarning("unknown highlight engine %s: ignoring it." % engine)
+			engine = HIGHLIGHT
+		engines[name] = engine
+		return engine
+
+
+def pygmentize(lang, type, line, text, memo):
+	"""Colorize code using Pygments. Results are memoized to tokenize
+	only once repeated codes. Return None if the language or the
+	back-end is not supported.
+	lang -- code language
+	type -- back-end type
+	line -- first line number (None for no numbering)
+	text -- code text
+	memo -- dictionary of the results of the generation"""
+	key = (lang, type, line, text)
+	try:
+		return memo[key]
+	except KeyError:
+		pass
+	try:
+		lexer = pygments.lexers.get_lexer_by_name(lang)
+	except pygments.util.ClassNotFound:
+		lexer = None
+	res = None
+	if lexer == None:
+		pass
+	elif type == 'html':
+		res = pygments.highlight(text, lexer,
+			pygments.formatters.HtmlFormatter(nowrap = True))
+		if res.endswith("\n"):
+			res = res[:-1]
+		if line != None:
+			res = "\n".join(['<span class="linenos">%4d </span>%s' % (line + i, l)
+				for (i, l) in enumerate(res.split("\n"))])
+	elif type == 'latex':
+		if line == None:
+			formatter = pygments.formatters.LatexFormatter()
+		else:
+			formatter = pygments.formatters.LatexFormatter(linenos = True, linenostart = line)
+		res = pygments.highlight(text, lexer, formatter)
+	memo[key] = res
+	return res
+
+
+def makeJob(gen, lang, text, line):
+	"""Build the job colorizing the given code.
+	Return None if the code cannot be colorized.
+	gen -- back-end generator
+	lang -- code language
+	text -- code text
+	line -- first line number (None for no numbering)"""
+	type = gen.getType()
+	if lang not in LANGS or type not in BACKS:
+		return None
+	if getEngine(gen.doc) != HIGHLIGHT:
+		return None
+	command = getCommand()
+	if not command:
+		return None
+	opts = ""
+	if line != None:
+		opts = opts + " -l"
+		if line != 1:
+			opts = opts + " -m %s" % line
+	return jobs.Job('%s -f --syntax=%s %s %s' % (command, lang, BACKS[type], opts), text)
+
+
+class Batch(jobs.Job):
+	"""Job colorizing in one call of highlight the code of several jobs
+	using the same command. The codes are written to temporary files
+	and highlight is called in batch mode. The jobs whose output
+	cannot be retrieved are run alone."""
+	members = None
+
+	def __init__(self, cmd):
+		jobs.Job.__init__(self, cmd)
+		self.members = []
+
+	def add(self, job):
+		"""Add a job to the batch."""
+		job.batch = self
+		self.members.append(job)
+
+	def run(self):
+		dir = tempfile.mkdtemp(prefix = "thot-highlight-")
+		try:
+			ins = []
+			for i in range(0, len(self.members)):
+				path = os.path.join(dir, "code-%d.txt" % i)
+				with open(path, "w", encoding = "utf-8") as file:
+					file.write(self.members[i].input)
+				ins.append(shlex.quote(path))
+			out = os.path.join(dir, "out")
+			os.mkdir(out)
+			cmd = self.cmd
+			self.cmd = "%s -q -O %s %s" % (cmd, shlex.quote(out), " ".join(ins))
+			jobs.Job.run(self)
+			self.cmd = cmd
+			for i in range(0, len(self.members)):
+				paths = glob.glob(os.path.join(out, "code-%d.txt.*" % i))
+				if len(paths) == 1:
+					with open(paths[0], "rb") as file:
+						self.members[i].out = file.read()
+					self.members[i].returncode = 0
+		except OSError as e:
+			self.error = str(e)
+		finally:
+			shutil.rmtree(dir, ignore_errors = True)
+
+
+def getLangs(gen, command):
+	"""Get the list of languages supported by the highlight command.
+	The list is recorded in the cache to avoid calling highlight
+	at each generation. Return None if the list cannot be obtained."""
+	store = cache.get(gen.doc)
+	key = store.make_key(command, "langs")
+	text = store.load(key, ".langs")
+	if text != None:
+		return text.split()
+	try:
+		ans = subprocess.check_output("%s -p" % command, shell = True).decode('utf-8')
+	except subprocess.CalledProcessError as e:
+		return None
+	langs = []
+	for line in ans.split("\n"):
+		try:
+			p = line.index(":")
+			if p >= 0:
+				line = line[p+1:]
+				for w in line.split():
+					if w != '(' and w != ')':
+						langs.append(w)
+		except ValueError as e:
+			pass
+	store.save(key, ".langs", "\n".join(langs))
+	return langs
+
+
+def genCode(gen, lang, text, type, line, job = None):
 	"""Generate colorized code.
 	gen -- back-end generator
 	lang -- code language
-	lines -- lines of the code"""
-	global COMMAND
-	
+	lines -- lines of the code
+	job -- job colorizing the code (if already built)"""
 	type = gen.getType()
-	if lang in LANGS and type in BACKS:
+	if getEngine(gen.doc) == PYGMENTS:
+		res = pygmentize(lang, type, line, text, gen.get_state("highlight", dict))
+		if res != None:
+			gen.genVerbatim(res)
+			return
+	elif lang in LANGS and type in BACKS:
 		command = getCommand()
 		
 		# default behaviour if no command
@@ -202,72 +381,75 @@ def genCode(gen, lang, text, type, line):
 				gen.genVerbatim("\n\\end{verbatim}\n")
 			return
 		
-		# other options
-		opts = ""
-		if line != None:
-			opts = opts + " -l"
-			if line != 1:
-				opts = opts + " -m %s" % line
-		
 		# perform the command
-		try:
-			cfd = True
-			if os.name == "nt":
-				cfd = False
-			process = subprocess.Popen(
-				['%s -f --syntax=%s %s %s' % (command, lang, BACKS[type], opts)],
-				stdin = subprocess.PIPE,
-				stdout = subprocess.PIPE,
-				close_fds = cfd,
-				shell = True
-			)
-			res, _ = process.communicate(text.encode('utf-8'))
-			
-			# generate the source
-			gen.genVerbatim(res.decode('utf-8'))
+		if job == None:
+			job = makeJob(gen, lang, text, line)
+		job.wait()
+		if job.error != None:
+			common.onError("can not call 'highlight'")
 			
-		except OSError as e:
-			sys.stderr.write("ERROR: can not call 'highlight'\n")
-			sys.exit(1)
-	else:
-		if lang and lang not in LANGS and lang not in unsupported:
-			sys.stderr.write('WARNING: ' + lang + ' unsupported highglight language\n')
-			unsupported.append(lang)
-		if gen.getType() not in BACKS and gen.getType() not in unsupported_backs:
-			sys.stderr.write('WARNING: ' + gen.getType() + ' unsupported highlight back-end\n')
-			unsupported_baks.append(lang)
-		if type == 'latex':
-			gen.genVerbatim('\\begin{verbatim}\n')
-		gen.genText(text)
-		if type == 'latex':
-			gen.genVerbatim('\\end{verbatim}\n\n')
+		# generate the source
+		gen.genVerbatim(job.out.decode('utf-8'))
+		return
+
+	# unsupported language or back-end
+	if lang and (lang not in LANGS or getEngine(gen.doc) == PYGMENTS) and lang not in unsupported:
+		sys.stderr.write('WARNING: ' + lang + ' unsupported highglight language\n')
+		unsupported.append(lang)
+	if gen.getType() not in BACKS and gen.getType() not in unsupported_backs:
+		sys.stderr.write('WARNING: ' + gen.getType() + ' unsupported highlight back-end\n')
+		unsupported_backs.append(gen.getType())
+	if type == 'latex':
+		gen.genVerbatim('\\begin{verbatim}\n')
+	gen.genText(text)
+	if type == 'latex':
+		gen.genVerbatim('\\end{verbatim}\n\n')
 
 
 class Feature(doc.Feature):
 
+	def preparePygments(self, gen):
+		"""Build the style files for Pygments engine."""
+		type = gen.getType()
+		if type in CSS_BACKS:
+			css = gen.new_friend('highlight/highlight.css')
+			formatter = pygments.formatters.HtmlFormatter()
+			with open(css, "w") as out:
+				out.write(formatter.get_style_defs("pre.code"))
+				out.write("\n")
+			styles = gen.doc.getVar('HTML_STYLES')
+			if styles:
+				styles += ':'
+			styles += css
+			gen.doc.setVar('HTML_STYLES', styles)
+		elif type == 'latex':
+			css = gen.new_friend('highlight/highlight.sty')
+			formatter = pygments.formatters.LatexFormatter()
+			with open(css, "w") as out:
+				out.write(formatter.get_style_defs())
+				out.write("\n")
+			preamble = gen.doc.getVar('LATEX_PREAMBLE')
+			preamble += '\\usepackage{color}\n'
+			preamble += '\\usepackage{fancyvrb}\n'
+			preamble += '\\input {%s}\n' % css
+			gen.doc.setVar('LATEX_PREAMBLE', preamble)
+
 	def prepare(self, gen):
 		type = gen.getType()
+		if getEngine(gen.doc) == PYGMENTS:
+			self.preparePygments(gen)
+			return
 		command = getCommand()
 		if not command:
 			return
 			
-		# parse list of languages
-		try:
-			global LANGS
-			ans = subprocess.check_output("%s -p" % command, shell = True).decode('utf-8')
-			LANGS = []
-			for line in ans.split("\n"):
-				try:
-					p = line.index(":")
-					if p >= 0:
-						line = line[p+1:]
-						for w in line.split():
-							if w != '(' and w != ')':
-								LANGS.append(w)
-				except ValueError as e:
-					pass
-		except subprocess.CalledProcessError as e :
+		# get list of languages
+		global LANGS
+		langs = getLangs(gen, command)
+		if langs == None:
 			common.onWarning("cannot get supported languages from %s, falling back to default list." % command)
+		else:
+			LANGS = langs
 		
 		# build the CSS file
 		if type in CSS_BACKS:
@@ -285,8 +467,7 @@ class Feature(doc.Feature):
 				)
 				_ = process.communicate("")
 			except OSError as e:
-				sys.stderr.write("ERROR: can not call 'highlight'\n")
-				sys.exit(1)
+				common.onError("can not call 'highlight'")
 
 			# add the file to the style
 			styles = gen.doc.getVar('HTML_STYLES')
@@ -308,8 +489,7 @@ class Feature(doc.Feature):
 				)
 				_ = process.communicate("")
 			except OSError as e:
-				sys.stderr.write("ERROR: can not call 'highlight'\n")
-				sys.exit(1)
+				common.onError("can not call 'highlight'")
 
 			# build the preamble
 			preamble = gen.doc.getVar('LATEX_PREAMBLE')
@@ -318,6 +498,31 @@ class Feature(doc.Feature):
 			preamble += '\\input {%s}\n' % css
 			gen.doc.setVar('LATEX_PREAMBLE', preamble)
 
+	def complete(self, gen):
+
+		# group the jobs of code blocks by command
+		groups = { }
+		for node, job in gen.jobs.items():
+			if isinstance(node, CodeBlock) and job != None and not job.is_done():
+				try:
+					groups[job.cmd].append(job)
+				except KeyError:
+					groups[job.cmd] = [job]
+
+		# submit them as batches
+		pool = gen.get_pool()
+		for cmd, group in groups.items():
+			if len(group) == 1:
+				continue
+			for i in range(0, len(group), BATCH_SIZE):
+				batch = Batch(cmd)
+				for job in group[i:i + BATCH_SIZE]:
+					batch.add(job)
+				pool.submit(batch)
+		for group in groups.values():
+			if len(group) == 1:
+				pool.submit(group[0])
+
 
 FEATURE = Feature()
 
@@ -333,26 +538,37 @@ class CodeBlock(doc.Block):
 	def dumpHead(self, tab):
 		print(tab + "code(" + self.lang + ",")
 
-	def gen(self, gen):
-
-		# aggregate code
+	def getCode(self):
+		"""Get the code as text."""
 		text = ""
 		for line in self.content:
 			if text != "":
 				text += '\n'
 			text += line
+		return text
+
+	def pregen(self, gen):
+		gen.prepare_job(self, False)
+
+	def make_job(self, gen):
+		return makeJob(gen, self.lang, self.getCode(), self.line_number)
+
+	def gen(self, gen):
+
+		# aggregate code
+		text = self.getCode()
 
 		# generate the code
 		type = gen.getType()
 		if type == 'html':
 			gen.genEmbeddedBegin(self)
 			gen.genVerbatim('<pre class="code">\n')
-			genCode(gen, self.lang, text, type, self.line_number)
+			genCode(gen, self.lang, text, type, self.line_number, gen.get_job(self))
 			gen.genVerbatim('</pre>')
 			gen.genEmbeddedEnd(self)
 		elif type == 'latex':
 			gen.genEmbeddedBegin(self)
-			genCode(gen, self.lang, text, type, self.line_number)
+			genCode(gen, self.lang, text, type, self.line_number, gen.get_job(self))
 			gen.genEmbeddedEnd(self)
 		elif type == 'docbook':
 			gen.genVerbatim('<programlisting xml:space="preserve" ')
@@ -0,0 +1,217 @@
+# incremental -- Thot incremental generation
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Support for incremental generation of back-ends producing several
+pages.
+
+For each page, a fingerprint is computed from the nodes generated in
+the page (including their labels, their references and the references
+they point to) and from the context of the page (table of content,
+template). This fingerprint is recorded, with the variables and the
+friend files used to generate the page, in a state file of the import
+directory. At the next generation, a page is only generated again if
+its fingerprint, the value of one of its variables or one of its friend
+files changed. Else the page file is left untouched.
+
+The following variables are supported:
+* THOT_INCREMENTAL -- "yes" to enable incremental generation (option
+  --incremental).
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+import thot.common as common
+import thot.doc as doc
+
+VERSION = "1"
+STATE_FILE = "incremental.json"
+
+
+class Fingerprint:
+	"""Structural hash of document nodes as seen by a generator."""
+	gen = None
+	hash = None
+
+	def __init__(self, gen):
+		self.gen = gen
+		self.hash = hashlib.sha256()
+		self.hash.update(VERSION.encode("utf-8"))
+
+	def add(self, *items):
+		"""Add simple items (strings, numbers, etc) to the fingerprint."""
+		for item in items:
+			self.hash.update(b"\0")
+			self.hash.update(str(item).encode("utf-8"))
+
+	def addValue(self, val):
+		"""Add an attribute value to the fingerprint."""
+		if val == None or isinstance(val, (str, int, float, bool)):
+			self.add(repr(val))
+		elif isinstance(val, (list, tuple)):
+			self.add("[")
+			for item in val:
+				self.addValue(item)
+			self.add("]")
+		elif isinstance(val, dict):
+			self.add("{")
+			for key in sorted(val.keys(), key = repr):
+				self.addValue(key)
+				self.addValue(val[key])
+			self.add("}")
+		elif isinstance(val, (set, frozenset)):
+			self.add("{", *sorted([repr(item) for item in val]), "}")
+		elif isinstance(val, doc.Document):
+			self.add("<document>")
+		elif isinstance(val, doc.Node):
+			self.addNode(val)
+		else:
+			self.add("<%s>" % val.__class__.__name__)
+
+	def addNode(self, node):
+		"""Add a node and its sub-nodes to the fingerprint."""
+		self.add("(", node.__class__.__module__, node.__class__.__name__)
+		for (name, val) in sorted(doc.get_attrs(node).items()):
+			if name not in ["file", "line"]:
+				self.add(name)
+				self.addValue(val)
+		self.add(self.gen.doc.getLabelFor(node))
+		self.addRef(node)
+		job = self.gen.jobs.get(node)
+		if job != None:
+			self.add(job.path)
+		if isinstance(node, doc.Ref):
+			self.addRef(self.gen.doc.getLabel(node.label))
+		self.add(")")
+
+	def addRef(self, node):
+		"""Add the reference (anchor, number) of a node, if any."""
+		try:
+			self.add(*self.gen.refs[node])
+		except (KeyError, TypeError):
+			self.add(None)
+
+	def addTOC(self, node):
+		"""Add the table of content below the given node."""
+		for child in node.getContent():
+			if child.getHeaderLevel() >= 0:
+				self.add(child.getHeaderLevel())
+				self.addRef(child)
+				self.addValue(child.title)
+				self.addTOC(child)
+
+	def addFile(self, path):
+		"""Add the modification time of a file."""
+		try:
+			st = os.stat(path)
+			self.add(path, st.st_size, st.st_mtime)
+		except OSError:
+			self.add(path)
+
+	def get(self):
+		"""Get the fingerprint as a string."""
+		return self.hash.hexdigest()
+
+
+class State:
+	"""Generation state of the pages of a document."""
+	gen = None
+	path = None
+	pages = None
+	current = None
+
+	def __init__(self, gen):
+		self.gen = gen
+		self.path = os.path.join(gen.getImportDir(), STATE_FILE)
+		self.pages = { }
+		try:
+			with open(self.path, encoding = "utf-8") as file:
+				state = json.load(file)
+			if state["version"] == VERSION:
+				self.pages = state["pages"]
+		except (OSError, ValueError, KeyError):
+			pass
+
+	def fingerprint(self):
+		"""Build a fingerprint."""
+		return Fingerprint(self.gen)
+
+	def is_unchanged(self, path, fingerprint):
+		"""Test if the page with the given path and fingerprint does not
+		need to be generated. In this case, the friend files used
+		by the page are declared again to the generator."""
+		try:
+			page = self.pages[path]
+		except KeyError:
+			return False
+		if page["fingerprint"] != fingerprint or not os.path.exists(path):
+			return False
+		for (id, val) in page["vars"].items():
+			if self.gen.doc.getVar(id) != val:
+				return False
+		for friend in page["friends"]:
+			if friend[0] == "use":
+				if self.gen.use_friend(friend[1], friend[2]) != friend[3]:
+					return False
+			elif friend[1] in self.gen.to_files or not os.path.exists(friend[1]):
+				return False
+			else:
+				self.gen.to_files[friend[1]] = ""
+				self.gen.addFile(friend[1])
+		return True
+
+	def begin(self):
+		"""Called before the generation of a page to record
+		the used variables and friend files."""
+		self.gen.doc.used_vars = set()
+		self.gen.friend_log = []
+
+	def end(self, path, fingerprint):
+		"""Called after the generation of a page."""
+		self.pages[path] = {
+			"fingerprint": fingerprint,
+			"vars": dict([(id, self.gen.doc.getVar(id)) for id in self.gen.doc.used_vars]),
+			"friends": self.gen.friend_log
+		}
+		self.gen.doc.used_vars = None
+		self.gen.friend_log = None
+
+	def save(self):
+		"""Save the state."""
+		dpath = os.path.dirname(self.path)
+		try:
+			os.makedirs(dpath, exist_ok = True)
+			fd, tmp = tempfile.mkstemp(dir = dpath)
+			with os.fdopen(fd, "w", encoding = "utf-8") as file:
+				json.dump({ "version": VERSION, "pages": self.pages }, file)
+			os.replace(tmp, self.path)
+		except OSError as e:
+			common.onWarning("cannot save incremental state: %s" % e)
+
+
+def get(gen):
+	"""Get the incremental state for the given generator. Return None
+	if incremental generation is not enabled: in this case, any state
+	is removed as the generated pages will not match it anymore."""
+	if gen.doc.getVar("THOT_INCREMENTAL") == "yes":
+		return State(gen)
+	path = os.path.join(gen.getImportDir(), STATE_FILE)
+	if os.path.exists(path):
+		os.remove(path)
+	return None
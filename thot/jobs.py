@@ -0,0 +1,132 @@
+# jobs -- Thot external command jobs
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Support for the execution of external commands (dot, gnuplot,
+highlight, etc) as jobs.
+
+Jobs are built by the document nodes during the pre-generation phase
+and submitted to a pool of workers whose size is given by the THOT_JOBS
+variable (option -j). The generation phase then waits for the job
+results. With a pool of size 1, the jobs are simply run, in order,
+when their result is required.
+
+As the jobs spend their time waiting for external processes, the
+workers are threads."""
+
+import concurrent.futures
+import os
+import os.path
+import subprocess
+
+import thot.common as common
+
+
+class Job:
+	"""A job is a command run in a shell to which an input text
+	is passed. Once run, out and err contain the output and error
+	streams of the command, returncode its return code and, if the
+	command cannot be launched at all, error contains the error message.
+
+	A job without command (None) is considered as already done:
+	it is used to represent results available without running any
+	command (for example, found in the cache).
+
+	The path and key attributes are free for the job users (usually
+	path of the produced file and its cache key). The directory of path
+	is created before running the command.
+
+	A job may also be part of a batch, a job that runs the commands of
+	several jobs in one process. Such a job is not submitted alone to
+	the pool: it is run by its batch."""
+	cmd = None
+	input = None
+	path = None
+	key = None
+	out = b""
+	err = b""
+	returncode = None
+	error = None
+	future = None
+	batch = None
+
+	def __init__(self, cmd, input = None, path = None, key = None):
+		self.cmd = cmd
+		self.input = input
+		self.path = path
+		self.key = key
+		if cmd == None:
+			self.returncode = 0
+
+	def is_done(self):
+		"""Test if the job has been run."""
+		return self.returncode != None or self.error != None
+
+	def run(self):
+		"""Run the command of the job."""
+		common.onVerbose(lambda _: "CMD: %s" % self.cmd)
+		input = None
+		if self.input != None:
+			input = self.input.encode('utf-8')
+		try:
+			if self.path and os.path.dirname(self.path):
+				os.makedirs(os.path.dirname(self.path), exist_ok = True)
+			process = subprocess.Popen(
+				self.cmd,
+				stdin = subprocess.PIPE,
+				stdout = subprocess.PIPE,
+				stderr = subprocess.PIPE,
+				close_fds = True,
+				shell = True
+			)
+			(self.out, self.err) = process.communicate(input)
+			self.returncode = process.returncode
+		except OSError as e:
+			self.error = str(e)
+
+	def wait(self):
+		"""Wait for the end of the job (running it if it has not been
+		submitted to a pool). If the job is part of a batch that did not
+		produce its result, the job is run alone. Return the job itself."""
+		if self.batch != None and not self.is_done():
+			self.batch.wait()
+		if self.future != None:
+			self.future.result()
+		elif not self.is_done():
+			self.run()
+		return self
+
+
+class Pool:
+	"""Pool of workers running the jobs."""
+	size = None
+	executor = None
+
+	def __init__(self, size = 1):
+		self.size = size
+		if size > 1:
+			self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = size)
+
+	def submit(self, job):
+		"""Submit a job to the pool. If the pool has only one worker,
+		the job will be run when its result is required."""
+		if self.executor != None and job.batch == None and not job.is_done():
+			job.future = self.executor.submit(job.run)
+
+	def shutdown(self):
+		"""Wait for all jobs and release the workers."""
+		if self.executor != None:
+			self.executor.shutdown()
+			self.executor = None
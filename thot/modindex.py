@@ -0,0 +1,297 @@
+# modindex -- Thot index of available modules
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Index of the modules (or back-ends) of a directory.
+
+The index records the description of the modules (short description,
+syntax, outputs, etc) found by reading their source, without executing
+them. It is used to list the available modules and their syntax.
+Executing a module is only needed when a document uses it.
+
+The index of a directory is stored in the cache (THOT_CACHE) and
+rebuilt for the modules whose file size or modification time changed.
+
+The entry of a module is a dictionary with the following keys:
+* name -- name of the module,
+* path -- path of the module file,
+* short -- short description (or None),
+* description -- description (or None),
+* init -- True if the module defines an init function,
+* syntax -- True if the module defines a new syntax (__syntax__),
+* words, lines -- list of pairs (RE, description) of the syntax,
+* outputs -- map of output type to list of pairs (form, description),
+* complete -- False if some information can only be obtained by
+  executing the module (computed values, __syntaxes__, etc).
+"""
+
+import ast
+import json
+import os
+import os.path
+
+import thot.cache as cache
+import thot.common as common
+
+VERSION = "1"
+
+indexes = { }
+
+
+def literal(node, consts = None):
+	"""Get the value of an AST expression if it is a literal. The
+	expression may also refer to names of consts (a dictionary of
+	the literal globals of the module) and concatenate or format
+	literal values. Raise ValueError else."""
+	if isinstance(node, ast.Name):
+		if consts == None or node.id not in consts:
+			raise ValueError("unknown name %s" % node.id)
+		return consts[node.id]
+	elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Mod)):
+		left = literal(node.left, consts)
+		right = literal(node.right, consts)
+		try:
+			if isinstance(node.op, ast.Add):
+				return left + right
+			else:
+				return left % right
+		except (TypeError, ValueError) as e:
+			raise ValueError(str(e))
+	elif isinstance(node, (ast.List, ast.Tuple)):
+		items = [literal(item, consts) for item in node.elts]
+		return items if isinstance(node, ast.List) else tuple(items)
+	else:
+		return ast.literal_eval(node)
+
+
+def get_syntax(node, consts = None):
+	"""Get the list of pairs (RE, description) from the AST of
+	__words__ or __lines__ definition. The items whose RE or
+	description is not a literal are ignored. Return the list
+	and a boolean set to False if some items has been ignored."""
+	if not isinstance(node, (ast.List, ast.Tuple)):
+		raise ValueError("not a list")
+	syntax = []
+	complete = True
+	for item in node.elts:
+		try:
+			if not isinstance(item, ast.Tuple) or len(item.elts) < 3:
+				raise ValueError("not a syntax item")
+			syntax.append((literal(item.elts[1], consts), literal(item.elts[2], consts)))
+		except ValueError:
+			complete = False
+	return (syntax, complete)
+
+
+def forget(node, consts):
+	"""Remove from consts the names whose value may be changed by
+	the given statement."""
+	for n in ast.walk(node):
+		if isinstance(n, ast.Name) and not isinstance(n.ctx, ast.Load):
+			consts.pop(n.id, None)
+		elif isinstance(n, ast.Global):
+			for id in n.names:
+				consts.pop(id, None)
+
+
+def scan(name, path):
+	"""Build the entry of a module from its source."""
+	entry = {
+		"name": name,
+		"path": path,
+		"short": None,
+		"description": None,
+		"init": False,
+		"syntax": False,
+		"words": [],
+		"lines": [],
+		"outputs": { },
+		"complete": True
+	}
+	consts = { }
+	with open(path, "rb") as file:
+		tree = ast.parse(file.read(), path)
+	for node in tree.body:
+		if isinstance(node, ast.FunctionDef) and node.name == "init":
+			entry["init"] = True
+		if not isinstance(node, ast.Assign):
+			forget(node, consts)
+			continue
+		for target in node.targets:
+			if not isinstance(target, ast.Name):
+				forget(target, consts)
+				continue
+			id = target.id
+			try:
+				if id in ("__short__", "__description__"):
+					entry[id[2:-2]] = consts[id] = literal(node.value, consts)
+				elif id in ("__words__", "__lines__"):
+					(entry[id[2:-2]], complete) = get_syntax(node.value, consts)
+					if not complete:
+						entry["complete"] = False
+				elif id == "__syntax__":
+					entry["syntax"] = True
+				elif id == "__syntaxes__":
+					entry["complete"] = False
+				elif id.startswith("__") and id.endswith("__") \
+				and id[2:-2] in ("html", "latex", "docbook"):
+					entry["outputs"][id[2:-2]] = [(f, d) for (f, d) in literal(node.value, consts)]
+				else:
+					consts[id] = literal(node.value, consts)
+			except ValueError:
+				if id.startswith("__"):
+					entry["complete"] = False
+				elif id in consts:
+					del consts[id]
+	return entry
+
+
+class Index:
+	"""Index of the modules of a directory."""
+	dir = None
+	entries = None
+	stamps = None
+
+	def __init__(self, dir):
+		self.dir = dir
+		self.entries = { }
+		self.stamps = { }
+
+	def update(self):
+		"""Update the index with the current content of the directory.
+		Return True if the index has been changed."""
+		changed = False
+		found = set()
+		try:
+			files = os.listdir(self.dir)
+		except OSError:
+			files = []
+		for file in files:
+			(name, ext) = os.path.splitext(file)
+			if ext != ".py" or file.startswith("__"):
+				continue
+			path = os.path.join(self.dir, file)
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			found.add(name)
+			stamp = [st.st_size, st.st_mtime]
+			if self.stamps.get(name) == stamp:
+				continue
+			try:
+				self.entries[name] = scan(name, path)
+			except (OSError, SyntaxError, ValueError) as e:
+				common.onVerbose(lambda _: "cannot index %s: %s" % (path, e))
+				self.entries[name] = { "name": name, "path": path, "complete": False }
+			self.stamps[name] = stamp
+			changed = True
+		for name in list(self.entries.keys()):
+			if name not in found:
+				del self.entries[name]
+				del self.stamps[name]
+				changed = True
+		return changed
+
+	def load(self, text):
+		"""Load the index from its JSON text."""
+		try:
+			data = json.loads(text)
+			if data["version"] == VERSION:
+				self.entries = data["entries"]
+				self.stamps = data["stamps"]
+		except (ValueError, KeyError, TypeError):
+			pass
+
+	def save(self):
+		"""Get the JSON text of the index."""
+		return json.dumps({
+			"version": VERSION,
+			"entries": self.entries,
+			"stamps": self.stamps
+		})
+
+
+def get(doc, dir):
+	"""Get the up-to-date index of the given directory."""
+	dir = os.path.abspath(dir)
+	try:
+		index = indexes[dir]
+		index.update()
+		return index
+	except KeyError:
+		pass
+	index = Index(dir)
+	store = cache.get(doc)
+	key = store.make_key([], "modindex", dir)
+	if key != None:
+		text = store.load(key, ".json")
+		if text != None:
+			index.load(text)
+	if index.update() and key != None:
+		store.save(key, ".json", index.save())
+	indexes[dir] = index
+	return index
+
+
+def get_entries(doc, paths):
+	"""Get the entries of the modules found in the given paths
+	(separated by ':'). The first module of a given name hides
+	the following ones."""
+	entries = { }
+	for dir in paths.split(":"):
+		if dir:
+			for (name, entry) in get(doc, dir).entries.items():
+				if name not in entries:
+					entries[name] = entry
+	return [entries[name] for name in sorted(entries.keys())]
+
+
+def find(doc, name, paths):
+	"""Find the entry of a module in the given paths (separated by ':').
+	Return None if the module cannot be found."""
+	for dir in paths.split(":"):
+		if dir:
+			entry = get(doc, dir).entries.get(name)
+			if entry != None:
+				return entry
+	return None
+
+
+def describe(mod):
+	"""Build the entry of a module from the executed module (used
+	when the entry of the index is not complete). The entry has an
+	additional key, syntaxes, with the list of pairs (syntax,
+	description) of the __syntaxes__ of the module."""
+	entry = {
+		"name": common.module_name(mod),
+		"path": getattr(mod, "__file__", None),
+		"short": mod.__dict__.get("__short__"),
+		"description": mod.__dict__.get("__description__"),
+		"init": "init" in mod.__dict__,
+		"syntax": "__syntax__" in mod.__dict__,
+		"words": [(w[1], w[2]) for w in mod.__dict__.get("__words__", [])],
+		"lines": [(l[1], l[2]) for l in mod.__dict__.get("__lines__", [])],
+		"outputs": { },
+		"syntaxes": [],
+		"complete": True
+	}
+	for out in ["html", "latex", "docbook"]:
+		name = "__%s__" % out
+		if name in mod.__dict__:
+			entry["outputs"][out] = mod.__dict__[name]
+	for s in mod.__dict__.get("__syntaxes__", []):
+		entry["syntaxes"] = entry["syntaxes"] + s.get_doc()
+	return entry
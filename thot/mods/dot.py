@@ -15,15 +15,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
-import subprocess
 import sys
 
+import thot.cache as cache
 import thot.common as common
 import thot.doc as doc
+import thot.jobs as jobs
 import thot.tparser as tparser
 
-count = 0
-
 class DotBlock(doc.Block):
 	"""A block containing .dot graph.
 	See http://www.graphviz.org/ for more details."""
@@ -39,31 +38,32 @@ class DotBlock(doc.Block):
 	def dumpHead(self, tab):
 		print("%sblock.dot(" % tab)
 
-	def gen(self, gen):
-		global count
-		path = gen.new_friend('dot/graph-%s.png' % count)
+	def pregen(self, gen):
+		gen.prepare_job(self)
+
+	def make_job(self, gen):
+		path = gen.new_friend('dot/graph-%s.png' % gen.new_count("dot"), False)
+		store = cache.get(gen.doc)
+		text = self.toText()
+		key = store.make_key(self.kind, "-Tpng", text, inputs = text)
+		if store.fetch(key, ".png", path):
+			return jobs.Job(None, path = path)
 		cmd = '%s -Tpng -o %s' % (self.kind, path)
-		common.onVerbose(lambda _: "CMD: %s" % cmd)
-		count += 1
-		try:
-			process = subprocess.Popen(
-				[cmd],
-					stdin = subprocess.PIPE,
-					stdout = subprocess.PIPE,
-					stderr = subprocess.PIPE,
-					close_fds = True,
-					shell = True
-				)
+		return jobs.Job(cmd, self.toText(), path, key)
+
+	def gen(self, gen):
+		job = gen.get_job(self)
+		if job.cmd != None:
+			if job.error != None:
+				self.onError('can not process dot graph: %s' % job.error)
 			text = self.toText()
-			(out, err) = process.communicate(text.encode('utf-8'))
-			if process.returncode:
-				sys.stderr.write(err)
+			if job.returncode:
+				sys.stderr.write(job.err.decode('utf-8'))
 				self.onError('error during dot call on %s' % text)
-			if err:
-				self.onError('error during dot call: %son %s' % (err, text))
-			gen.genFigure(path, self, self.caption)
-		except OSError as e:
-			self.onError('can not process dot graph: %s' % str(e))
+			if job.err:
+				self.onError('error during dot call: %son %s' % (job.err, text))
+			cache.get(gen.doc).store(job.key, ".png", job.path)
+		gen.genFigure(job.path, self, self.caption)
 
 	def kind(self):
 		return "figure"
@@ -75,6 +75,7 @@ class Source:
 		"""Add a code documentation entry."""
 		if ref == None:
 			self.ref = os.path.dirname(ref)
+		self.man.addDependency(path)
 		read_tags(path, self.map, sep, ref)
 
 	def resolve(self, word):
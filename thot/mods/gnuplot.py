@@ -15,14 +15,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
-import subprocess
 import sys
 
+import thot.cache as cache
 import thot.common as common
 import thot.doc as doc
+import thot.jobs as jobs
 import thot.tparser as tparser
 
-count = 0
 has_gnuplot = True
 
 class GnuPlotBlock(doc.Block):
@@ -39,46 +39,54 @@ class GnuPlotBlock(doc.Block):
 	def dumpHead(self, tab):
 		print("%sblock.gnuplot(" % tab)
 
-	def gen(self, gen):
-		
-		# gnuplot exists ?
-		global count
-		global has_gnuplot
-		if not has_gnuplot:
-			return
-		
+	def pregen(self, gen):
+		gen.prepare_job(self)
+
+	def make_job(self, gen):
 		# prepare the size
 		opt = ""
 		if self.w:
 			if not self.h:
 				self.h = self.w
 			opt = "size %s,%s"  % (self.w, self.h)
+
+		# look in the cache
+		path = gen.new_friend('gnuplot/graph-%s.png' % gen.new_count("gnuplot"), False)
+		text = self.toText()
+		store = cache.get(gen.doc)
+		key = store.make_key("gnuplot", opt, text, inputs = text)
+		if store.fetch(key, ".png", path):
+			return jobs.Job(None, path = path)
+
+		# build the job
+		return jobs.Job('gnuplot',
+			"set terminal png transparent %s crop\nset output \"%s\"\n%s" % (opt, path, text),
+			path, key)
+
+	def gen(self, gen):
 		
-		path = gen.new_friend('gnuplot/graph-%s.png' % count)
-		count += 1
-		try:
-			process = subprocess.Popen(
-				[ 'gnuplot' ],
-					stdin = subprocess.PIPE,
-					stdout = subprocess.PIPE,
-					stderr = subprocess.PIPE,
-					close_fds = True,
-					shell = True
-				)
-			(out, err) = process.communicate(("set terminal png transparent %s crop\nset output \"%s\"\n%s" % (opt, path, self.toText())).encode('utf-8'))
-			if process.returncode == 127:
+		# gnuplot exists ?
+		global has_gnuplot
+		if not has_gnuplot:
+			return
+
+		# get the result
+		job = gen.get_job(self)
+		if job.cmd != None:
+			if job.error != None:
+				self.onError('can not process gnuplot: %s' % job.error)
+			if job.returncode == 127:
 				has_gnuplot = False
 				self.onWarning("gnuplot is not available")
 				return
-			if process.returncode:
-				print("ERROR: %d" % process.returncode)
-				sys.stderr.write(err)
+			if job.returncode:
+				print("ERROR: %d" % job.returncode)
+				sys.stderr.write(job.err.decode('utf-8'))
 				self.onError('error during gnuplot call')
-			gen.genEmbeddedBegin(self)
-			gen.genImage(path, self, self.caption)
-			gen.genEmbeddedEnd(self)
-		except OSError as e:
-			self.onError('can not process gnuplot: %s' % str(e))
+			cache.get(gen.doc).store(job.key, ".png", job.path)
+		gen.genEmbeddedBegin(self)
+		gen.genImage(job.path, self, self.caption)
+		gen.genEmbeddedEnd(self)
 
 	def numbering(self):
 		return "figure"
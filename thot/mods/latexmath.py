@@ -18,14 +18,13 @@ import re
 import subprocess
 import sys
 
+import thot.cache as cache
 import thot.common as common
 import thot.doc as doc
 import thot.tparser as tparser
 
 mimetex = common.CommandRequirement("mimetex", 'mimetex not found but required by latexmath module: ignoring latexmath tags')
 
-count = 0
-formulae = { }
 DEFAULT = None
 BUILDERS = { }
 BUILDER = None
@@ -175,6 +174,40 @@ try:
 except ImportError as e:
 	pass
 
+def make_formula(gen, cmd, text, node):
+	"""Build, using mimetex, the image of the given formula.
+	Return the path of the image or an empty string."""
+	formulae = gen.get_state("latexmath", dict)
+	if text in formulae:
+		return formulae[text]
+	rpath = gen.new_friend("latexmath/latexmath-%s.gif" % gen.new_count("latexmath"));
+	store = cache.get(gen.doc)
+	key = store.make_key(cmd, text)
+	if store.fetch(key, ".gif", rpath):
+		formulae[text] = rpath
+		return rpath
+	try:
+		proc = subprocess.Popen(
+			["%s -d '%s' -e %s" % (cmd, text, rpath)],
+			stdout = subprocess.PIPE,
+			stderr = subprocess.PIPE,
+			shell = True
+		)
+		out, err = proc.communicate()
+		if proc.returncode != 0:
+			sys.stderr.write(out.decode('utf-8'))
+			sys.stderr.write(err.decode('utf-8'))
+			node.onWarning("bad latexmath formula.")
+			return ''
+		else:
+			formulae[text] = rpath
+			store.store(key, ".gif", rpath)
+			return rpath
+	except OSError as e:
+		node.onWarning("mimetex is not available: no latexmath !")
+		return ''
+
+
 class MimetexMath(doc.Word):
 	
 	def __init__(self, text):
@@ -188,8 +221,6 @@ class MimetexMath(doc.Word):
 
 	def gen(self, gen):
 		global mimetex
-		global count
-		global formulae
 		
 		if gen.getType() == "latex":
 			gen.genVerbatim("$%s$" % self.text)
@@ -197,29 +228,7 @@ class MimetexMath(doc.Word):
 			cmd = mimetex.get()
 			if not cmd:
 				return
-			rpath = ''
-			if self.text in formulae:
-				rpath = formulae[self.text]
-			else:
-				rpath = gen.new_friend("latexmath/latexmath-%s.gif" % count);
-				count += 1
-				try:
-					proc = subprocess.Popen(
-						["%s -d '%s' -e %s" % (cmd, self.text, rpath)],
-						stdout = subprocess.PIPE,
-						stderr = subprocess.PIPE,
-						shell = True
-					)
-					out, err = proc.communicate()
-					if proc.returncode != 0:
-						sys.stderr.write(out)
-						sys.stderr.write(err)
-						self.onWarning("bad latexmath formula.")
-					else:
-						formulae[self.text] = rpath
-				except OSError as e:
-					MIMETEX_AVAILABLE = False
-					self.onWarning("mimetex is not available: no latexmath !")
+			rpath = make_formula(gen, cmd, self.text, self)
 			if rpath:
 				gen.genImage(rpath, None, self)
 
@@ -227,35 +236,11 @@ class MimetexBuilder(Builder):
 
 	def gen(self, gen, text, part):
 		global mimetex
-		global count
-		global formulae
 		
 		cmd = mimetex.get()
 		if not cmd:
 			return
-		rpath = ''
-		if text in formulae:
-			rpath = formulae[text]
-		else:
-			rpath = gen.new_friend("latexmath/latexmath-%s.gif" % count);
-			count += 1
-			try:
-				proc = subprocess.Popen(
-					["%s -d '%s' -e %s" % (cmd, text, rpath)],
-					stdout = subprocess.PIPE,
-					stderr = subprocess.PIPE,
-					shell = True
-				)
-				out, err = proc.communicate()
-				if proc.returncode != 0:
-					sys.stderr.write(out)
-					sys.stderr.write(err)
-					self.onWarning("bad latexmath formula.")
-				else:
-					formulae[text] = rpath
-			except OSError as e:
-				MIMETEX_AVAILABLE = False
-				self.onWarning("mimetex is not available: no latexmath !")
+		rpath = make_formula(gen, cmd, text, part)
 		if rpath:
 			gen.genImage(rpath, part, None)
 	
@@ -285,7 +270,8 @@ def selectBuilder(man):
 		n = man.doc.getVar("LATEXMATH", DEFAULT)
 		BUILDER = BUILDERS[n]
 	except KeyError:
-		man.onWarning("unknown mathlatex output: %s. Reverting to use mimetex." % v)
+		common.onWarning("unknown mathlatex output: %s. Reverting to use mimetex." % n)
+		BUILDER = BUILDERS["mimetex"]
 
 END_BLOCK = re.compile("^\s*<\/eq>\s*$")
 		
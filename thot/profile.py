@@ -0,0 +1,312 @@
+# profile -- Thot processing profiler
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Profiling of the processing of a document (option --profile).
+
+The profiler measures the wall and CPU times of the different parts
+of the processing, identified by a category and a name:
+* phase -- main phases (initialization, parsing, pre-generation, output),
+* module -- loading of a module (common.loadModule),
+* line, word -- line and word handlers of the parser (named after
+  their function and RE),
+* pregen -- pre-generation by feature and by node class building jobs,
+* gen -- gen* methods of the back-end generators,
+* command -- external commands (only wall time).
+
+Measures are aggregated by category and name: the total times include
+nested measures while the self times exclude them. With a trace, each
+measure is also recorded as an event of Chrome trace format.
+
+Profiling is enabled when current is not None: instrumented code
+checks this variable to avoid any cost when profiling is disabled."""
+
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import types
+
+current = None
+
+TOP = 40
+NAME_WIDTH = 48
+
+
+class Entry:
+	"""Aggregated measures for a category and a name."""
+	count = 0
+	wall = 0.
+	cpu = 0.
+	self_wall = 0.
+	self_cpu = 0.
+
+	def add(self, count, wall, cpu, self_wall, self_cpu):
+		self.count += count
+		self.wall += wall
+		self.cpu += cpu
+		self.self_wall += self_wall
+		self.self_cpu += self_cpu
+
+
+class Profiler:
+	"""Profiler recording the measures. Each thread has its own stack
+	of measures in progress."""
+	entries = None
+	events = None
+	local = None
+	lock = None
+
+	def __init__(self, trace = False):
+		self.entries = { }
+		self.events = [] if trace else None
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+	def reset(self):
+		"""Remove all measures."""
+		self.entries = { }
+		if self.events != None:
+			self.events = []
+
+	def stack(self):
+		"""Get the stack of measures in progress of the current thread."""
+		try:
+			return self.local.stack
+		except AttributeError:
+			self.local.stack = []
+			return self.local.stack
+
+	def begin(self, cat, name):
+		"""Begin a measure."""
+		self.stack().append([cat, name, time.perf_counter(), time.thread_time(), 0., 0.])
+
+	def end(self):
+		"""End the last begun measure."""
+		wall = time.perf_counter()
+		cpu = time.thread_time()
+		stack = self.stack()
+		(cat, name, start, cpu_start, child_wall, child_cpu) = stack.pop()
+		wall -= start
+		cpu -= cpu_start
+		if stack:
+			stack[-1][4] += wall
+			stack[-1][5] += cpu
+		self.add(cat, name, start, wall, cpu, wall - child_wall, cpu - child_cpu)
+
+	def record(self, cat, name, start, wall):
+		"""Record a measure of wall time only (like an external command)
+		as nested in the current measure."""
+		stack = self.stack()
+		if stack:
+			stack[-1][4] += wall
+		self.add(cat, name, start, wall, 0., wall, 0.)
+
+	def add(self, cat, name, start, wall, cpu, self_wall, self_cpu):
+		"""Add a measure."""
+		with self.lock:
+			try:
+				entry = self.entries[(cat, name)]
+			except KeyError:
+				entry = Entry()
+				self.entries[(cat, name)] = entry
+			entry.add(1, wall, cpu, self_wall, self_cpu)
+			if self.events != None:
+				self.events.append({
+					"name": name,
+					"cat": cat,
+					"ph": "X",
+					"ts": start * 1e6,
+					"dur": wall * 1e6,
+					"pid": os.getpid(),
+					"tid": threading.get_ident()
+				})
+
+	def call(self, cat, name, fun, *args):
+		"""Call the function with the given arguments and measure it."""
+		self.begin(cat, name)
+		try:
+			return fun(*args)
+		finally:
+			self.end()
+
+	def export(self):
+		"""Export the measures as JSON-compatible data."""
+		return {
+			"entries": [{
+					"category": cat,
+					"name": name,
+					"count": e.count,
+					"wall": e.wall,
+					"cpu": e.cpu,
+					"self_wall": e.self_wall,
+					"self_cpu": e.self_cpu
+				} for ((cat, name), e) in self.entries.items()],
+			"events": self.events if self.events != None else []
+		}
+
+	def merge(self, data):
+		"""Merge measures exported by another profiler (usually from
+		a child process)."""
+		with self.lock:
+			for e in data["entries"]:
+				key = (e["category"], e["name"])
+				try:
+					entry = self.entries[key]
+				except KeyError:
+					entry = Entry()
+					self.entries[key] = entry
+				entry.add(e["count"], e["wall"], e["cpu"], e["self_wall"], e["self_cpu"])
+			if self.events != None:
+				self.events.extend(data["events"])
+
+	def report(self, out = sys.stderr):
+		"""Display the measures as tables: times by category, then
+		the TOP entries with the biggest self wall times."""
+		cats = { }
+		for ((cat, _), e) in self.entries.items():
+			try:
+				cats[cat].add(e.count, e.self_wall, e.self_cpu, e.self_wall, e.self_cpu)
+			except KeyError:
+				cats[cat] = Entry()
+				cats[cat].add(e.count, e.self_wall, e.self_cpu, e.self_wall, e.self_cpu)
+		out.write("%-10s %10s %10s %10s\n" % ("category", "calls", "wall (s)", "cpu (s)"))
+		for (cat, e) in sorted(cats.items(), key = lambda p: -p[1].wall):
+			out.write("%-10s %10d %10.3f %10.3f\n" % (cat, e.count, e.wall, e.cpu))
+		out.write("\n%-10s %-*s %8s %9s %9s %9s %9s\n" % ("category", NAME_WIDTH, "name",
+			"calls", "wall", "self", "cpu", "self cpu"))
+		entries = sorted(self.entries.items(), key = lambda p: -p[1].self_wall)
+		for ((cat, name), e) in entries[:TOP]:
+			if len(name) > NAME_WIDTH:
+				name = name[:NAME_WIDTH - 3] + "..."
+			out.write("%-10s %-*s %8d %9.3f %9.3f %9.3f %9.3f\n" % (cat, NAME_WIDTH, name,
+				e.count, e.wall, e.self_wall, e.cpu, e.self_cpu))
+		if len(entries) > TOP:
+			out.write("(%d more entries)\n" % (len(entries) - TOP))
+
+	def save(self, path):
+		"""Save the measures in a JSON file that is also readable as
+		a Chrome trace (chrome://tracing, Perfetto)."""
+		data = self.export()
+		with open(path, "w", encoding = "utf-8") as file:
+			json.dump({
+				"traceEvents": data["events"],
+				"displayTimeUnit": "ms",
+				"entries": data["entries"]
+			}, file)
+
+
+def call(cat, name, fun, *args):
+	"""Call the function with the given arguments and measure it
+	if profiling is enabled."""
+	if current == None:
+		return fun(*args)
+	else:
+		return current.call(cat, name, fun, *args)
+
+
+def handler_name(fun, pattern):
+	"""Build the name of a parser handler from its function and RE."""
+	name = getattr(fun, "__name__", "?")
+	if name == "<lambda>":
+		return "%s %s" % (fun.__module__, pattern)
+	else:
+		return "%s.%s %s" % (fun.__module__, name, pattern)
+
+
+def class_name(obj):
+	"""Get the name of the class of an object prefixed by its module."""
+	return "%s.%s" % (obj.__class__.__module__.split(".")[-1], obj.__class__.__name__)
+
+
+def wrap(cat, name, fun):
+	"""Wrap the function to measure it when profiling is enabled."""
+	@functools.wraps(fun)
+	def measured(*args, **kwargs):
+		if current == None:
+			return fun(*args, **kwargs)
+		current.begin(cat, name)
+		try:
+			return fun(*args, **kwargs)
+		finally:
+			current.end()
+	measured.profiled = True
+	return measured
+
+
+def instrument(cls):
+	"""Wrap the gen* methods of the given generator class and of its
+	base classes to measure them."""
+	for klass in cls.__mro__:
+		for (name, fun) in list(klass.__dict__.items()):
+			if name.startswith("gen") and isinstance(fun, types.FunctionType) \
+			and not getattr(fun, "profiled", False):
+				setattr(klass, name, wrap("gen", "%s.%s.%s" %
+					(klass.__module__.split(".")[-1], klass.__name__, name), fun))
+
+
+def command_name(args):
+	"""Get the name of an external command from the arguments
+	of subprocess.Popen."""
+	if isinstance(args, (list, tuple)):
+		args = " ".join([str(arg) for arg in args])
+	words = str(args).split()
+	return os.path.basename(words[0]) if words else "?"
+
+
+class Popen(subprocess.Popen):
+	"""subprocess.Popen measuring the time of the external command."""
+	profile_start = None
+
+	def __init__(self, args, *rest, **kwargs):
+		self.profile_start = time.perf_counter()
+		super().__init__(args, *rest, **kwargs)
+
+	def wait(self, timeout = None):
+		res = super().wait(timeout)
+		if self.profile_start != None and current != None:
+			current.record("command", command_name(self.args), self.profile_start,
+				time.perf_counter() - self.profile_start)
+			self.profile_start = None
+		return res
+
+
+def start(trace = False):
+	"""Enable profiling. If trace is True, the measures are also
+	recorded as events."""
+	global current
+	current = Profiler(trace)
+	subprocess.Popen = Popen
+
+
+def stop(path = None):
+	"""Disable profiling, display the measures and, if a path is given,
+	save them in this file."""
+	global current
+	if current == None:
+		return
+	profiler = current
+	current = None
+	subprocess.Popen = Popen.__bases__[0]
+	sys.stdout.flush()
+	profiler.report()
+	if path != None:
+		try:
+			profiler.save(path)
+		except OSError as e:
+			sys.stderr.write("ERROR: cannot write profile %s: %s\n" % (path, e))
@@ -0,0 +1,102 @@
+# reader -- Thot input of parsed files
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Input of the text files parsed by Thot.
+
+The parser works line by line but the lines are not read one by one
+from the text file: the bytes are read by blocks of CHUNK_SIZE bytes
+and decoded in bulk with the encoding of the file, then split in lines.
+Only one chunk is kept in memory, whatever the size of the file.
+
+As for text files, "\\r\\n" and "\\r" line endings are read as "\\n".
+Inputs that are not buffered text files (like io.StringIO) are read
+line by line."""
+
+import codecs
+import io
+
+import thot.common as common
+
+CHUNK_SIZE = 1 << 20
+
+
+class DecodeError(common.ParseException):
+	"""Raised when the input cannot be decoded. The lines before the
+	erroneous one have been read."""
+
+	def __init__(self, msg):
+		common.ParseException.__init__(self, msg)
+
+
+def normalize(text):
+	"""Convert the line endings of text to "\\n"."""
+	if "\r" in text:
+		text = text.replace("\r\n", "\n").replace("\r", "\n")
+	return text
+
+
+def decode_error(e, prefix, encoding, errors):
+	"""Build the DecodeError for the UnicodeDecodeError e raised when
+	decoding prefix followed by e.object. Return the list of lines before
+	the error and the exception."""
+	text = prefix + bytes(e.object[:e.start]).decode(encoding, errors)
+	lines = normalize(text).split("\n")
+	return (lines[:-1], DecodeError("cannot decode with %s: %s" % (encoding, e.reason)))
+
+
+def read_chunks(input, encoding, errors):
+	"""Generate the lines of a binary file read by chunks."""
+	decoder = codecs.getincrementaldecoder(encoding)(errors)
+	rest = ""
+	while True:
+		data = input.read(CHUNK_SIZE)
+		try:
+			text = decoder.decode(data, not data)
+		except UnicodeDecodeError as e:
+			(lines, exn) = decode_error(e, rest, encoding, errors)
+			yield from lines
+			raise exn
+
+		# a "\r" at the end may be followed by "\n" in the next chunk
+		if rest.endswith("\r"):
+			rest = rest[:-1]
+			text = "\r" + text
+		if data and text.endswith("\r"):
+			text = normalize(text[:-1]) + "\r"
+		else:
+			text = normalize(text)
+
+		lines = text.split("\n")
+		lines[0] = rest + lines[0]
+		rest = lines.pop()
+		yield from lines
+		if not data:
+			break
+	if rest:
+		yield rest
+
+
+def read_lines(file):
+	"""Generate the lines of a text file, without their ending "\\n".
+	Decoding errors raise DecodeError."""
+	if not isinstance(file, io.TextIOWrapper):
+		try:
+			for line in file:
+				yield line[:-1] if line.endswith("\n") else line
+		except UnicodeDecodeError as e:
+			raise DecodeError("cannot decode: %s" % e.reason)
+		return
+	yield from read_chunks(file.buffer, codecs.lookup(file.encoding).name, file.errors)
@@ -0,0 +1,293 @@
+# serve -- Thot local preview server
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local preview server.
+
+The command "thot serve" runs an HTTP server on the documents of a
+directory. Asking for the page DOC.html generates the HTML of DOC.thot
+with the html back-end. The pages and the stylesheets are generated in
+memory: the files of the directory are not changed, except the files
+produced by external commands (dot, gnuplot, ...) that are written in
+the import directory. Other friend files are served from their source.
+
+The result of a generation is kept until the document, or one of its
+included files, changes (modification time then content). As the
+server runs in a single process, the modules are only loaded once and
+the results of external commands are reused from the cache (THOT_CACHE),
+as the snapshots of the parsed documents if they are enabled
+(THOT_SNAPSHOT)."""
+
+import html
+import http.server
+import mimetypes
+import optparse
+import os
+import os.path
+import sys
+import time
+import traceback
+import urllib.parse
+
+import thot.command as command
+import thot.common as common
+import thot.snapshot as snapshot
+import thot.stream as stream
+
+DEFAULT_PORT = 8000
+
+
+def get_stamp(path):
+	"""Get the stamp (modification time, size) of a file or None."""
+	try:
+		st = os.stat(path)
+		return (st.st_mtime, st.st_size)
+	except OSError:
+		return None
+
+
+class Entry:
+	"""Result of the generation of a document."""
+	path = None
+	stamps = None
+	hashes = None
+	pages = None
+	files = None
+	encoding = None
+	error = None
+
+	def __init__(self, path):
+		self.path = path
+		self.stamps = { }
+		self.hashes = { }
+		self.pages = { }
+		self.files = { }
+
+	def record(self, files):
+		"""Record the state of the files used by the generation."""
+		for file in files:
+			self.stamps[file] = get_stamp(file)
+			self.hashes[file] = snapshot.hash_file(file)
+
+	def is_valid(self):
+		"""Test if the files of the generation are unchanged. A file whose
+		stamp changed is only considered as changed if its content hash
+		changed."""
+		for (file, stamp) in self.stamps.items():
+			nstamp = get_stamp(file)
+			if nstamp == stamp:
+				continue
+			if nstamp == None or snapshot.hash_file(file) != self.hashes[file]:
+				return False
+			self.stamps[file] = nstamp
+		return True
+
+	def get(self, path):
+		"""Get a generated file as a pair (content, file): content is
+		the bytes of a file generated in memory, file the path of a file
+		to read. Return None if the file is not part of the generation."""
+		if path in self.pages:
+			return (self.pages[path].encode(self.encoding, "replace"), None)
+		elif path in self.files:
+			return (None, self.files[path] or path)
+		else:
+			return None
+
+
+class Server:
+	"""Generate the documents on request and keep the results."""
+	env = None
+	options = None
+	out_drivers = None
+	entries = None
+	pages = None
+
+	def __init__(self, env, options):
+		self.env = env
+		self.options = options
+		self.out_drivers = command.load_outputs(env)
+		self.entries = { }
+		self.pages = { }
+
+	def render(self, path):
+		"""Get the entry of the generation of the given .thot file,
+		generating it again if needed."""
+		entry = self.entries.get(path)
+		if entry != None:
+			if entry.is_valid():
+				return entry
+			for page in list(entry.pages.keys()) + list(entry.files.keys()):
+				if self.pages.get(page) is entry:
+					del self.pages[page]
+
+		# generate the document
+		start = time.time()
+		entry = Entry(path)
+		env = dict(self.env)
+		command.set_input(env, path)
+		man = command.make_manager(env, self.out_drivers)
+		try:
+			with open(path, encoding = common.ENCODING) as input:
+				document = command.parse(man, self.out_drivers, self.options, input)
+			gen = self.out_drivers[0][1].Generator(document)
+			gen.memory = { }
+			gen.run()
+			entry.encoding = stream.get_encoding(document.getVar("ENCODING"))
+			entry.pages = dict([(os.path.normpath(p), t) for (p, t) in gen.memory.items()])
+			entry.files = dict([(os.path.normpath(p), f) for (p, f) in gen.to_files.items()])
+		except common.ThotException as e:
+			entry.error = "ERROR: %s" % e
+		except (Exception, SystemExit):
+			entry.error = traceback.format_exc()
+		entry.record([path] + [file for file in man.files if file != path])
+
+		# record the generated files
+		self.entries[path] = entry
+		for page in list(entry.pages.keys()) + list(entry.files.keys()):
+			self.pages[page] = entry
+		if entry.error:
+			sys.stderr.write("%s\n" % entry.error)
+		common.onInfo("%s generated in %.2fs" % (path, time.time() - start))
+		return entry
+
+	def find(self, path):
+		"""Look for the file of the given path (relative to the served
+		directory). Return (status, content, file, type) where content is
+		the bytes of the answer or file is the path of a file to send."""
+		entry = None
+		if path in self.pages:
+			entry = self.render(self.pages[path].path)
+		elif path.endswith(".html") and os.path.isfile(path[:-5] + ".thot"):
+			entry = self.render(path[:-5] + ".thot")
+		elif os.path.isdir(path):
+			return (200, self.make_index(path), None, "text/html; charset=utf-8")
+		elif os.path.isfile(path):
+			return (200, None, path, mimetypes.guess_type(path)[0])
+
+		# look in the generated files
+		if entry != None:
+			if entry.error:
+				return (500, entry.error.encode("utf-8"), None, "text/plain; charset=utf-8")
+			res = entry.get(path)
+			if res != None:
+				type = mimetypes.guess_type(path)[0]
+				if res[0] != None and type and type.startswith("text/"):
+					type = "%s; charset=%s" % (type, entry.encoding)
+				return (200, res[0], res[1], type)
+		return (404, b"not found", None, "text/plain")
+
+	def make_index(self, path):
+		"""Build the page listing the documents and the sub-directories
+		of a directory."""
+		items = []
+		for name in sorted(os.listdir(path)):
+			if os.path.isdir(os.path.join(path, name)):
+				items.append(name + "/")
+			elif name.endswith(".thot"):
+				items.append(name[:-5] + ".html")
+		return ("<html><head><title>%s</title></head><body><ul>\n%s</ul></body></html>\n" % (
+			html.escape(path),
+			"".join(['<li><a href="%s">%s</a></li>\n'
+				% (urllib.parse.quote(item), html.escape(item)) for item in items])
+		)).encode("utf-8")
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	"""Handler of the HTTP requests."""
+
+	def answer(self, body):
+		path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+		path = os.path.normpath(path.lstrip("/"))
+		if path == ".." or path.startswith("../") or os.path.isabs(path):
+			(status, content, file, type) = (403, b"forbidden", None, "text/plain")
+		else:
+			(status, content, file, type) = self.server.thot.find(path)
+		if file != None:
+			try:
+				with open(file, "rb") as input:
+					content = input.read()
+			except OSError as e:
+				(status, content, type) = (404, str(e).encode("utf-8"), "text/plain")
+		self.send_response(status)
+		self.send_header("Content-Type", type or "application/octet-stream")
+		self.send_header("Content-Length", str(len(content)))
+		self.send_header("Cache-Control", "no-cache")
+		self.end_headers()
+		if body:
+			self.wfile.write(content)
+
+	def do_GET(self):
+		self.answer(True)
+
+	def do_HEAD(self):
+		self.answer(False)
+
+
+def make_option_parser():
+	"""Build the parser of the options of "thot serve"."""
+	oparser = optparse.OptionParser(usage = "%prog serve [options] [DIR]")
+	oparser.add_option("-p", "--port", action="store", dest="port", type="int",
+		default=DEFAULT_PORT, help="port of the server (default %d)" % DEFAULT_PORT)
+	oparser.add_option("-b", "--bind", action="store", dest="bind", default="localhost",
+		help="address the server is bound to (default localhost)")
+	oparser.add_option("-D", "--define", action="append", dest="defines",
+		help="add the given definition to the document environment.")
+	oparser.add_option("-u", "--use", action="append", dest="uses",
+		help="given module is loaded before the generation.")
+	oparser.add_option("--encoding", "-e", dest="encoding", action="store",
+		type="string", help="select the encoding of the input files")
+	oparser.add_option("--verbose", "-v", dest = "verbose", action="store_true", default=False,
+		help="display verbose messages about the processing")
+	return oparser
+
+
+def run(argv):
+	"""Run the preview server with the given arguments."""
+	(options, args) = make_option_parser().parse_args(argv)
+	if len(args) > 1:
+		common.onError("serve requires at most one directory")
+	common.IS_VERBOSE = options.verbose
+	if options.encoding:
+		common.ENCODING = options.encoding
+	env = command.make_env()
+	env["THOT_OUT_TYPE"] = "html"
+	env["THOT_OUT_PATH"] = ""
+	if options.defines:
+		for d in options.defines:
+			p = d.find('=')
+			if p == -1:
+				common.onError('-D' + d + ' must follow syntax -Didentifier=value')
+			else:
+				env[d[:p]] = d[p+1:]
+	env["THOT_INCREMENTAL"] = "no"
+
+	# Thot paths are relative to the current directory
+	if args:
+		try:
+			os.chdir(args[0])
+		except OSError as e:
+			common.onError("cannot serve %s: %s" % (args[0], e))
+	try:
+		server = http.server.HTTPServer((options.bind, options.port), Handler)
+	except OSError as e:
+		common.onError("cannot start the server on %s:%d: %s" % (options.bind, options.port, e))
+	server.thot = Server(env, options)
+	common.onInfo("serving %s at http://%s:%d/ (Ctrl-C to stop)"
+		% (os.getcwd(), options.bind, server.server_address[1]))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
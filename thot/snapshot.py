@@ -0,0 +1,297 @@
+# snapshot -- Thot parsed document snapshots
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Snapshots of parsed documents.
+
+Once a document is parsed, its tree, labels, features and variables
+are saved in a snapshot stored in the cache directory (THOT_CACHE).
+The snapshot records the content hashes of the input files (including
+the files declared by modules with Manager.addDependency()) and of the
+Python modules loaded during the parsing, and the initial value of
+the variables read by the parsing. A later generation of the same
+document loads the snapshot instead of parsing again if none of them
+changed. The messages displayed during the parsing (warnings, etc)
+are recorded in the snapshot and displayed again when it is loaded.
+
+Objects that are global of Thot modules (classes, features, etc) are
+not saved but recorded by reference in the snapshot.
+
+The following variables are supported:
+* THOT_SNAPSHOT -- "yes" to enable the snapshots.
+"""
+
+import hashlib
+import io
+import os
+import os.path
+import pickle
+import sys
+import tempfile
+import types
+
+import thot.cache as cache
+import thot.common as common
+import thot.doc as tdoc
+
+VERSION = "1"
+
+PRIMITIVES = (type(None), bool, int, float, complex, str, bytes,
+	tuple, list, dict, set, frozenset, types.ModuleType)
+
+
+def hash_file(path):
+	"""Compute the hash of the content of a file.
+	Return None if the file cannot be read."""
+	try:
+		with open(path, "rb") as file:
+			return hashlib.sha256(file.read()).hexdigest()
+	except OSError:
+		return None
+
+
+def get_modules():
+	"""Get the Python modules involved in the parsing as a list
+	of pairs (reference, module) where reference is ("import", name)
+	for modules imported by Python and ("load", path) for modules
+	loaded by Thot."""
+	loaded = set([id(mod) for mod in common.modules.values()])
+	mods = [(("import", name), mod) for (name, mod) in list(sys.modules.items())
+		if (name == "thot" or name.startswith("thot.")) and mod != None
+		and id(mod) not in loaded]
+	mods = mods + [(("load", path), mod) for (path, mod) in common.modules.items()]
+	return mods
+
+
+def get_module(ref):
+	"""Get a module from its reference."""
+	if ref[0] == "import":
+		__import__(ref[1])
+		return sys.modules[ref[1]]
+	else:
+		dir, file = os.path.split(ref[1])
+		return common.loadModule(os.path.splitext(file)[0], dir)
+
+
+def get_globals():
+	"""Build the map of global objects of modules (except primitive
+	values) to their reference (module reference, name, key). As the
+	binding of a global variable may depend on the module initialization,
+	objects found in global dictionaries are referenced by their key
+	(key is None for a simple global)."""
+	map = { }
+	dicts = []
+	for (ref, mod) in get_modules():
+		for (name, val) in list(mod.__dict__.items()):
+			if not isinstance(val, PRIMITIVES):
+				map[id(val)] = (ref, name, None)
+			elif isinstance(val, dict):
+				dicts.append((ref, name, val))
+	for (ref, name, vals) in dicts:
+		for (key, val) in list(vals.items()):
+			if isinstance(key, str) and not isinstance(val, PRIMITIVES):
+				map[id(val)] = (ref, name, key)
+	return map
+
+
+class Pickler(pickle.Pickler):
+	"""Pickler recording globals of modules and the document by
+	reference."""
+	document = None
+	globals = None
+
+	def __init__(self, file, document):
+		pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+		self.document = document
+		self.globals = get_globals()
+
+	def persistent_id(self, obj):
+		if obj is self.document:
+			return ("document", )
+		elif isinstance(obj, PRIMITIVES):
+			return None
+		try:
+			return ("global", ) + self.globals[id(obj)]
+		except KeyError:
+			return None
+
+
+class Unpickler(pickle.Unpickler):
+	"""Unpickler resolving the references of Pickler."""
+	document = None
+
+	def __init__(self, file, document):
+		pickle.Unpickler.__init__(self, file)
+		self.document = document
+
+	def persistent_load(self, pid):
+		if pid[0] == "document":
+			return self.document
+		mod = get_module(tuple(pid[1]))
+		if mod == None:
+			raise pickle.UnpicklingError("no module %s" % (pid[1], ))
+		val = getattr(mod, pid[2])
+		if pid[3] != None:
+			val = val[pid[3]]
+		return val
+
+
+class Snapshot:
+	"""Snapshot of the parsing of a document."""
+	man = None
+	path = None
+	env = None
+	uses = None
+	messages = None
+
+	def __init__(self, man, out_drivers, uses):
+		self.man = man
+		doc = man.get_doc()
+		self.env = dict(doc.env)
+		file = doc.env["THOT_FILE"]
+		h = hashlib.sha256()
+		h.update(os.path.abspath(file).encode("utf-8"))
+		for out_driver in out_drivers:
+			if "init" in out_driver.__dict__:
+				h.update(b"\0")
+				h.update(out_driver.__file__.encode("utf-8"))
+		store = cache.get(doc)
+		if file != "<stdin>" and store != cache.NULL_CACHE \
+		and doc.getVar("THOT_SNAPSHOT") == "yes":
+			self.path = os.path.join(store.path, "snapshots", h.hexdigest() + ".pickle")
+		self.uses = list(uses) if uses else []
+
+	def make_info(self):
+		"""Build the information to check the validity of the snapshot."""
+		doc = self.man.get_doc()
+		return {
+			"version": VERSION,
+			"python": sys.version_info[:2],
+			"encoding": common.ENCODING,
+			"uses": self.uses,
+			"files": dict([(path, hash_file(path)) for path in self.man.files]),
+			"modules": dict([(mod.__file__, hash_file(mod.__file__))
+				for (_, mod) in get_modules() if getattr(mod, "__file__", None)]),
+			"vars": dict([(id, self.env.get(id)) for id in doc.used_vars]),
+			"mods": [common.module_name(mod) for mod in self.man.used_mods],
+			"delta": dict([(k, v) for (k, v) in doc.env.items() if self.env.get(k) != v]),
+			"messages": self.messages
+		}
+
+	def is_valid(self, info):
+		"""Test if the information of a snapshot is valid for the
+		current generation."""
+		if info["version"] != VERSION \
+		or tuple(info["python"]) != sys.version_info[:2] \
+		or info["encoding"] != common.ENCODING \
+		or info["uses"] != self.uses:
+			return False
+		for (path, h) in list(info["files"].items()) + list(info["modules"].items()):
+			if h == None or hash_file(path) != h:
+				return False
+		for (id, val) in info["vars"].items():
+			if self.env.get(id) != val:
+				return False
+		return True
+
+	def start(self):
+		"""Called before the parsing to record the used variables
+		and the displayed messages."""
+		self.man.get_doc().used_vars = set()
+		if self.path != None:
+			self.messages = common.record_messages()
+
+	def save(self):
+		"""Save the snapshot of the parsed document."""
+		doc = self.man.get_doc()
+		if self.path == None:
+			doc.used_vars = None
+			return
+		common.stop_messages()
+		info = self.make_info()
+		doc.used_vars = None
+		state = tdoc.get_attrs(doc)
+		for name in ["env", "used_vars", "var_cache", "labels", "inv_labels", "numbers"]:
+			if name in state:
+				del state[name]
+		labels = [(label, doc.labels[label]) for label in doc.labels]
+		try:
+			buf = io.BytesIO()
+			pickle.dump(info, buf, pickle.HIGHEST_PROTOCOL)
+			Pickler(buf, doc).dump((state, labels))
+			dpath = os.path.dirname(self.path)
+			os.makedirs(dpath, exist_ok = True)
+			fd, tmp = tempfile.mkstemp(dir = dpath)
+			with os.fdopen(fd, "wb") as file:
+				file.write(buf.getvalue())
+			os.replace(tmp, self.path)
+		except OSError as e:
+			common.onWarning("cannot save snapshot %s: %s" % (self.path, e))
+		except Exception as e:
+			common.onVerbose(lambda _: "cannot save snapshot of %s: %s" % (doc.env["THOT_FILE"], e))
+
+	def load(self, make_manager, out_drivers):
+		"""Try to load the snapshot in the document of the manager.
+		make_manager is a function building a new manager to replay the
+		initialization of back-ends and used modules.
+		Return True if the snapshot has been loaded, False else."""
+		if self.path == None:
+			return False
+		doc = self.man.get_doc()
+		try:
+			with open(self.path, "rb") as file:
+				info = pickle.load(file)
+				if not self.is_valid(info):
+					return False
+
+				# initialize back-end and modules as in the parsing
+				shown = common.record_messages()
+				man = make_manager()
+				for (id, val) in info["delta"].items():
+					man.get_doc().setVar(id, val)
+				for out_driver in out_drivers:
+					if "init" in out_driver.__dict__:
+						out_driver.init(man)
+				for name in info["mods"]:
+					man.use(name)
+
+				# load the document
+				(state, labels) = Unpickler(file, doc).load()
+		except FileNotFoundError:
+			return False
+		except Exception as e:
+			common.onVerbose(lambda _: "cannot load snapshot %s: %s" % (self.path, e))
+			return False
+		finally:
+			common.stop_messages()
+		self.man.used_mods = man.used_mods
+		self.man.files = list(info["files"].keys())
+
+		# install the parsed document
+		for (name, val) in state.items():
+			setattr(doc, name, val)
+		for (id, val) in info["delta"].items():
+			doc.setVar(id, val)
+		for (label, node) in labels:
+			doc.addLabel(label, node)
+		common.onVerbose(lambda _: "loaded snapshot %s" % self.path)
+
+		# display the messages of the parsing not displayed by the initialization
+		for (kind, message) in info["messages"]:
+			if (kind, message) in shown:
+				shown.remove((kind, message))
+			else:
+				common.replay_message(kind, message)
+		return True
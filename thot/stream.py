@@ -0,0 +1,123 @@
+# stream -- Thot buffered output streams
+# Copyright (C) 2020  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Buffered output streams used by the back-ends to write the
+generated files.
+
+The back-ends write the generated text by many small pieces. The output
+streams are text streams of the io module (implemented in C) to keep
+the cost of each write as low as possible: the text is encoded by chunks
+and the encoded bytes are written to the file by blocks of BUFFER_SIZE
+bytes. The written text is never kept as a whole: outputs to the
+standard output or to a pipe are streamed.
+
+Once closed with close_output(), the number of bytes written
+to a stream is known.
+
+Streams opened with open_memory() keep the text in memory instead of
+writing it to a file."""
+
+import codecs
+import io
+import locale
+import sys
+
+BUFFER_SIZE = 1 << 20
+STDOUT = "-"
+
+
+class Sink(io.RawIOBase):
+	"""Raw stream forwarding the bytes to a binary file that is not
+	seekable (like the standard output) and counting them."""
+	name = STDOUT
+	file = None
+	count = 0
+
+	def __init__(self, file):
+		io.RawIOBase.__init__(self)
+		self.file = file
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		self.file.write(data)
+		self.count += len(data)
+		return len(data)
+
+	def close(self):
+		if not self.closed:
+			self.file.flush()
+		io.RawIOBase.close(self)
+
+
+class MemoryOutput(io.StringIO):
+	"""Text stream keeping the written text in memory."""
+	name = None
+	text_encoding = None
+
+	def __init__(self, name, encoding):
+		io.StringIO.__init__(self)
+		self.name = name
+		self.text_encoding = encoding
+
+
+def get_encoding(encoding):
+	"""Get the encoding to write files with. If encoding is not
+	given or not supported, the encoding of the locale is used."""
+	if encoding:
+		try:
+			return codecs.lookup(encoding).name
+		except LookupError:
+			sys.stderr.write("WARNING: unknown encoding %s: using %s\n"
+				% (encoding, locale.getpreferredencoding()))
+	return locale.getpreferredencoding()
+
+
+def open_output(path, encoding = None):
+	"""Open a buffered text stream to write the file with the given path
+	(the name attribute of the stream). If the path is STDOUT, the stream
+	writes to the standard output."""
+	if path == STDOUT:
+		sys.stdout.flush()
+		raw = Sink(sys.stdout.buffer)
+	else:
+		raw = io.FileIO(path, "w")
+	return io.TextIOWrapper(io.BufferedWriter(raw, BUFFER_SIZE), get_encoding(encoding))
+
+
+def open_memory(path, encoding = None):
+	"""Open a text stream keeping the text of the file with the given
+	path (the name attribute of the stream) in memory. The text is
+	available with getvalue() until the stream is closed."""
+	return MemoryOutput(path, get_encoding(encoding))
+
+
+def close_output(out):
+	"""Close a stream opened by open_output() or open_memory() and return
+	the number of bytes written to the file (or of the encoded text)."""
+	out.flush()
+	if isinstance(out, MemoryOutput):
+		size = len(out.getvalue().encode(out.text_encoding, "replace"))
+		out.close()
+		return size
+	raw = out.buffer.raw
+	if isinstance(raw, Sink):
+		size = raw.count
+	else:
+		size = raw.tell()
+	out.close()
+	return size
@@ -17,9 +17,17 @@
 import os.path
 import re
 import sys
+try:
+	import re._parser as sre_parse
+	import re._constants as sre_constants
+except ImportError:
+	import sre_parse
+	import sre_constants
 
 import thot.doc as doc
 import thot.common as common
+import thot.profile as profile
+import thot.reader as reader
 
 DEBUG = False
 
@@ -71,6 +79,73 @@ __words__ = [
 ]
 INITIAL_WORDS = [(f, e) for (f, e, _) in __words__]
 
+MAX_RANGE = 256
+
+def chars_cost(chars):
+	"""Estimate how often a line contains one of the given characters:
+	letters, digits and spaces are much more frequent than other ones."""
+	return sum(10 if c.isalnum() or c.isspace() else 1 for c in chars)
+
+
+def required_chars(seq):
+	"""Compute a set of characters such that any match of the parsed
+	RE sequence contains at least one of them. Among the possible sets,
+	the one with the rarest characters is chosen. Return None if no
+	such set can be determined."""
+	best = None
+	for (op, arg) in seq:
+		chars = None
+		if op is sre_constants.LITERAL:
+			chars = set(chr(arg))
+		elif op is sre_constants.IN:
+			chars = set()
+			for (iop, iarg) in arg:
+				if iop is sre_constants.LITERAL:
+					chars.add(chr(iarg))
+				elif iop is sre_constants.RANGE and iarg[1] - iarg[0] < MAX_RANGE:
+					chars.update(chr(c) for c in range(iarg[0], iarg[1] + 1))
+				else:
+					chars = None
+					break
+		elif op is sre_constants.SUBPATTERN:
+			if arg[1] & sre_constants.SRE_FLAG_IGNORECASE:
+				return None
+			chars = required_chars(arg[3])
+		elif op is sre_constants.BRANCH:
+			chars = set()
+			for alt in arg[1]:
+				alt_chars = required_chars(alt)
+				if alt_chars == None:
+					chars = None
+					break
+				chars.update(alt_chars)
+		elif op is sre_constants.MAX_REPEAT or op is sre_constants.MIN_REPEAT:
+			if arg[0] > 0:
+				chars = required_chars(arg[2])
+		if chars != None and (best == None or chars_cost(chars) < chars_cost(best)):
+			best = chars
+	return best
+
+
+def make_filter_re(words):
+	"""Build an RE matching the characters such that a line containing
+	none of them cannot contain any word of the given list of
+	(function, RE). Return None if there is no such characters."""
+	chars = set()
+	for (fun, wre) in words:
+		try:
+			parsed = sre_parse.parse(wre)
+		except Exception:
+			return None
+		if parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE:
+			return None
+		required = required_chars(parsed)
+		if required == None:
+			return None
+		chars.update(required)
+	return re.compile("[%s]" % "".join(re.escape(c) for c in sorted(chars)))
+
+
 def handleText(man, line, suffix = ' '):
 
 	# init RE_WORDS
@@ -83,6 +158,12 @@ def handleText(man, line, suffix = ' '):
 			text = text + "(?P<a" + str(i) + ">" + wre + ")"
 			i = i + 1
 		man.words_re = re.compile(text)
+		man.words_filter = make_filter_re(man.words)
+
+	# no word in the line
+	if man.words_filter != None and man.words_filter.search(line) == None:
+		man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeWord(line + suffix)))
+		return
 
 	# look in line
 	match = man.words_re.search(line)
@@ -93,7 +174,10 @@ def handleText(man, line, suffix = ' '):
 		if word:
 			man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeWord(word)))
 		line = line[match.end():]
-		fun(man, match)
+		if profile.current == None:
+			fun(man, match)
+		else:
+			profile.current.call("word", profile.handler_name(fun, wre), fun, man, match)
 		match = man.words_re.search(line)
 
 	# end of line
@@ -117,8 +201,8 @@ def handleInclude(man, match):
 	if not os.path.isabs(path):
 		path = os.path.join(os.path.dirname(man.file_name), path)
 	try:
-		file = open(path)
-		man.parseInternal(file, path)
+		with open(path, encoding = common.ENCODING) as file:
+			man.parseInternal(file, path)
 	except IOError as e:
 		common.onError('%s:%d: cannot include "%s": %s' % (man.file_name, man.line_num, path, e))
 
@@ -165,6 +249,52 @@ __lines__ = [
 ]
 INITIAL_LINES = [(f, re.compile(e)) for (f, e, _) in __lines__]
 
+GROUP_RE = re.compile(r"\\.|\(\?P<(\w+)>|\(\?P=(\w+)\)")
+BACKREF_RE = re.compile(r"\\[1-9]")
+
+def compileLines(lines):
+	"""Build the matcher of line syntaxes. Consecutive line REs are
+	merged in an alternation where the group a<i> identifies the
+	matching line syntax (the first matching one as in a sequential
+	test). As group names must be unique, the named groups of each RE
+	are renamed. REs that cannot be merged (flags, numeric
+	back-references) are kept alone.
+	
+	The result is a list of pairs (RE, index) where index is the index
+	of the line syntax for a single RE, None for merged REs."""
+	res = []
+	alts = []
+	
+	def rename(i, pat):
+		def fix(m):
+			if m.group(1):
+				return "(?P<a%d_%s>" % (i, m.group(1))
+			elif m.group(2):
+				return "(?P=a%d_%s)" % (i, m.group(2))
+			else:
+				return m.group(0)
+		return GROUP_RE.sub(fix, pat)
+	
+	def flush():
+		if alts:
+			try:
+				res.append((re.compile("|".join([a for (_, a) in alts])), None))
+			except re.error:
+				res.extend([(lines[i][1], i) for (i, _) in alts])
+			del alts[:]
+	
+	for i in range(0, len(lines)):
+		lre = lines[i][1]
+		if not isinstance(lre.pattern, str) \
+		or lre.flags != re.UNICODE \
+		or BACKREF_RE.search(lre.pattern):
+			flush()
+			res.append((lre, i))
+		else:
+			alts.append((i, "(?P<a%d>%s)" % (i, rename(i, lre.pattern))))
+	flush()
+	return res
+
 class Syntax:
 	"""Base class of all syntaxes added to the parser."""
 	
@@ -188,15 +318,21 @@ class DefaultParser:
 
 	def parse(self, handler, line):
 		line = handler.doc.reduceVars(line)
-		done = False
-		for (fun, re) in handler.lines:
-			match = re.match(line)
+		if handler.lines_re == None:
+			handler.lines_re = compileLines(handler.lines)
+		for (lre, idx) in handler.lines_re:
+			match = lre.match(line)
 			if match:
-				fun(handler, match)
-				done = True
-				break
-		if not done:
-			handleText(handler, line)
+				if idx == None:
+					idx = int(match.lastgroup[1:])
+					match = handler.lines[idx][1].match(line)
+				if profile.current == None:
+					handler.lines[idx][0](handler, match)
+				else:
+					(fun, lre) = handler.lines[idx]
+					profile.current.call("line", profile.handler_name(fun, lre.pattern), fun, handler, match)
+				return
+		handleText(handler, line)
 
 
 class Manager:
@@ -205,26 +341,32 @@ class Manager:
 	parser = None
 	#doc = None
 	lines = None
+	lines_re = None
 	words = None
 	words_re = None
+	words_filter = None
 	added_lines = None
 	added_words = None
 	line_num = None
 	file_name = None
 	used_mods = None
 	factory = None
+	files = None
+	sending = False
+	forwarded = None
 
 	def __init__(self, document, factory = doc.Factory()):
 		self.item = document
 		self.doc = document
 		self.parser = DefaultParser()
 		self.items = []
-		self.lines = INITIAL_LINES
-		self.words = INITIAL_WORDS
+		self.lines = list(INITIAL_LINES)
+		self.words = list(INITIAL_WORDS)
 		self.added_lines = []
 		self.added_words = []
 		self.used_mods = []
 		self.factory = factory
+		self.files = []
 
 	def get_doc(self):
 		return self.doc
@@ -240,9 +382,22 @@ class Manager:
 		print("DEBUG: %s" % msg)
 
 	def send(self, event):
+		"""Send an event to the top item. The events forwarded (see
+		forward()) by the items are sent in turn, in a loop, so that
+		deeply nested items do not reach the recursion limit."""
 		if DEBUG:
 			self.debug("send(%s)" % event) 
-		self.item.onEvent(self, event)
+		sending = self.sending
+		forwarded = self.forwarded
+		self.sending = True
+		try:
+			while event != None:
+				self.forwarded = None
+				self.item.onEvent(self, event)
+				event = self.forwarded
+		finally:
+			self.sending = sending
+			self.forwarded = forwarded
 
 	def iter(self):
 		"""Generate an iterator on the stack of items (from top to bottom)."""
@@ -269,10 +424,22 @@ class Manager:
 			self.debug("stack = %s" % self.items)		
 
 	def forward(self, event):
+		"""Pop the top item and send it the event. It must be the last
+		action of onEvent(): the event is sent after it returns."""
 		if DEBUG:
 			self.debug("forward(%s)" % event)
 		self.pop()
-		self.send(event)
+		if self.sending:
+			self.forwarded = event
+		else:
+			self.send(event)
+
+	def addDependency(self, path):
+		"""Declare a file read by a module during the parsing (like a tag
+		file). As the parsed files, its change invalidates the snapshot
+		of the document."""
+		if path not in self.files:
+			self.files.append(path)
 
 	def setParser(self, parser):
 		self.parser = parser
@@ -285,11 +452,14 @@ class Manager:
 		prev_file = self.file_name
 		self.line_num = 0
 		self.file_name = name
-		for line in file:
+		self.files.append(name)
+		try:
+			for line in reader.read_lines(file):
+				self.line_num += 1
+				self.parser.parse(self, line)
+		except reader.DecodeError as e:
 			self.line_num += 1
-			if line[-1] == '\n':
-				line = line[0:-1]
-			self.parser.parse(self, line)
+			raise common.ParseException(str(e))
 		self.line_num = prev_line
 		self.file_name = prev_file
 
@@ -313,6 +483,7 @@ class Manager:
 		(f, re) with f the function to call when the RE re is found."""
 		self.added_lines.append(line)
 		self.lines.append(line)
+		self.lines_re = None
 
 	def addWord(self, word):
 		self.added_words.append(word)
@@ -326,6 +497,7 @@ class Manager:
 		self.lines.extend(INITIAL_LINES)
 		self.lines.extend(self.added_lines)
 		self.lines.extend(lines)
+		self.lines_re = None
 
 		# process words
 		self.words = []